@@ -8,10 +8,11 @@ require('dotenv').config();
 const express = require('express');
 const multer = require('multer');
 const path = require('path');
-const { createClient } = require('@supabase/supabase-js');
+const fs = require('fs');
+const zlib = require('zlib');
 const crypto = require('crypto');
-const axios = require('axios');
 const cors = require('cors');
+const compression = require('compression');
 const moment = require('moment-timezone');
 
 // ========== IMPORTAR BOT DE TELEGRAM ==========
@@ -21,21 +22,21 @@ const bot = require('./bot');
 const PORT = process.env.PORT || 3000;
 const BOT_TOKEN = process.env.BOT_TOKEN;
 const ADMIN_IDS = process.env.ADMIN_IDS ? process.env.ADMIN_IDS.split(',').map(id => parseInt(id.trim())) : [];
-const SUPABASE_URL = process.env.SUPABASE_URL;
-const SUPABASE_SERVICE_KEY = process.env.SUPABASE_SERVICE_KEY;
 const BONUS_CUP_DEFAULT = parseFloat(process.env.BONUS_CUP_DEFAULT) || 70;
 const WEBAPP_URL = process.env.WEBAPP_URL || `http://localhost:${PORT}`;
 const TIMEZONE = process.env.TIMEZONE || 'America/Havana';
 
 // ========== INICIALIZAR SUPABASE ==========
-const supabase = createClient(SUPABASE_URL, SUPABASE_SERVICE_KEY);
+const supabase = bot.context.supabase;
 
 // ========== INICIALIZAR EXPRESS ==========
 const app = express();
+// gzip/deflate según Accept-Encoding: app.html pesa ~130 KB sin comprimir y
+// las respuestas JSON de la API también se benefician.
+app.use(compression());
 app.use(cors());
 app.use(express.json());
 app.use(express.urlencoded({ extended: true }));
-app.use(express.static(path.join(__dirname, 'webapp')));
 
 // ========== CONFIGURACIÓN DE MULTER ==========
 const upload = multer({
@@ -52,8 +53,49 @@ const regionMap = {
 
 // ========== FUNCIONES AUXILIARES ==========
 
+const ADMIN_ID_SET = new Set(ADMIN_IDS);
+
+// userId puede llegar como número o como string (query/body de la WebApp)
 function isAdmin(userId) {
-    return ADMIN_IDS.includes(parseInt(userId));
+    return ADMIN_ID_SET.has(Number(userId));
+}
+
+// Registra un fallo al enviar una notificación sin cortar el flujo principal.
+// Los 429 de Telegram se distinguen para que el retry_after quede en el log.
+function logNotifyError(where, e) {
+    if (e && e.code === 429) {
+        console.warn(`Límite de Telegram (429) en ${where}, reintentar en ${e.parameters?.retry_after ?? '?'}s`);
+    } else {
+        console.warn(`Error notificando (${where}):`, e?.message || e);
+    }
+}
+
+function escapeHTML(text) {
+    if (!text) return '';
+    return String(text)
+        .replace(/&/g, '&amp;')
+        .replace(/</g, '&lt;')
+        .replace(/>/g, '&gt;')
+        .replace(/"/g, '&quot;')
+        .replace(/'/g, '&#039;');
+}
+
+// Avisos a admins en paralelo, siempre en HTML; los fallos individuales solo
+// se registran
+function notifyAdmins(text, extra, where) {
+    return Promise.all(ADMIN_IDS.map(adminId =>
+        bot.telegram.sendMessage(adminId, text, { ...extra, parse_mode: 'HTML' }).catch(e => logNotifyError(where, e))
+    ));
+}
+
+// Mismo teclado Aprobar/Rechazar que usa bot.js en los avisos a admins
+function approveRejectMarkup(kind, id) {
+    return {
+        inline_keyboard: [[
+            { text: '✅ Aprobar', callback_data: `approve_${kind}_${id}` },
+            { text: '❌ Rechazar', callback_data: `reject_${kind}_${id}` }
+        ]]
+    };
 }
 
 function verifyTelegramWebAppData(initData, botToken) {
@@ -68,89 +110,50 @@ function verifyTelegramWebAppData(initData, botToken) {
     return computedHash === hash;
 }
 
-// Obtener todas las tasas
-async function getExchangeRates() {
-    const { data } = await supabase
-        .from('exchange_rate')
-        .select('rate, rate_usdt, rate_trx')
-        .eq('id', 1)
-        .single();
-    return data || { rate: 110, rate_usdt: 110, rate_trx: 1 };
-}
-
-async function getExchangeRateUSD() {
-    const rates = await getExchangeRates();
-    return rates.rate;
-}
-
-async function getExchangeRateUSDT() {
-    const rates = await getExchangeRates();
-    return rates.rate_usdt;
-}
-
-async function getExchangeRateTRX() {
-    const rates = await getExchangeRates();
-    return rates.rate_trx;
-}
-
-async function setExchangeRateUSD(rate) {
-    await supabase
-        .from('exchange_rate')
-        .update({ rate, updated_at: new Date() })
-        .eq('id', 1);
-}
-
-async function setExchangeRateUSDT(rate) {
-    await supabase
-        .from('exchange_rate')
-        .update({ rate_usdt: rate, updated_at: new Date() })
-        .eq('id', 1);
-}
-
-async function setExchangeRateTRX(rate) {
-    await supabase
-        .from('exchange_rate')
-        .update({ rate_trx: rate, updated_at: new Date() })
-        .eq('id', 1);
-}
-
-// Convertir cualquier moneda a CUP
-async function convertToCUP(amount, currency) {
-    const rates = await getExchangeRates();
-    switch (currency) {
-        case 'CUP': return amount;
-        case 'USD': return amount * rates.rate;
-        case 'USDT': return amount * rates.rate_usdt;
-        case 'TRX': return amount * rates.rate_trx;
-        case 'MLC': return amount * rates.rate; // MLC se trata como USD
-        default: return 0;
-    }
-}
-
-// Convertir de CUP a otra moneda
-async function convertFromCUP(amountCUP, targetCurrency) {
-    const rates = await getExchangeRates();
-    switch (targetCurrency) {
-        case 'CUP': return amountCUP;
-        case 'USD': return amountCUP / rates.rate;
-        case 'USDT': return amountCUP / rates.rate_usdt;
-        case 'TRX': return amountCUP / rates.rate_trx;
-        case 'MLC': return amountCUP / rates.rate;
-        default: return 0;
-    }
-}
+// ========== CONFIGURACIÓN Y SALDOS (COMPARTIDOS CON BOT.JS) ==========
+// La caché, los lectores/setters de configuración y los wrappers de las RPC de
+// saldo se definen una sola vez en bot.js y llegan por bot.context, igual que
+// el cliente de Supabase: lo que invalida un endpoint de admin deja de servirse
+// también en el bot, y viceversa.
+const {
+    invalidateCache,
+    getExchangeRates,
+    getPlayPrices,
+    getPlayPrice,
+    getMethodsIndex,
+    getMethods,
+    getMethod,
+    setExchangeRateUSD,
+    setExchangeRateUSDT,
+    setExchangeRateTRX,
+    convertToCUP,
+    adjustBalance,
+    approveDeposit,
+    approveWithdraw,
+    placeBet,
+    transferBalance,
+    getAppConfig,
+    getMinDepositUSD,
+    getMinWithdrawUSD,
+    setMinDepositUSD,
+    setMinWithdrawUSD
+} = bot.context;
+
+const SESSION_COLUMNS = 'id, lottery, date, time_slot, status, end_time';
 
 // ========== FUNCIÓN GETORCREATEUSER CON MANEJO DE ERROR DE COLUMNA ==========
 async function getOrCreateUser(telegramId, firstName = 'Jugador', username = null) {
     try {
-        let { data: user, error: selectError } = await supabase
-            .from('users')
-            .select('*')
-            .eq('telegram_id', telegramId)
-            .maybeSingle();
+        // Misma RPC que getUser en bot.js: una sola ida y vuelta
+        const { data, error } = await supabase.rpc('get_or_create_user', {
+            p_telegram_id: telegramId,
+            p_first_name: firstName,
+            p_username: username,
+            p_bonus_cup: BONUS_CUP_DEFAULT
+        });
 
-        if (selectError) {
-            console.error('Error al consultar usuario:', selectError);
+        if (error || !data || !data.user) {
+            console.error('Error al obtener/crear usuario:', error);
             // Devolvemos un objeto por defecto para no romper la app
             return {
                 telegram_id: telegramId,
@@ -161,57 +164,8 @@ async function getOrCreateUser(telegramId, firstName = 'Jugador', username = nul
                 usd: 0
             };
         }
-
-        if (!user) {
-            try {
-                const { data: newUser, error: insertError } = await supabase
-                    .from('users')
-                    .insert({
-                        telegram_id: telegramId,
-                        first_name: firstName,
-                        username: username,
-                        bonus_cup: BONUS_CUP_DEFAULT,
-                        cup: 0,
-                        usd: 0
-                    })
-                    .select()
-                    .single();
-
-                if (insertError) {
-                    console.error('Error al crear usuario:', insertError);
-                    // Si hay error (ej. columna bonus_cup no existe), devolvemos objeto por defecto
-                    return {
-                        telegram_id: telegramId,
-                        first_name: firstName,
-                        username: username,
-                        bonus_cup: BONUS_CUP_DEFAULT,
-                        cup: 0,
-                        usd: 0
-                    };
-                }
-                user = newUser;
-                // El mensaje de bienvenida se envía solo en el bot, no aquí
-            } catch (insertException) {
-                console.error('Excepción al crear usuario:', insertException);
-                return {
-                    telegram_id: telegramId,
-                    first_name: firstName,
-                    username: username,
-                    bonus_cup: BONUS_CUP_DEFAULT,
-                    cup: 0,
-                    usd: 0
-                };
-            }
-        } else {
-            if (username && user.username !== username) {
-                await supabase
-                    .from('users')
-                    .update({ username })
-                    .eq('telegram_id', telegramId)
-                    .catch(e => console.error('Error actualizando username:', e));
-            }
-        }
-        return user;
+        // El mensaje de bienvenida se envía solo en el bot, no aquí
+        return data.user;
     } catch (e) {
         console.error('Error grave en getOrCreateUser:', e);
         return {
@@ -225,60 +179,49 @@ async function getOrCreateUser(telegramId, firstName = 'Jugador', username = nul
     }
 }
 
-async function getMinDepositUSD() {
-    const { data } = await supabase
-        .from('app_config')
-        .select('value')
-        .eq('key', 'min_deposit_usd')
-        .single();
-    return data ? parseFloat(data.value) : 1.0;
-}
-
-async function getMinWithdrawUSD() {
-    const { data } = await supabase
-        .from('app_config')
-        .select('value')
-        .eq('key', 'min_withdraw_usd')
-        .single();
-    return data ? parseFloat(data.value) : 1.0;
-}
+// Parsear monto con moneda (ej: "500 cup", "10,5 USDT"): una única pasada de
+// la regex, insensible a mayúsculas y con coma o punto decimal.
+const AMOUNT_WITH_CURRENCY_RE = /^\s*(\d+)(?:[.,](\d+))?\s*(cup|usd|usdt|trx|mlc)\s*$/i;
 
-async function setMinDepositUSD(value) {
-    await supabase
-        .from('app_config')
-        .upsert({ key: 'min_deposit_usd', value: value.toString() }, { onConflict: 'key' });
-}
-
-async function setMinWithdrawUSD(value) {
-    await supabase
-        .from('app_config')
-        .upsert({ key: 'min_withdraw_usd', value: value.toString() }, { onConflict: 'key' });
-}
-
-// Parsear monto con moneda (ej: "500 cup", "10 usdt")
 function parseAmountWithCurrency(text) {
-    const lower = text.toLowerCase().replace(',', '.').trim();
-    const match = lower.match(/^(\d+(?:\.\d+)?)\s*(cup|usd|usdt|trx|mlc)$/);
+    if (!text) return null;
+    const match = AMOUNT_WITH_CURRENCY_RE.exec(text);
     if (!match) return null;
     return {
-        amount: parseFloat(match[1]),
-        currency: match[2].toUpperCase()
+        amount: parseFloat(match[2] ? `${match[1]}.${match[2]}` : match[1]),
+        currency: match[3].toUpperCase()
     };
 }
 
 // ========== FUNCIONES DE PARSEO DE APUESTAS ==========
+// Expresiones del parser de apuestas: se compilan una sola vez al cargar el módulo
+const BET_LINE_RE = /^([\d\s,]+)\s*(?:con|\*)\s*([0-9.]+)\s*(cup|usd)?$/i;
+const BET_NUMBERS_SPLIT_RE = /[\s,]+/;
+const BET_NUMBER_RE = {
+    fijo: /^\d{2}$/,
+    corridos: /^\d{2}$/,
+    centena: /^\d{3}$/,
+    parle: /^\d{2}x\d{2}$/
+};
+const FIJO_DECENA_TERMINAL_RE = /^[dt]\d$/i;
+
 function parseBetLine(line, betType) {
     line = line.trim().toLowerCase();
     if (!line) return [];
+    // Descarte rápido antes de la regex: toda jugada lleva "con" o "*"
+    if (!line.includes('con') && !line.includes('*')) return [];
 
-    const match = line.match(/^([\d\s,]+)\s*(?:con|\*)\s*([0-9.]+)\s*(cup|usd)?$/i);
+    const numberRe = BET_NUMBER_RE[betType];
+    if (!numberRe) return [];
+
+    const match = line.match(BET_LINE_RE);
     if (!match) return [];
 
     let numerosStr = match[1].trim();
     const montoStr = match[2];
     const moneda = (match[3] || 'usd').toUpperCase();
 
-    const numeros = numerosStr.split(/[\s,]+/).filter(n => n.length > 0);
+    const numeros = numerosStr.split(BET_NUMBERS_SPLIT_RE).filter(n => n.length > 0);
     const montoBase = parseFloat(montoStr);
     if (isNaN(montoBase) || montoBase <= 0) return [];
 
@@ -288,24 +231,12 @@ function parseBetLine(line, betType) {
         let montoReal = montoBase;
         let numeroGuardado = numero;
 
-        if (betType === 'fijo') {
-            if (/^\d{2}$/.test(numero)) {
-                // normal
-            } else if (/^[Dd](\d)$/.test(numero)) {
-                montoReal = montoBase * 10;
-                numeroGuardado = numero.toUpperCase();
-            } else if (/^[Tt](\d)$/.test(numero)) {
-                montoReal = montoBase * 10;
-                numeroGuardado = numero.toUpperCase();
-            } else {
-                continue;
-            }
-        } else if (betType === 'corridos') {
-            if (!/^\d{2}$/.test(numero)) continue;
-        } else if (betType === 'centena') {
-            if (!/^\d{3}$/.test(numero)) continue;
-        } else if (betType === 'parle') {
-            if (!/^\d{2}x\d{2}$/.test(numero)) continue;
+        if (numberRe.test(numero)) {
+            // normal
+        } else if (betType === 'fijo' && FIJO_DECENA_TERMINAL_RE.test(numero)) {
+            // D/T (decena o terminal): cubre 10 números
+            montoReal = montoBase * 10;
+            numeroGuardado = numero.toUpperCase();
         } else {
             continue;
         }
@@ -407,9 +338,71 @@ async function requireAdmin(req, res, next) {
     next();
 }
 
+// ========== PROTECCIÓN CONTRA ENVÍOS DUPLICADOS ==========
+// La WebApp puede reenviar la misma solicitud (doble toque o reintento en redes
+// móviles inestables). Cada envío lleva una clave de idempotencia generada por
+// la WebApp (idempotencyKey); se recuerda por acción + usuario + clave durante
+// DUPLICATE_WINDOW_MS y se rechazan las repeticiones, evitando avisos dobles a
+// los admins, mientras que dos operaciones iguales pero distintas pasan. Si la
+// solicitud original falla, la clave se libera para reintentar.
+const DUPLICATE_WINDOW_MS = 60 * 1000;
+const DUPLICATE_MAX_KEYS = 1024;
+const recentSubmissions = new Map();
+
+function preventDuplicates(action) {
+    return (req, res, next) => {
+        const userId = req.body.userId || req.body.from;
+        const submissionKey = req.body.idempotencyKey;
+        // Sin clave (WebApp antigua en caché) no hay forma de distinguir un
+        // reintento de una operación nueva: se deja pasar.
+        if (!submissionKey) return next();
+        const key = `${action}:${userId}:${submissionKey}`;
+        const now = Date.now();
+        const seenAt = recentSubmissions.get(key);
+        if (seenAt && now - seenAt < DUPLICATE_WINDOW_MS) {
+            return res.status(409).json({ error: 'Solicitud duplicada: ya fue enviada, espera un momento' });
+        }
+        recentSubmissions.delete(key);
+        recentSubmissions.set(key, now);
+        while (recentSubmissions.size > DUPLICATE_MAX_KEYS) {
+            recentSubmissions.delete(recentSubmissions.keys().next().value);
+        }
+        res.on('finish', () => {
+            if (res.statusCode >= 400) recentSubmissions.delete(key);
+        });
+        next();
+    };
+}
+
+// El username del bot no cambia: se pide a Telegram una sola vez (Telegraf
+// lo deja en bot.botInfo al arrancar) y se reutiliza en cada /api/auth.
+const BOT_USERNAME_FALLBACK = '4pu3$t4$_QvaBot';
+let botUsernamePromise = null;
+
+function getBotUsername() {
+    if (bot.botInfo) return Promise.resolve(bot.botInfo.username);
+    if (!botUsernamePromise) {
+        botUsernamePromise = bot.telegram.getMe()
+            .then(info => info.username)
+            .catch(() => {
+                botUsernamePromise = null;
+                return BOT_USERNAME_FALLBACK;
+            });
+    }
+    return botUsernamePromise;
+}
+
 // ========== ENDPOINTS PÚBLICOS ==========
 
 // --- Autenticación ---
+async function countReferrals(userId) {
+    const { count } = await supabase
+        .from('users')
+        .select('telegram_id', { count: 'exact', head: true })
+        .eq('ref_by', userId);
+    return count || 0;
+}
+
 app.post('/api/auth', async (req, res) => {
     const { initData } = req.body;
     if (!initData) return res.status(400).json({ error: 'Falta initData' });
@@ -422,12 +415,16 @@ app.post('/api/auth', async (req, res) => {
     if (!userStr) return res.status(400).json({ error: 'No hay datos de usuario' });
 
     const tgUser = JSON.parse(userStr);
-    const user = await getOrCreateUser(tgUser.id, tgUser.first_name, tgUser.username);
-    const rates = await getExchangeRates();
-
-    const botInfo = await axios.get(`https://api.telegram.org/bot${BOT_TOKEN}/getMe`)
-        .then(r => r.data.result)
-        .catch(() => ({ username: '4pu3$t4$_QvaBot' }));
+    // El conteo de referidos y los precios viajan en esta misma respuesta: la
+    // WebApp no necesita otras peticiones al arrancar. Las lecturas son
+    // independientes entre sí.
+    const [user, rates, botUsername, referralCount, playPrices] = await Promise.all([
+        getOrCreateUser(tgUser.id, tgUser.first_name, tgUser.username),
+        getExchangeRates(),
+        getBotUsername(),
+        countReferrals(tgUser.id),
+        getPlayPrices()
+    ]);
 
     res.json({
         user,
@@ -435,35 +432,45 @@ app.post('/api/auth', async (req, res) => {
         exchangeRate: rates.rate,
         exchangeRateUSDT: rates.rate_usdt,
         exchangeRateTRX: rates.rate_trx,
-        botUsername: botInfo.username,
-        bonusCupDefault: BONUS_CUP_DEFAULT
+        botUsername,
+        bonusCupDefault: BONUS_CUP_DEFAULT,
+        referralCount,
+        playPrices
     });
 });
 
+// --- Métodos de depósito y retiro en una sola respuesta (arranque de la WebApp) ---
+app.get('/api/payment-methods', async (req, res) => {
+    const [deposit, withdraw] = await Promise.all([
+        getMethods('deposit_methods'),
+        getMethods('withdraw_methods')
+    ]);
+    res.json({ deposit: deposit || [], withdraw: withdraw || [] });
+});
+
 // --- Métodos de depósito ---
 app.get('/api/deposit-methods', async (req, res) => {
-    const { data } = await supabase.from('deposit_methods').select('*').order('id');
+    const data = await getMethods('deposit_methods');
     res.json(data || []);
 });
 app.get('/api/deposit-methods/:id', async (req, res) => {
-    const { data } = await supabase.from('deposit_methods').select('*').eq('id', req.params.id).single();
+    const data = await getMethod('deposit_methods', req.params.id);
     res.json(data);
 });
 
 // --- Métodos de retiro ---
 app.get('/api/withdraw-methods', async (req, res) => {
-    const { data } = await supabase.from('withdraw_methods').select('*').order('id');
+    const data = await getMethods('withdraw_methods');
     res.json(data || []);
 });
 app.get('/api/withdraw-methods/:id', async (req, res) => {
-    const { data } = await supabase.from('withdraw_methods').select('*').eq('id', req.params.id).single();
+    const data = await getMethod('withdraw_methods', req.params.id);
     res.json(data);
 });
 
 // --- Precios de jugadas ---
 app.get('/api/play-prices', async (req, res) => {
-    const { data } = await supabase.from('play_prices').select('*');
-    res.json(data || []);
+    res.json(await getPlayPrices());
 });
 
 // --- Tasas de cambio ---
@@ -488,7 +495,7 @@ app.get('/api/config/min-withdraw', async (req, res) => {
 app.get('/api/winning-numbers', async (req, res) => {
     const { data } = await supabase
         .from('winning_numbers')
-        .select('*')
+        .select('id, lottery, date, time_slot, numbers, published_at')
         .order('published_at', { ascending: false })
         .limit(10);
     const formatted = (data || []).map(w => ({
@@ -506,7 +513,7 @@ app.get('/api/lottery-sessions/active', async (req, res) => {
     }
     const { data } = await supabase
         .from('lottery_sessions')
-        .select('*')
+        .select(SESSION_COLUMNS)
         .eq('lottery', lottery)
         .eq('date', date)
         .eq('time_slot', time_slot)
@@ -517,17 +524,18 @@ app.get('/api/lottery-sessions/active', async (req, res) => {
 
 // --- Obtener sesión por ID ---
 app.get('/api/lottery-sessions/:id', async (req, res) => {
-    const { id } = req.params;
+    const id = parseInt(req.params.id);
+    if (!(id > 0)) return res.json(null);
     const { data } = await supabase
         .from('lottery_sessions')
-        .select('*')
+        .select(SESSION_COLUMNS)
         .eq('id', id)
         .single();
     res.json(data);
 });
 
 // --- Solicitud de depósito ---
-app.post('/api/deposit-requests', upload.single('screenshot'), async (req, res) => {
+app.post('/api/deposit-requests', upload.single('screenshot'), preventDuplicates('deposit'), async (req, res) => {
     const { methodId, userId, amount, currency } = req.body;
     const file = req.file;
     if (!methodId || !userId || !file || !amount || !currency) {
@@ -535,11 +543,7 @@ app.post('/api/deposit-requests', upload.single('screenshot'), async (req, res)
     }
 
     const user = await getOrCreateUser(parseInt(userId));
-    const { data: method } = await supabase
-        .from('deposit_methods')
-        .select('*')
-        .eq('id', methodId)
-        .single();
+    const method = await getMethod('deposit_methods', methodId);
 
     if (!method) {
         return res.status(400).json({ error: 'Método no encontrado' });
@@ -586,47 +590,31 @@ app.post('/api/deposit-requests', upload.single('screenshot'), async (req, res)
             currency,
             status: 'pending'
         })
-        .select()
+        .select('id')
         .single();
 
     if (insertError) {
         return res.status(500).json({ error: 'Error al guardar solicitud' });
     }
 
-    for (const adminId of ADMIN_IDS) {
-        try {
-            await axios.post(`https://api.telegram.org/bot${BOT_TOKEN}/sendMessage`, {
-                chat_id: adminId,
-                text: `📥 <b>Nueva solicitud de DEPÓSITO</b> (WebApp)\n👤 Usuario: ${user.first_name} (${userId})\n🏦 Método: ${method.name} (${currency})\n💰 Monto: ${amount}\n📎 <a href="${publicUrl}">Ver captura</a>\n🆔 Solicitud: ${request.id}`,
-                parse_mode: 'HTML',
-                reply_markup: {
-                    inline_keyboard: [[
-                        { text: '✅ Aprobar', callback_data: `approve_deposit_${request.id}` },
-                        { text: '❌ Rechazar', callback_data: `reject_deposit_${request.id}` }
-                    ]]
-                }
-            });
-        } catch (e) {
-            console.error('Error enviando notificación de depósito:', e);
-        }
-    }
+    await notifyAdmins(
+        `📥 <b>Nueva solicitud de DEPÓSITO</b> (WebApp)\n👤 Usuario: ${escapeHTML(user.first_name)} (${userId})\n🏦 Método: ${escapeHTML(method.name)} (${currency})\n💰 Monto: ${escapeHTML(amount)}\n📎 <a href="${publicUrl}">Ver captura</a>\n🆔 Solicitud: ${request.id}`,
+        { reply_markup: approveRejectMarkup('deposit', request.id) },
+        'depósito a admin'
+    );
 
     res.json({ success: true, requestId: request.id });
 });
 
 // --- Solicitud de retiro ---
-app.post('/api/withdraw-requests', async (req, res) => {
+app.post('/api/withdraw-requests', preventDuplicates('withdraw'), async (req, res) => {
     const { methodId, amount, currency, userId, accountInfo } = req.body;
     if (!methodId || !amount || !currency || !userId || !accountInfo) {
         return res.status(400).json({ error: 'Faltan datos' });
     }
 
     const user = await getOrCreateUser(parseInt(userId));
-    const { data: method } = await supabase
-        .from('withdraw_methods')
-        .select('*')
-        .eq('id', methodId)
-        .single();
+    const method = await getMethod('withdraw_methods', methodId);
 
     if (!method) {
         return res.status(400).json({ error: 'Método no encontrado' });
@@ -672,34 +660,24 @@ app.post('/api/withdraw-requests', async (req, res) => {
             account_info: accountInfo,
             status: 'pending'
         })
-        .select()
+        .select('id')
         .single();
 
     if (insertError) {
         return res.status(500).json({ error: 'Error al crear solicitud' });
     }
 
-    for (const adminId of ADMIN_IDS) {
-        try {
-            await axios.post(`https://api.telegram.org/bot${BOT_TOKEN}/sendMessage`, {
-                chat_id: adminId,
-                text: `📤 <b>Nueva solicitud de RETIRO</b> (WebApp)\n👤 Usuario: ${user.first_name} (${userId})\n💰 Monto: ${amount} ${currency}\n🏦 Método: ${method.name} (${currency})\n📞 Cuenta: ${accountInfo}\n🆔 Solicitud: ${request.id}`,
-                parse_mode: 'HTML',
-                reply_markup: {
-                    inline_keyboard: [[
-                        { text: '✅ Aprobar', callback_data: `approve_withdraw_${request.id}` },
-                        { text: '❌ Rechazar', callback_data: `reject_withdraw_${request.id}` }
-                    ]]
-                }
-            });
-        } catch (e) {}
-    }
+    await notifyAdmins(
+        `📤 <b>Nueva solicitud de RETIRO</b> (WebApp)\n👤 Usuario: ${escapeHTML(user.first_name)} (${userId})\n💰 Monto: ${escapeHTML(amount)} ${escapeHTML(currency)}\n🏦 Método: ${escapeHTML(method.name)} (${escapeHTML(currency)})\n📞 Cuenta: ${escapeHTML(accountInfo)}\n🆔 Solicitud: ${request.id}`,
+        { reply_markup: approveRejectMarkup('withdraw', request.id) },
+        'retiro a admin'
+    );
 
     res.json({ success: true, requestId: request.id });
 });
 
 // --- Transferencia entre usuarios ---
-app.post('/api/transfer', async (req, res) => {
+app.post('/api/transfer', preventDuplicates('transfer'), async (req, res) => {
     const { from, to, amount, currency } = req.body;
     if (!from || !to || !amount || !currency || amount <= 0) {
         return res.status(400).json({ error: 'Datos inválidos' });
@@ -711,66 +689,40 @@ app.post('/api/transfer', async (req, res) => {
         return res.status(400).json({ error: 'No puedes transferirte a ti mismo' });
     }
 
-    const userFrom = await getOrCreateUser(parseInt(from));
-    if (!userFrom) return res.status(404).json({ error: 'Usuario origen no encontrado' });
-
-    // Buscar usuario destino
+    // Buscar usuario destino (el saldo y la existencia del origen los valida la RPC)
     let targetUserId = null;
-    let targetUser = null;
     if (!isNaN(to) && typeof to === 'number' || !isNaN(parseInt(to))) {
         targetUserId = parseInt(to);
-        const { data } = await supabase
-            .from('users')
-            .select('*')
-            .eq('telegram_id', targetUserId)
-            .single();
-        targetUser = data;
     } else {
         let username = to.replace(/^@/, '');
         const { data } = await supabase
             .from('users')
-            .select('*')
+            .select('telegram_id')
             .eq('username', username)
             .maybeSingle();
-        if (data) {
-            targetUser = data;
-            targetUserId = data.telegram_id;
-        }
+        if (data) targetUserId = data.telegram_id;
     }
-    if (!targetUser) {
+    if (!targetUserId) {
         return res.status(404).json({ error: 'Usuario destino no encontrado' });
     }
 
-    // Verificar saldo origen
-    if (currency === 'CUP') {
-        if (parseFloat(userFrom.cup) < amount) {
-            return res.status(400).json({ error: 'Saldo CUP insuficiente' });
-        }
-    } else {
-        if (parseFloat(userFrom.usd) < amount) {
-            return res.status(400).json({ error: 'Saldo USD insuficiente' });
-        }
+    // Verificación de saldo, débito y crédito en una sola transacción
+    let result;
+    try {
+        result = await transferBalance(parseInt(from), targetUserId, currency, amount);
+    } catch (transferError) {
+        console.error('Error en transferencia:', transferError);
+        return res.status(500).json({ error: 'No se pudo completar la transferencia' });
     }
 
-    // Realizar transferencia
-    if (currency === 'CUP') {
-        await supabase
-            .from('users')
-            .update({ cup: parseFloat(userFrom.cup) - amount, updated_at: new Date() })
-            .eq('telegram_id', from);
-        await supabase
-            .from('users')
-            .update({ cup: parseFloat(targetUser.cup) + amount, updated_at: new Date() })
-            .eq('telegram_id', targetUserId);
-    } else {
-        await supabase
-            .from('users')
-            .update({ usd: parseFloat(userFrom.usd) - amount, updated_at: new Date() })
-            .eq('telegram_id', from);
-        await supabase
-            .from('users')
-            .update({ usd: parseFloat(targetUser.usd) + amount, updated_at: new Date() })
-            .eq('telegram_id', targetUserId);
+    if (!result.ok) {
+        const errors = {
+            source_not_found: [404, 'Usuario origen no encontrado'],
+            target_not_found: [404, 'Usuario destino no encontrado'],
+            insufficient_funds: [400, `Saldo ${currency} insuficiente`]
+        };
+        const [status, message] = errors[result.reason] || [400, 'Datos inválidos'];
+        return res.status(status).json({ error: message });
     }
 
     res.json({ success: true });
@@ -783,19 +735,6 @@ app.post('/api/bets', async (req, res) => {
         return res.status(400).json({ error: 'Faltan datos' });
     }
 
-    if (sessionId) {
-        const { data: activeSession } = await supabase
-            .from('lottery_sessions')
-            .select('*')
-            .eq('id', sessionId)
-            .eq('status', 'open')
-            .maybeSingle();
-        if (!activeSession) {
-            return res.status(400).json({ error: 'La sesión de juego no está activa' });
-        }
-    }
-
-    const user = await getOrCreateUser(parseInt(userId));
     const parsed = parseBetMessage(rawText, betType);
     if (!parsed.ok) {
         return res.status(400).json({ error: 'No se pudo interpretar la apuesta' });
@@ -807,11 +746,7 @@ app.post('/api/bets', async (req, res) => {
         return res.status(400).json({ error: 'Debes especificar un monto válido' });
     }
 
-    const { data: priceData } = await supabase
-        .from('play_prices')
-        .select('min_cup, min_usd, max_cup, max_usd')
-        .eq('bet_type', betType)
-        .single();
+    const priceData = await getPlayPrice(betType);
 
     const minCup = priceData?.min_cup || 0;
     const minUsd = priceData?.min_usd || 0;
@@ -836,59 +771,36 @@ app.post('/api/bets', async (req, res) => {
         }
     }
 
-    let newUsd = parseFloat(user.usd) || 0;
-    let newBonus = parseFloat(user.bonus_cup) || 0;
-    let newCup = parseFloat(user.cup) || 0;
-
-    if (totalUSD > 0) {
-        const totalDisponible = newUsd + newBonus / (await getExchangeRateUSD());
-        if (totalDisponible < totalUSD) {
-            return res.status(400).json({ error: 'Saldo USD insuficiente' });
-        }
-        const bonoEnUSD = newBonus / (await getExchangeRateUSD());
-        const usarBonoUSD = Math.min(bonoEnUSD, totalUSD);
-        newBonus -= usarBonoUSD * (await getExchangeRateUSD());
-        newUsd -= (totalUSD - usarBonoUSD);
-    }
-
-    if (totalCUP > 0) {
-        if (newCup < totalCUP) {
-            return res.status(400).json({ error: 'Saldo CUP insuficiente' });
-        }
-        newCup -= totalCUP;
-    }
-
-    await supabase
-        .from('users')
-        .update({
-            usd: newUsd,
-            bonus_cup: newBonus,
-            cup: newCup,
-            updated_at: new Date()
-        })
-        .eq('telegram_id', userId);
-
-    const { data: bet, error: betError } = await supabase
-        .from('bets')
-        .insert({
-            user_id: parseInt(userId),
+    // Sesión abierta, saldo, descuento e inserción en una sola transacción
+    let result;
+    try {
+        result = await placeBet({
+            userId: parseInt(userId),
             lottery,
-            session_id: sessionId || null,
-            bet_type: betType,
-            raw_text: rawText,
+            sessionId,
+            betType,
+            rawText,
             items: parsed.items,
-            placed_at: new Date()
-        })
-        .select()
-        .single();
-
-    if (betError) {
+            costUSD: totalUSD,
+            costCUP: totalCUP
+        });
+    } catch (betError) {
         console.error('Error insertando apuesta:', betError);
         return res.status(500).json({ error: 'Error al registrar la apuesta' });
     }
 
-    const updatedUser = await getOrCreateUser(parseInt(userId));
-    res.json({ success: true, bet, updatedUser });
+    if (!result.ok) {
+        const errors = {
+            user_not_found: [404, 'Usuario no encontrado'],
+            session_closed: [400, 'La sesión de juego no está activa'],
+            insufficient_usd: [400, 'Saldo USD insuficiente'],
+            insufficient_cup: [400, 'Saldo CUP insuficiente']
+        };
+        const [status, message] = errors[result.reason] || [500, 'Error al registrar la apuesta'];
+        return res.status(status).json({ error: message });
+    }
+
+    res.json({ success: true, bet: result.bet, updatedUser: result.user });
 });
 
 // --- Cancelar jugada ---
@@ -897,60 +809,36 @@ app.post('/api/bets/:id/cancel', async (req, res) => {
     const { userId } = req.body;
     if (!userId) return res.status(400).json({ error: 'Falta userId' });
 
-    const { data: bet } = await supabase
-        .from('bets')
-        .select('*')
-        .eq('id', id)
-        .eq('user_id', userId)
-        .single();
-
-    if (!bet) return res.status(404).json({ error: 'Jugada no encontrada' });
-
-    if (bet.session_id) {
-        const { data: session } = await supabase
-            .from('lottery_sessions')
-            .select('status')
-            .eq('id', bet.session_id)
-            .single();
-        if (!session || session.status !== 'open') {
-            return res.status(400).json({ error: 'No se puede cancelar: sesión cerrada' });
-        }
+    // Bloqueo, verificación de sesión, borrado y reembolso en una transacción
+    // (cancel_bet en supabase/functions.sql): cancelar dos veces no reembolsa dos veces
+    const { data: result, error } = await supabase.rpc('cancel_bet', {
+        p_bet_id: parseInt(id),
+        p_telegram_id: parseInt(userId)
+    });
+    if (error) {
+        console.error('Error en cancel_bet:', error.message);
+        return res.status(500).json({ error: 'No se pudo cancelar la jugada' });
     }
-
-    const user = await getOrCreateUser(parseInt(userId));
-    let newCup = parseFloat(user.cup) || 0;
-    let newUsd = parseFloat(user.usd) || 0;
-    let newBonus = parseFloat(user.bonus_cup) || 0;
-
-    for (const item of bet.items) {
-        if (item.currency === 'CUP') {
-            newCup += item.amount;
-        } else if (item.currency === 'USD') {
-            newUsd += item.amount;
+    if (!result.ok) {
+        if (result.reason === 'session_closed') {
+            return res.status(400).json({ error: 'No se puede cancelar: sesión cerrada' });
         }
+        return res.status(404).json({ error: 'Jugada no encontrada' });
     }
 
-    await supabase
-        .from('users')
-        .update({ usd: newUsd, cup: newCup, bonus_cup: newBonus, updated_at: new Date() })
-        .eq('telegram_id', userId);
-
-    await supabase
-        .from('bets')
-        .delete()
-        .eq('id', id);
-
-    const updatedUser = await getOrCreateUser(parseInt(userId));
-    res.json({ success: true, updatedUser });
+    res.json({ success: true, updatedUser: result.user });
 });
 
 // --- Historial de apuestas ---
 app.get('/api/user/:userId/bets', async (req, res) => {
-    const { userId } = req.params;
+    const userId = parseInt(req.params.userId);
+    // Sin id válido (WebApp abierta fuera de Telegram, vistas previas) no hay
+    // nada que buscar: se responde vacío sin ir a Supabase.
+    if (!(userId > 0)) return res.json([]);
     const limit = parseInt(req.query.limit) || 20;
     const { data } = await supabase
         .from('bets')
-        .select('*')
+        .select('id, lottery, session_id, bet_type, raw_text, items, cost_cup, cost_usd, placed_at')
         .eq('user_id', userId)
         .order('placed_at', { ascending: false })
         .limit(limit);
@@ -959,43 +847,75 @@ app.get('/api/user/:userId/bets', async (req, res) => {
 
 // --- Cantidad de referidos ---
 app.get('/api/user/:userId/referrals/count', async (req, res) => {
-    const { userId } = req.params;
-    const { count } = await supabase
-        .from('users')
-        .select('*', { count: 'exact', head: true })
-        .eq('ref_by', userId);
-    res.json({ count: count || 0 });
+    const userId = parseInt(req.params.userId);
+    if (!(userId > 0)) return res.json({ count: 0 });
+    res.json({ count: await countReferrals(userId) });
 });
 
 // ========== ENDPOINTS DE ADMIN ==========
 
-// --- Añadir método de depósito ---
-app.post('/api/admin/deposit-methods', requireAdmin, async (req, res) => {
-    const { name, card, confirm, currency, min_amount, max_amount } = req.body;
-    if (!name || !card || !confirm || !currency) {
-        return res.status(400).json({ error: 'Faltan campos obligatorios' });
+// Valida un método de depósito/retiro recibido en el cuerpo y lo devuelve
+// como fila lista para insertar: { row } o { error }.
+function buildMethodRow(table, { name, card, confirm, currency, min_amount, max_amount } = {}) {
+    if (table === 'deposit_methods') {
+        if (!name || !card || !confirm || !currency) return { error: 'Faltan campos obligatorios' };
+    } else if (!name || !card || !currency) {
+        return { error: 'Nombre, instrucción y moneda obligatorios' };
     }
     const validCurrencies = ['CUP', 'USD', 'USDT', 'TRX', 'MLC'];
-    if (!validCurrencies.includes(currency)) {
-        return res.status(400).json({ error: 'Moneda no válida' });
-    }
-    const insertData = {
-        name,
-        card,
-        confirm,
-        currency,
-        min_amount: min_amount !== undefined ? (min_amount === 0 ? null : min_amount) : null,
-        max_amount: max_amount !== undefined ? (max_amount === 0 ? null : max_amount) : null
+    if (!validCurrencies.includes(currency)) return { error: 'Moneda no válida' };
+    return {
+        row: {
+            name,
+            card,
+            confirm: confirm || 'ninguno',
+            currency,
+            min_amount: min_amount !== undefined ? (min_amount === 0 ? null : min_amount) : null,
+            max_amount: max_amount !== undefined ? (max_amount === 0 ? null : max_amount) : null
+        }
     };
+}
+
+// Inserta uno o varios métodos con un solo INSERT (PostgREST acepta un array
+// en el cuerpo) e invalida la caché de la tabla una sola vez.
+async function insertMethods(table, rows) {
     const { data, error } = await supabase
-        .from('deposit_methods')
-        .insert(insertData)
-        .select()
-        .single();
+        .from(table)
+        .insert(rows)
+        .select();
+    invalidateCache(table);
+    return { data, error };
+}
+
+// --- Añadir método de depósito ---
+app.post('/api/admin/deposit-methods', requireAdmin, async (req, res) => {
+    const { row, error: invalid } = buildMethodRow('deposit_methods', req.body);
+    if (invalid) return res.status(400).json({ error: invalid });
+    const { data, error } = await insertMethods('deposit_methods', [row]);
     if (error) return res.status(500).json({ error: error.message });
-    res.json(data);
+    res.json(data[0]);
 });
 
+// --- Importar varios métodos de una vez ({ methods: [...] }) ---
+// Se validan todos antes de insertar: si alguno falla no se guarda ninguno.
+for (const table of ['deposit_methods', 'withdraw_methods']) {
+    app.post(`/api/admin/${table.replace('_', '-')}/bulk`, requireAdmin, async (req, res) => {
+        const methods = req.body && req.body.methods;
+        if (!Array.isArray(methods) || methods.length === 0) {
+            return res.status(400).json({ error: 'Falta la lista de métodos' });
+        }
+        const rows = [];
+        for (let i = 0; i < methods.length; i++) {
+            const { row, error: invalid } = buildMethodRow(table, methods[i]);
+            if (invalid) return res.status(400).json({ error: `Método ${i + 1}: ${invalid}` });
+            rows.push(row);
+        }
+        const { data, error } = await insertMethods(table, rows);
+        if (error) return res.status(500).json({ error: error.message });
+        res.json(data);
+    });
+}
+
 // --- Editar método de depósito ---
 app.put('/api/admin/deposit-methods/:id', requireAdmin, async (req, res) => {
     const { id } = req.params;
@@ -1019,6 +939,7 @@ app.put('/api/admin/deposit-methods/:id', requireAdmin, async (req, res) => {
         .eq('id', id)
         .select()
         .single();
+    invalidateCache('deposit_methods');
     if (error) return res.status(500).json({ error: error.message });
     res.json(data);
 });
@@ -1030,35 +951,18 @@ app.delete('/api/admin/deposit-methods/:id', requireAdmin, async (req, res) => {
         .from('deposit_methods')
         .delete()
         .eq('id', id);
+    invalidateCache('deposit_methods');
     if (error) return res.status(500).json({ error: error.message });
     res.json({ success: true });
 });
 
 // --- Añadir método de retiro ---
 app.post('/api/admin/withdraw-methods', requireAdmin, async (req, res) => {
-    const { name, card, confirm, currency, min_amount, max_amount } = req.body;
-    if (!name || !card || !currency) {
-        return res.status(400).json({ error: 'Nombre, instrucción y moneda obligatorios' });
-    }
-    const validCurrencies = ['CUP', 'USD', 'USDT', 'TRX', 'MLC'];
-    if (!validCurrencies.includes(currency)) {
-        return res.status(400).json({ error: 'Moneda no válida' });
-    }
-    const insertData = {
-        name,
-        card,
-        confirm: confirm || 'ninguno',
-        currency,
-        min_amount: min_amount !== undefined ? (min_amount === 0 ? null : min_amount) : null,
-        max_amount: max_amount !== undefined ? (max_amount === 0 ? null : max_amount) : null
-    };
-    const { data, error } = await supabase
-        .from('withdraw_methods')
-        .insert(insertData)
-        .select()
-        .single();
+    const { row, error: invalid } = buildMethodRow('withdraw_methods', req.body);
+    if (invalid) return res.status(400).json({ error: invalid });
+    const { data, error } = await insertMethods('withdraw_methods', [row]);
     if (error) return res.status(500).json({ error: error.message });
-    res.json(data);
+    res.json(data[0]);
 });
 
 // --- Editar método de retiro ---
@@ -1084,6 +988,7 @@ app.put('/api/admin/withdraw-methods/:id', requireAdmin, async (req, res) => {
         .eq('id', id)
         .select()
         .single();
+    invalidateCache('withdraw_methods');
     if (error) return res.status(500).json({ error: error.message });
     res.json(data);
 });
@@ -1095,6 +1000,7 @@ app.delete('/api/admin/withdraw-methods/:id', requireAdmin, async (req, res) =>
         .from('withdraw_methods')
         .delete()
         .eq('id', id);
+    invalidateCache('withdraw_methods');
     if (error) return res.status(500).json({ error: error.message });
     res.json({ success: true });
 });
@@ -1103,21 +1009,24 @@ app.delete('/api/admin/withdraw-methods/:id', requireAdmin, async (req, res) =>
 app.put('/api/admin/exchange-rate/usd', requireAdmin, async (req, res) => {
     const { rate } = req.body;
     if (!rate || rate <= 0) return res.status(400).json({ error: 'Tasa inválida' });
-    await setExchangeRateUSD(rate);
+    const error = await setExchangeRateUSD(rate);
+    if (error) return res.status(500).json({ error: error.message });
     res.json({ success: true });
 });
 
 app.put('/api/admin/exchange-rate/usdt', requireAdmin, async (req, res) => {
     const { rate } = req.body;
     if (!rate || rate <= 0) return res.status(400).json({ error: 'Tasa inválida' });
-    await setExchangeRateUSDT(rate);
+    const error = await setExchangeRateUSDT(rate);
+    if (error) return res.status(500).json({ error: error.message });
     res.json({ success: true });
 });
 
 app.put('/api/admin/exchange-rate/trx', requireAdmin, async (req, res) => {
     const { rate } = req.body;
     if (!rate || rate <= 0) return res.status(400).json({ error: 'Tasa inválida' });
-    await setExchangeRateTRX(rate);
+    const error = await setExchangeRateTRX(rate);
+    if (error) return res.status(500).json({ error: error.message });
     res.json({ success: true });
 });
 
@@ -1137,6 +1046,7 @@ app.put('/api/admin/play-prices/:betType', requireAdmin, async (req, res) => {
         .update(updateData)
         .eq('bet_type', betType);
     if (error) return res.status(500).json({ error: error.message });
+    invalidateCache('play_prices');
     res.json({ success: true });
 });
 
@@ -1144,7 +1054,8 @@ app.put('/api/admin/play-prices/:betType', requireAdmin, async (req, res) => {
 app.post('/api/admin/min-deposit', requireAdmin, async (req, res) => {
     const { value } = req.body;
     if (!value || value <= 0) return res.status(400).json({ error: 'Valor inválido' });
-    await setMinDepositUSD(value);
+    const error = await setMinDepositUSD(value);
+    if (error) return res.status(500).json({ error: error.message });
     res.json({ success: true });
 });
 
@@ -1152,7 +1063,8 @@ app.post('/api/admin/min-deposit', requireAdmin, async (req, res) => {
 app.post('/api/admin/min-withdraw', requireAdmin, async (req, res) => {
     const { value } = req.body;
     if (!value || value <= 0) return res.status(400).json({ error: 'Valor inválido' });
-    await setMinWithdrawUSD(value);
+    const error = await setMinWithdrawUSD(value);
+    if (error) return res.status(500).json({ error: error.message });
     res.json({ success: true });
 });
 
@@ -1162,7 +1074,7 @@ app.get('/api/admin/lottery-sessions', requireAdmin, async (req, res) => {
     if (!date) return res.status(400).json({ error: 'Falta fecha' });
     const { data } = await supabase
         .from('lottery_sessions')
-        .select('*')
+        .select(SESSION_COLUMNS)
         .eq('date', date);
     res.json(data || []);
 });
@@ -1249,7 +1161,7 @@ app.post('/api/admin/lottery-sessions/toggle', requireAdmin, async (req, res) =>
 app.get('/api/admin/lottery-sessions/closed', requireAdmin, async (req, res) => {
     const { data } = await supabase
         .from('lottery_sessions')
-        .select('*')
+        .select(SESSION_COLUMNS)
         .eq('status', 'closed')
         .order('date', { ascending: false });
     res.json(data || []);
@@ -1261,7 +1173,7 @@ app.get('/api/admin/winning-numbers/:sessionId/winners', requireAdmin, async (re
 
     const { data: session } = await supabase
         .from('lottery_sessions')
-        .select('*')
+        .select('lottery, date, time_slot')
         .eq('id', sessionId)
         .single();
 
@@ -1294,15 +1206,13 @@ app.get('/api/admin/winning-numbers/:sessionId/winners', requireAdmin, async (re
         `${corridos[1]}x${corridos[2]}`
     ];
 
-    const { data: multipliers } = await supabase
-        .from('play_prices')
-        .select('bet_type, payout_multiplier');
+    const multipliers = await getPlayPrices();
     const multiplierMap = {};
     multipliers.forEach(m => { multiplierMap[m.bet_type] = parseFloat(m.payout_multiplier) || 0; });
 
     const { data: bets } = await supabase
         .from('bets')
-        .select('*')
+        .select('user_id, bet_type, raw_text, items')
         .eq('session_id', sessionId);
 
     const winners = [];
@@ -1378,7 +1288,7 @@ app.post('/api/admin/winning-numbers', requireAdmin, async (req, res) => {
 
     const { data: session } = await supabase
         .from('lottery_sessions')
-        .select('*')
+        .select('lottery, date, time_slot')
         .eq('id', sessionId)
         .single();
 
@@ -1422,18 +1332,19 @@ app.post('/api/admin/winning-numbers', requireAdmin, async (req, res) => {
 
     if (insertError) return res.status(500).json({ error: insertError.message });
 
-    const { data: multipliers } = await supabase
-        .from('play_prices')
-        .select('bet_type, payout_multiplier');
+    const multipliers = await getPlayPrices();
     const multiplierMap = {};
     multipliers.forEach(m => { multiplierMap[m.bet_type] = parseFloat(m.payout_multiplier) || 0; });
 
     const { data: bets } = await supabase
         .from('bets')
-        .select('*')
+        .select('id, user_id, bet_type, items')
         .eq('session_id', sessionId);
 
-    const rates = await getExchangeRates();
+    // Premios que no se pudieron acreditar: se sigue con el resto de jugadas y
+    // al final se responde con la lista (winning_numbers ya quedó guardado y
+    // no se puede volver a publicar).
+    const unpaidBets = [];
 
     for (const bet of bets || []) {
         let premioTotalUSD = 0;
@@ -1475,19 +1386,16 @@ app.post('/api/admin/winning-numbers', requireAdmin, async (req, res) => {
         }
 
         if (premioTotalUSD > 0 || premioTotalCUP > 0) {
-            const { data: user } = await supabase
-                .from('users')
-                .select('usd, cup')
-                .eq('telegram_id', bet.user_id)
-                .single();
-
-            let newUsd = parseFloat(user.usd) + premioTotalUSD;
-            let newCup = parseFloat(user.cup) + premioTotalCUP;
-
-            await supabase
-                .from('users')
-                .update({ usd: newUsd, cup: newCup, updated_at: new Date() })
-                .eq('telegram_id', bet.user_id);
+            let credited = null;
+            try {
+                credited = await adjustBalance(bet.user_id, { usd: premioTotalUSD, cup: premioTotalCUP });
+            } catch (e) {
+                console.error(`Error acreditando el premio de la jugada ${bet.id}:`, e.message);
+            }
+            if (!credited) {
+                unpaidBets.push(bet.id);
+                continue;
+            }
 
             const formatted = cleanNumber.replace(/(\d{3})(\d{4})/, '$1 $2');
             try {
@@ -1499,7 +1407,9 @@ app.post('/api/admin/winning-numbers', requireAdmin, async (req, res) => {
                     `✅ El premio ya fue acreditado a tu saldo.`,
                     { parse_mode: 'HTML' }
                 );
-            } catch (e) {}
+            } catch (e) {
+                logNotifyError('premio a usuario', e);
+            }
         } else {
             const formatted = cleanNumber.replace(/(\d{3})(\d{4})/, '$1 $2');
             try {
@@ -1509,7 +1419,9 @@ app.post('/api/admin/winning-numbers', requireAdmin, async (req, res) => {
                     `😔 No has ganado esta vez. ¡Sigue intentando!`,
                     { parse_mode: 'HTML' }
                 );
-            } catch (e) {}
+            } catch (e) {
+                logNotifyError('resultado a usuario', e);
+            }
         }
     }
 
@@ -1522,6 +1434,20 @@ app.post('/api/admin/winning-numbers', requireAdmin, async (req, res) => {
         `💬 Revisa tu historial para ver si has ganado. ¡Suerte en la próxima!`
     );
 
+    if (unpaidBets.length > 0) {
+        await notifyAdmins(
+            `⚠️ <b>Premios sin acreditar</b>\n` +
+            `🎰 ${escapeHTML(session.lottery)} - ${escapeHTML(session.time_slot)} (${session.date})\n` +
+            `Jugadas (id): <code>${unpaidBets.join(', ')}</code>`,
+            undefined,
+            'premios sin acreditar'
+        );
+        return res.status(500).json({
+            error: 'Números publicados, pero algunos premios no se pudieron acreditar',
+            unpaidBets
+        });
+    }
+
     res.json({ success: true, message: 'Números publicados y premios calculados' });
 });
 
@@ -1572,7 +1498,7 @@ app.post('/api/admin/pending-deposits/:id/approve', requireAdmin, async (req, re
     // Obtener la solicitud
     const { data: request, error: fetchError } = await supabase
         .from('deposit_requests')
-        .select('*')
+        .select('user_id, amount, currency')
         .eq('id', id)
         .eq('status', 'pending')
         .single();
@@ -1582,48 +1508,37 @@ app.post('/api/admin/pending-deposits/:id/approve', requireAdmin, async (req, re
     }
 
     // Actualizar saldo del usuario
-    const user = await getOrCreateUser(request.user_id);
-    let newCup = parseFloat(user.cup) || 0;
-    let newUsd = parseFloat(user.usd) || 0;
-    let newBonus = parseFloat(user.bonus_cup) || 0;
-
     // Convertir el monto a CUP si es necesario (los depósitos siempre incrementan CUP o USD según la moneda)
+    const credit = {};
     if (request.currency === 'CUP') {
-        newCup += parseFloat(request.amount);
+        credit.cup = parseFloat(request.amount);
     } else if (request.currency === 'USD') {
-        newUsd += parseFloat(request.amount);
+        credit.usd = parseFloat(request.amount);
     } else {
         // Para otras monedas, convertir a CUP usando la tasa actual
-        const cupAmount = await convertToCUP(parseFloat(request.amount), request.currency);
-        newCup += cupAmount;
-    }
-
-    await supabase
-        .from('users')
-        .update({ cup: newCup, usd: newUsd, updated_at: new Date() })
-        .eq('telegram_id', request.user_id);
-
-    // Marcar solicitud como aprobada
-    const { error: updateError } = await supabase
-        .from('deposit_requests')
-        .update({ status: 'approved', processed_at: new Date(), processed_by: parseInt(userId) })
-        .eq('id', id);
-
-    if (updateError) {
-        return res.status(500).json({ error: updateError.message });
+        credit.cup = await convertToCUP(parseFloat(request.amount), request.currency);
     }
 
-    // Notificar al usuario
+    // Marcar como aprobada y acreditar en la misma transacción
+    let credited;
     try {
-        await bot.telegram.sendMessage(request.user_id,
-            `✅ <b>¡Depósito aprobado!</b>\n\n` +
-            `💰 Monto: ${request.amount} ${request.currency}\n` +
-            `📌 El saldo ya ha sido acreditado a tu cuenta.`,
-            { parse_mode: 'HTML' }
-        );
-    } catch (e) {}
+        credited = await approveDeposit(parseInt(id), credit, parseInt(userId));
+    } catch (e) {
+        return res.status(500).json({ error: e.message });
+    }
+    if (!credited) {
+        return res.status(404).json({ error: 'Solicitud no encontrada o ya procesada' });
+    }
 
     res.json({ success: true });
+
+    // Notificar al usuario sin retrasar la respuesta al admin
+    bot.telegram.sendMessage(request.user_id,
+        `✅ <b>¡Depósito aprobado!</b>\n\n` +
+        `💰 Monto: ${request.amount} ${request.currency}\n` +
+        `📌 El saldo ya ha sido acreditado a tu cuenta.`,
+        { parse_mode: 'HTML' }
+    ).catch(e => logNotifyError('depósito aprobado', e));
 });
 
 // --- Rechazar solicitud de depósito ---
@@ -1633,7 +1548,7 @@ app.post('/api/admin/pending-deposits/:id/reject', requireAdmin, async (req, res
 
     const { data: request, error: fetchError } = await supabase
         .from('deposit_requests')
-        .select('*')
+        .select('user_id, amount, currency')
         .eq('id', id)
         .eq('status', 'pending')
         .single();
@@ -1660,7 +1575,9 @@ app.post('/api/admin/pending-deposits/:id/reject', requireAdmin, async (req, res
             `📌 Por favor, contacta con el administrador si tienes dudas.`,
             { parse_mode: 'HTML' }
         );
-    } catch (e) {}
+    } catch (e) {
+        logNotifyError('depósito rechazado', e);
+    }
 
     res.json({ success: true });
 });
@@ -1709,7 +1626,7 @@ app.post('/api/admin/pending-withdraws/:id/approve', requireAdmin, async (req, r
 
     const { data: request, error: fetchError } = await supabase
         .from('withdraw_requests')
-        .select('*')
+        .select('user_id, amount, currency')
         .eq('id', id)
         .eq('status', 'pending')
         .single();
@@ -1718,40 +1635,28 @@ app.post('/api/admin/pending-withdraws/:id/approve', requireAdmin, async (req, r
         return res.status(404).json({ error: 'Solicitud no encontrada o ya procesada' });
     }
 
-    // El saldo ya se verificó al crear la solicitud, así que solo marcamos como aprobado
-    // (Opcional: podríamos descontar aquí, pero ya se descontó al crear la solicitud, según tu lógica actual)
-    // En tu implementación actual, el saldo NO se descuenta al crear la solicitud, solo se verifica.
-    // Por lo tanto, al aprobar debemos descontar el saldo.
-
-    const user = await getOrCreateUser(request.user_id);
-    let newCup = parseFloat(user.cup) || 0;
-    let newUsd = parseFloat(user.usd) || 0;
-
+    // Aprobar y descontar van en la misma transacción (RPC approve_withdraw):
+    // si la solicitud ya no está pendiente no se descuenta nada.
+    const debit = {};
     if (request.currency === 'CUP') {
-        newCup -= parseFloat(request.amount);
+        debit.cup = parseFloat(request.amount);
     } else if (request.currency === 'USD') {
-        newUsd -= parseFloat(request.amount);
+        debit.usd = parseFloat(request.amount);
     } else {
-        const cupAmount = await convertToCUP(parseFloat(request.amount), request.currency);
-        newCup -= cupAmount;
+        debit.cup = await convertToCUP(parseFloat(request.amount), request.currency);
     }
 
-    if (newCup < 0 || newUsd < 0) {
-        return res.status(400).json({ error: 'Saldo insuficiente (posible cambio de tasa). Rechace la solicitud.' });
+    let result;
+    try {
+        result = await approveWithdraw(parseInt(id), debit, parseInt(userId));
+    } catch (e) {
+        return res.status(500).json({ error: e.message });
     }
-
-    await supabase
-        .from('users')
-        .update({ cup: newCup, usd: newUsd, updated_at: new Date() })
-        .eq('telegram_id', request.user_id);
-
-    const { error: updateError } = await supabase
-        .from('withdraw_requests')
-        .update({ status: 'approved', processed_at: new Date(), processed_by: parseInt(userId) })
-        .eq('id', id);
-
-    if (updateError) {
-        return res.status(500).json({ error: updateError.message });
+    if (!result.ok) {
+        if (result.reason === 'not_pending') {
+            return res.status(404).json({ error: 'Solicitud no encontrada o ya procesada' });
+        }
+        return res.status(400).json({ error: 'Saldo insuficiente (posible cambio de tasa). Rechace la solicitud.' });
     }
 
     try {
@@ -1761,7 +1666,9 @@ app.post('/api/admin/pending-withdraws/:id/approve', requireAdmin, async (req, r
             `📌 Los fondos han sido enviados a tu cuenta.`,
             { parse_mode: 'HTML' }
         );
-    } catch (e) {}
+    } catch (e) {
+        logNotifyError('retiro aprobado', e);
+    }
 
     res.json({ success: true });
 });
@@ -1773,7 +1680,7 @@ app.post('/api/admin/pending-withdraws/:id/reject', requireAdmin, async (req, re
 
     const { data: request, error: fetchError } = await supabase
         .from('withdraw_requests')
-        .select('*')
+        .select('user_id, amount, currency')
         .eq('id', id)
         .eq('status', 'pending')
         .single();
@@ -1799,41 +1706,216 @@ app.post('/api/admin/pending-withdraws/:id/reject', requireAdmin, async (req, re
             `📌 Contacta con el administrador para más información.`,
             { parse_mode: 'HTML' }
         );
-    } catch (e) {}
+    } catch (e) {
+        logNotifyError('retiro rechazado', e);
+    }
 
     res.json({ success: true });
 });
 
 // ========== SERVIDOR ESTÁTICO ==========
-app.get('/', (req, res) => {
-    res.sendFile(path.join(__dirname, 'webapp', 'index.html'));
-});
-app.get('/app.html', (req, res) => {
-    res.sendFile(path.join(__dirname, 'webapp', 'app.html'));
+// index.html y app.html no cambian mientras corre el proceso: se leen una vez
+// al arrancar y se sirven desde memoria con su ETag. Si el navegador ya tiene
+// la versión actual (If-None-Match) responde 304 sin cuerpo.
+// También se comprimen una sola vez (brotli al máximo y gzip 9); el middleware
+// compression no toca respuestas que ya llevan Content-Encoding.
+function loadPage(file) {
+    const body = fs.readFileSync(path.join(__dirname, 'webapp', file));
+    const hash = crypto.createHash('sha1').update(body).digest('base64url');
+    return {
+        identity: { body, etag: `"${hash}"` },
+        br: {
+            body: zlib.brotliCompressSync(body, {
+                params: {
+                    [zlib.constants.BROTLI_PARAM_QUALITY]: zlib.constants.BROTLI_MAX_QUALITY,
+                    [zlib.constants.BROTLI_PARAM_MODE]: zlib.constants.BROTLI_MODE_TEXT,
+                    [zlib.constants.BROTLI_PARAM_SIZE_HINT]: body.length
+                }
+            }),
+            etag: `"${hash}-br"`
+        },
+        gzip: { body: zlib.gzipSync(body, { level: 9 }), etag: `"${hash}-gz"` }
+    };
+}
+
+const PAGES = {
+    index: loadPage('index.html'),
+    app: loadPage('app.html')
+};
+
+function sendPage(page) {
+    return (req, res) => {
+        const encoding = req.acceptsEncodings('br', 'gzip', 'identity') || 'identity';
+        const variant = page[encoding];
+        res.set({
+            'Content-Type': 'text/html; charset=utf-8',
+            'ETag': variant.etag,
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding'
+        });
+        if (encoding !== 'identity') res.set('Content-Encoding', encoding);
+        if (req.fresh) return res.status(304).end();
+        res.send(variant.body);
+    };
+}
+
+app.get(['/', '/index.html'], sendPage(PAGES.index));
+app.get('/app.html', sendPage(PAGES.app));
+app.use(express.static(path.join(__dirname, 'webapp')));
+
+// ========== WEBHOOK DE TELEGRAM ==========
+// Con una URL pública https, Telegram empuja cada actualización a este mismo
+// servidor Express (sin bucle de getUpdates ni pings periódicos a la Bot API).
+// El long polling queda solo para desarrollo local (http), ya que Telegram
+// solo acepta webhooks https; nunca se usan los dos a la vez. Como en
+// producción todo llega por aquí, la cola de abajo tiene tope y stopBot la
+// vacía antes de salir.
+const WEBHOOK_DOMAIN = process.env.WEBHOOK_DOMAIN || (WEBAPP_URL.startsWith('https://') ? new URL(WEBAPP_URL).host : null);
+// El secreto debe ser el mismo en todas las instancias (cada una llama a
+// setWebhook al arrancar): si no se configura, se deriva del token del bot,
+// igual que la ruta con bot.secretPathComponent().
+const WEBHOOK_SECRET = process.env.WEBHOOK_SECRET ||
+    crypto.createHmac('sha256', 'telegram-webhook-secret').update(BOT_TOKEN).digest('hex');
+const WEBHOOK_PATH = `/tg/${bot.secretPathComponent()}`;
+const WEBHOOK_WORKERS = parseInt(process.env.WEBHOOK_WORKERS) || 8;
+// El bot solo maneja mensajes (texto, fotos, comandos) y botones inline: el
+// resto de tipos (ediciones, cambios de miembros, etc.) ni se pide a Telegram.
+const ALLOWED_UPDATES = ['message', 'callback_query'];
+
+// Se responde 200 a Telegram antes de procesar: los handlers hacen varias
+// consultas a Supabase y no deben retrasar el acuse (Telegram reintenta y
+// encola si tarda). Las actualizaciones se procesan con WEBHOOK_WORKERS en paralelo,
+// pero las de un mismo usuario van en orden, una a una, para que dos handlers
+// no lean y escriban su sesión a la vez.
+// La cola tiene tope: si está llena se responde 429 y Telegram reintenta más
+// tarde en lugar de acumular en memoria actualizaciones ya confirmadas.
+const WEBHOOK_QUEUE_LIMIT = parseInt(process.env.WEBHOOK_QUEUE_LIMIT) || 1000;
+const SHUTDOWN_DRAIN_MS = parseInt(process.env.SHUTDOWN_DRAIN_MS) || 10000;
+const updateQueue = [];
+const busyUpdateUsers = new Set();
+let activeUpdateWorkers = 0;
+let acceptingUpdates = true;
+let onUpdateQueueIdle = null;
+
+function updateUserId(update) {
+    const payload = Object.values(update).find(v => v && typeof v === 'object' && v.from);
+    return payload ? payload.from.id : null;
+}
+
+function enqueueUpdate(update) {
+    updateQueue.push(update);
+    drainUpdateQueue();
+}
+
+function drainUpdateQueue() {
+    let i = 0;
+    while (activeUpdateWorkers < WEBHOOK_WORKERS && i < updateQueue.length) {
+        const update = updateQueue[i];
+        const userId = updateUserId(update);
+        if (userId !== null && busyUpdateUsers.has(userId)) {
+            i++;
+            continue;
+        }
+        updateQueue.splice(i, 1);
+        activeUpdateWorkers++;
+        if (userId !== null) busyUpdateUsers.add(userId);
+        bot.handleUpdate(update)
+            .catch(err => console.error('Error procesando update de Telegram:', err))
+            .finally(() => {
+                activeUpdateWorkers--;
+                if (userId !== null) busyUpdateUsers.delete(userId);
+                drainUpdateQueue();
+            });
+    }
+    if (onUpdateQueueIdle && activeUpdateWorkers === 0 && updateQueue.length === 0) onUpdateQueueIdle();
+}
+
+// Resuelve true cuando no queda nada en cola ni en proceso, o false si pasa
+// timeoutMs antes.
+function waitForUpdateQueue(timeoutMs) {
+    return new Promise(resolve => {
+        const timer = setTimeout(() => resolve(false), timeoutMs);
+        onUpdateQueueIdle = () => {
+            clearTimeout(timer);
+            resolve(true);
+        };
+        drainUpdateQueue();
+    });
+}
+
+app.post(WEBHOOK_PATH, (req, res) => {
+    if (req.get('X-Telegram-Bot-Api-Secret-Token') !== WEBHOOK_SECRET) {
+        return res.sendStatus(403);
+    }
+    // Telegram trata cualquier respuesta distinta de 2xx como no entregada y
+    // reintenta: así no se pierde nada al apagar ni con la cola llena.
+    if (!acceptingUpdates) return res.sendStatus(503);
+    if (updateQueue.length >= WEBHOOK_QUEUE_LIMIT) {
+        res.set('Retry-After', '5');
+        return res.sendStatus(429);
+    }
+    res.sendStatus(200);
+    if (req.body && req.body.update_id !== undefined) enqueueUpdate(req.body);
 });
 
-// ========== KEEP-ALIVE ==========
-setInterval(async () => {
-    try {
-        await axios.get(`https://api.telegram.org/bot${BOT_TOKEN}/getMe`);
-        console.log('[Keep-Alive] Ping a Telegram OK');
-    } catch (e) {
-        console.error('[Keep-Alive] Error:', e.message);
+async function startBot() {
+    if (!WEBHOOK_DOMAIN) {
+        console.log('🤖 Sin URL https pública: usando long polling');
+        return bot.launch({ allowedUpdates: ALLOWED_UPDATES });
     }
-}, 5 * 60 * 1000);
+    await bot.telegram.setWebhook(`https://${WEBHOOK_DOMAIN}${WEBHOOK_PATH}`, {
+        secret_token: WEBHOOK_SECRET,
+        allowed_updates: ALLOWED_UPDATES,
+        // Telegram no abre más peticiones simultáneas de las que procesamos
+        max_connections: Math.min(Math.max(WEBHOOK_WORKERS, 1), 100)
+    });
+    console.log(`🤖 Webhook de Telegram activo en https://${WEBHOOK_DOMAIN}/tg/***`);
+}
+
+// bot.stop() solo aplica al long polling. Con webhook las actualizaciones ya
+// confirmadas a Telegram están en updateQueue: se dejan de aceptar nuevas
+// (503, Telegram las reintenta contra la siguiente instancia) y se termina de
+// procesar la cola, con SHUTDOWN_DRAIN_MS como límite, antes de salir.
+async function stopBot(signal) {
+    if (!WEBHOOK_DOMAIN) return bot.stop(signal);
+    acceptingUpdates = false;
+    server.close();
+    const drained = await waitForUpdateQueue(SHUTDOWN_DRAIN_MS);
+    if (!drained) {
+        console.warn(`⚠️ ${signal}: se cierra con ${updateQueue.length + activeUpdateWorkers} actualizaciones sin terminar`);
+    }
+    process.exit(0);
+}
 
 // ========== INICIAR SERVIDOR Y BOT ==========
-app.listen(PORT, () => {
+const server = app.listen(PORT, () => {
     console.log(`🚀 Backend de 4pu3$t4$_Qva corriendo en http://localhost:${PORT}`);
     console.log(`📡 WebApp servida en ${WEBAPP_URL}`);
     console.log(`🤖 Iniciando bot de Telegram...`);
+
+    // El cliente de Supabase es el mismo de bot.js y su fetch mantiene las
+    // conexiones vivas: una primera ronda al arrancar abre el pool (TLS incluido)
+    // y deja en caché lo que pide /api/auth y /api/payment-methods.
+    Promise.all([
+        getExchangeRates(),
+        getPlayPrices(),
+        getAppConfig(),
+        getMethodsIndex('deposit_methods'),
+        getMethodsIndex('withdraw_methods')
+    ]).catch(err => console.error('Error precargando configuración:', err.message));
 });
 
-bot.launch()
+// Detrás del proxy del hosting las conexiones se reutilizan entre peticiones:
+// el keep-alive del servidor debe durar más que el del proxy (60 s en la
+// mayoría) para que no cierre un socket que el proxy cree abierto y devuelva 502.
+server.keepAliveTimeout = 65 * 1000;
+server.headersTimeout = 66 * 1000;
+
+startBot()
     .then(() => console.log('🤖 Bot de Telegram iniciado correctamente'))
     .catch(err => console.error('❌ Error al iniciar el bot:', err));
 
-process.once('SIGINT', () => bot.stop('SIGINT'));
-process.once('SIGTERM', () => bot.stop('SIGTERM'));
+process.once('SIGINT', () => stopBot('SIGINT'));
+process.once('SIGTERM', () => stopBot('SIGTERM'));
 
 module.exports = app;
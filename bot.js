@@ -15,13 +15,14 @@
 // ==============================
 
 require('dotenv').config();
-const { Telegraf, Markup } = require('telegraf');
+const { Telegraf, Markup, session: telegrafSession } = require('telegraf');
 const { message } = require('telegraf/filters');
 const LocalSession = require('telegraf-session-local');
 const { createClient } = require('@supabase/supabase-js');
 const cron = require('node-cron');
 const moment = require('moment-timezone');
 const axios = require('axios');
+const https = require('https');
 
 // ========== CONFIGURACIÓN DESDE .ENV ==========
 const BOT_TOKEN = process.env.BOT_TOKEN;
@@ -31,6 +32,7 @@ const SUPABASE_SERVICE_KEY = process.env.SUPABASE_SERVICE_KEY;
 const BONUS_CUP_DEFAULT = parseFloat(process.env.BONUS_CUP_DEFAULT) || 70;
 const TIMEZONE = process.env.TIMEZONE || 'America/Havana';
 const WEBAPP_URL = process.env.WEBAPP_URL || 'http://localhost:3000';
+const REDIS_URL = process.env.REDIS_URL;
 
 // ========== HORARIO DE RETIROS (hora Cuba) ==========
 const WITHDRAW_HOURS = { start: 22, end: 23.5 };
@@ -42,10 +44,19 @@ function isWithdrawTime() {
 }
 
 // ========== INICIALIZAR SUPABASE ==========
-const supabase = createClient(SUPABASE_URL, SUPABASE_SERVICE_KEY);
+// Un único cliente para todo el proceso: backend.js lo toma de bot.context y
+// así el bot y la API comparten las conexiones keep-alive a Supabase. Con la
+// service key no hay sesión de usuario que guardar ni token que refrescar.
+const supabase = createClient(SUPABASE_URL, SUPABASE_SERVICE_KEY, {
+    auth: { persistSession: false, autoRefreshToken: false }
+});
 
 // ========== INICIALIZAR BOT ==========
-const bot = new Telegraf(BOT_TOKEN);
+// Agente HTTPS persistente para api.telegram.org: las llamadas a la Bot API y
+// la descarga de capturas reutilizan las conexiones TCP/TLS ya abiertas.
+const telegramAgent = new https.Agent({ keepAlive: true, keepAliveMsecs: 10000, maxSockets: 50 });
+const bot = new Telegraf(BOT_TOKEN, { telegram: { agent: telegramAgent } });
+bot.context.supabase = supabase;
 
 // ========== CONFIGURAR COMANDOS DEL MENÚ LATERAL ==========
 bot.telegram.setMyCommands([
@@ -58,17 +69,96 @@ bot.telegram.setMyCommands([
   { command: 'webapp', description: '🌐 Abrir WebApp' }
 ]).catch(err => console.error('Error al setear comandos:', err));
 
-// ========== SESIÓN LOCAL ==========
-const localSession = new LocalSession({ database: 'session_db.json' });
-bot.use(localSession.middleware());
+// ========== SESIÓN ==========
+// Los flujos a medias (depósito, apuesta, acción de admin...) caducan tras
+// SESSION_TTL_MS sin actividad: se limpia la sesión al volver y se purgan
+// las sesiones abandonadas.
+const SESSION_TTL_MS = 10 * 60 * 1000;
+
+// Con REDIS_URL las sesiones viven en Redis (claves session:<from>:<chat> con
+// caducidad SESSION_TTL_MS), así varias instancias del proceso comparten el
+// estado de los flujos y un reinicio no los pierde. Sin Redis se usa el
+// archivo local session_db.json, válido para una sola instancia.
+let localSession = null;
+if (REDIS_URL) {
+    const { createClient: createRedisClient } = require('redis');
+    const redis = createRedisClient({ url: REDIS_URL });
+    redis.on('error', err => console.error('Error de Redis:', err.message));
+    redis.connect().catch(err => console.error('No se pudo conectar a Redis:', err.message));
+    bot.use(telegrafSession({
+        // Igual que LocalSession: sin sesión guardada (usuario nuevo o clave
+        // caducada) ctx.session empieza como objeto vacío, nunca undefined.
+        defaultSession: () => ({}),
+        store: {
+            async get(key) {
+                const raw = await redis.get(`session:${key}`);
+                return raw ? JSON.parse(raw) : undefined;
+            },
+            async set(key, value) {
+                await redis.set(`session:${key}`, JSON.stringify(value), { PX: SESSION_TTL_MS });
+            },
+            async delete(key) {
+                await redis.del(`session:${key}`);
+            }
+        }
+    }));
+} else {
+    localSession = new LocalSession({ database: 'session_db.json' });
+    bot.use(localSession.middleware());
+}
+
+bot.use((ctx, next) => {
+    if (ctx.session) {
+        const now = Date.now();
+        if (ctx.session.touchedAt && now - ctx.session.touchedAt > SESSION_TTL_MS) {
+            for (const key of Object.keys(ctx.session)) delete ctx.session[key];
+        }
+        ctx.session.touchedAt = now;
+    }
+    return next();
+});
+
+if (localSession) setInterval(async () => {
+    try {
+        const DB = await localSession.DB;
+        const limit = Date.now() - SESSION_TTL_MS;
+        await DB.get('sessions')
+            .remove(s => !s.data || !s.data.touchedAt || s.data.touchedAt < limit)
+            .write();
+    } catch (e) {
+        console.error('Error purgando sesiones caducadas:', e.message);
+    }
+}, 60 * 1000).unref();
 
 // ========== FUNCIÓN PARA VERIFICAR SI UN USUARIO ES ADMIN ==========
+// ADMIN_IDS se lee una vez del .env; el Set hace la comprobación O(1) en cada
+// render de menú y en cada mensaje del manejador de texto.
+const ADMIN_ID_SET = new Set(ADMIN_IDS);
+
 function isAdmin(userId) {
-    return ADMIN_IDS.includes(userId);
+    return ADMIN_ID_SET.has(userId);
+}
+
+// Envuelve un handler de botón exclusivo de administradores: a cualquier otro
+// usuario se le responde con la alerta y el handler no llega a ejecutarse.
+function adminOnly(handler) {
+    return async (ctx) => {
+        if (!isAdmin(ctx.from.id)) {
+            await ctx.answerCbQuery('⛔ No autorizado', { show_alert: true });
+            return;
+        }
+        return handler(ctx);
+    };
 }
 
 // ========== FUNCIONES AUXILIARES ==========
 
+// Quita el "cargando" del botón y envía el mensaje a la vez: son dos llamadas
+// independientes a la Bot API y no hace falta esperar una para lanzar la otra.
+function replyAndAnswer(ctx, text, extra) {
+    return Promise.all([ctx.answerCbQuery(), replyHtml(ctx, text, extra)]);
+}
+
 function escapeHTML(text) {
     if (!text) return '';
     return String(text)
@@ -79,37 +169,149 @@ function escapeHTML(text) {
         .replace(/'/g, '&#039;');
 }
 
+// Registra un fallo al enviar una notificación sin cortar el flujo principal.
+// Los 429 de Telegram se distinguen para que el retry_after quede en el log.
+function logNotifyError(where, e) {
+    if (e && e.code === 429) {
+        console.warn(`Límite de Telegram (429) en ${where}, reintentar en ${e.parameters?.retry_after ?? '?'}s`);
+    } else {
+        console.warn(`Error notificando (${where}):`, e?.message || e);
+    }
+}
+
+// ========== ENVÍO EN HTML ==========
+// El formato se decide en cada llamada: los textos con etiquetas (<b>, <code>,
+// <a>...) salen por replyHtml/sendHtml (y por safeEdit, replyAndAnswer y
+// notifyAdmins, que siempre envían HTML) con los datos del usuario pasados
+// por escapeHTML; el resto va con ctx.reply/sendMessage como texto plano.
+function withHtml(extra) {
+    return { ...extra, parse_mode: 'HTML' };
+}
+
+function replyHtml(ctx, text, extra) {
+    return ctx.reply(text, withHtml(extra));
+}
+
+function sendHtml(telegram, chatId, text, extra) {
+    return telegram.sendMessage(chatId, text, withHtml(extra));
+}
+
+// Mismo aviso a todos los admins, enviado en paralelo: un admin que falla
+// (bloqueó el bot, 429...) no retrasa ni impide el envío a los demás.
+function notifyAdmins(text, extra, where) {
+    return Promise.all(ADMIN_IDS.map(adminId =>
+        sendHtml(bot.telegram, adminId, text, extra).catch(e => logNotifyError(where, e))
+    ));
+}
+
 async function safeEdit(ctx, text, keyboard = null) {
     try {
         if (ctx.callbackQuery) {
-            await ctx.editMessageText(text, {
-                parse_mode: 'HTML',
+            await ctx.editMessageText(text, withHtml({
                 reply_markup: keyboard?.reply_markup
-            });
+            }));
         } else {
-            await ctx.reply(text, {
-                parse_mode: 'HTML',
+            await replyHtml(ctx, text, {
                 reply_markup: keyboard?.reply_markup
             });
         }
     } catch (err) {
         console.warn('Error en safeEdit, enviando nuevo mensaje:', err.message);
         try {
-            await ctx.reply(text, {
-                parse_mode: 'HTML',
+            await replyHtml(ctx, text, {
                 reply_markup: keyboard?.reply_markup
             });
-        } catch (e) {}
+        } catch (e) {
+            logNotifyError('safeEdit', e);
+        }
     }
 }
 
+// ========== CACHÉ DE CONFIGURACIÓN ==========
+// Tasas y precios de jugadas solo cambian desde el panel de admin, pero se leen
+// en casi cada flujo. Se guardan en memoria CONFIG_CACHE_TTL_MS y los setters
+// invalidan la entrada. Se cachea la promesa para que lecturas simultáneas
+// compartan una sola consulta.
+const CONFIG_CACHE_TTL_MS = 30 * 1000;
+const configCache = new Map();
+
+function cached(key, loader) {
+    const hit = configCache.get(key);
+    if (hit && hit.expires > Date.now()) return hit.promise;
+    const promise = loader();
+    configCache.set(key, { promise, expires: Date.now() + CONFIG_CACHE_TTL_MS });
+    promise.catch(() => configCache.delete(key));
+    return promise;
+}
+
+function invalidateCache(key) {
+    configCache.delete(key);
+}
+
+// backend.js usa esta misma caché (como el cliente de Supabase): un cambio
+// hecho desde el bot o desde la WebApp invalida la entrada para los dos.
+bot.context.cached = cached;
+bot.context.invalidateCache = invalidateCache;
+
 async function getExchangeRates() {
-    const { data } = await supabase
-        .from('exchange_rate')
-        .select('rate, rate_usdt, rate_trx')
-        .eq('id', 1)
-        .single();
-    return data || { rate: 110, rate_usdt: 110, rate_trx: 1 };
+    return cached('exchange_rate', async () => {
+        const { data } = await supabase
+            .from('exchange_rate')
+            .select('rate, rate_usdt, rate_trx')
+            .eq('id', 1)
+            .single();
+        return data || { rate: 110, rate_usdt: 110, rate_trx: 1 };
+    });
+}
+
+// Columnas que de verdad leen el bot y la WebApp; con '*' PostgREST serializa
+// también las que nadie usa.
+const PLAY_PRICE_COLUMNS = 'bet_type, payout_multiplier, min_cup, max_cup, min_usd, max_usd';
+const METHOD_COLUMNS = 'id, name, card, confirm, currency, min_amount, max_amount';
+
+async function getPlayPrices() {
+    try {
+        return await cached('play_prices', async () => {
+            const { data, error } = await supabase.from('play_prices').select(PLAY_PRICE_COLUMNS);
+            if (error) throw error;
+            return data || [];
+        });
+    } catch (e) {
+        console.error('Error leyendo play_prices:', e.message);
+        return [];
+    }
+}
+
+async function getPlayPrice(betType) {
+    const prices = await getPlayPrices();
+    return prices.find(p => p.bet_type === betType) || null;
+}
+
+// Métodos de depósito/retiro: la lista ordenada y un índice por id salen de la
+// misma consulta cacheada, así que elegir un método (dep_/wit_) es un Map.get.
+async function getMethodsIndex(table) {
+    try {
+        return await cached(table, async () => {
+            const { data, error } = await supabase
+                .from(table)
+                .select(METHOD_COLUMNS)
+                .order('id', { ascending: true });
+            if (error) throw error;
+            const list = data || [];
+            return { list, byId: new Map(list.map(m => [m.id, m])) };
+        });
+    } catch (e) {
+        console.error(`Error leyendo ${table}:`, e.message);
+        return { list: [], byId: new Map() };
+    }
+}
+
+async function getMethods(table) {
+    return (await getMethodsIndex(table)).list;
+}
+
+async function getMethod(table, id) {
+    return (await getMethodsIndex(table)).byId.get(Number(id)) || null;
 }
 
 async function getExchangeRateUSD() {
@@ -127,160 +329,327 @@ async function getExchangeRateTRX() {
     return rates.rate_trx;
 }
 
+// Los setters de configuración devuelven el error de Supabase (null si todo
+// fue bien) en lugar de lanzarlo; quien llama decide cómo avisar.
 async function setExchangeRateUSD(rate) {
-    await supabase
+    const { error } = await supabase
         .from('exchange_rate')
         .update({ rate, updated_at: new Date() })
         .eq('id', 1);
+    invalidateCache('exchange_rate');
+    invalidateCache('cup_rates');
+    return error;
 }
 
 async function setExchangeRateUSDT(rate) {
-    await supabase
+    const { error } = await supabase
         .from('exchange_rate')
         .update({ rate_usdt: rate, updated_at: new Date() })
         .eq('id', 1);
+    invalidateCache('exchange_rate');
+    invalidateCache('cup_rates');
+    return error;
 }
 
 async function setExchangeRateTRX(rate) {
-    await supabase
+    const { error } = await supabase
         .from('exchange_rate')
         .update({ rate_trx: rate, updated_at: new Date() })
         .eq('id', 1);
+    invalidateCache('exchange_rate');
+    invalidateCache('cup_rates');
+    return error;
+}
+
+// CUP que vale una unidad de cada moneda. Se deriva de las tasas una sola vez
+// y se cachea junto a ellas (los setters invalidan ambas entradas), así las
+// conversiones del camino caliente (aprobar depósitos/retiros) son una búsqueda.
+async function getCupRates() {
+    return cached('cup_rates', async () => {
+        const rates = await getExchangeRates();
+        return { CUP: 1, USD: rates.rate, USDT: rates.rate_usdt, TRX: rates.rate_trx, MLC: rates.rate };
+    });
 }
 
 async function convertToCUP(amount, currency) {
-    const rates = await getExchangeRates();
-    switch (currency) {
-        case 'CUP': return amount;
-        case 'USD': return amount * rates.rate;
-        case 'USDT': return amount * rates.rate_usdt;
-        case 'TRX': return amount * rates.rate_trx;
-        case 'MLC': return amount * rates.rate;
-        default: return 0;
-    }
+    const cupRate = (await getCupRates())[currency];
+    return cupRate ? amount * cupRate : 0;
 }
 
 async function convertFromCUP(amountCUP, targetCurrency) {
-    const rates = await getExchangeRates();
-    switch (targetCurrency) {
-        case 'CUP': return amountCUP;
-        case 'USD': return amountCUP / rates.rate;
-        case 'USDT': return amountCUP / rates.rate_usdt;
-        case 'TRX': return amountCUP / rates.rate_trx;
-        case 'MLC': return amountCUP / rates.rate;
-        default: return 0;
-    }
+    const cupRate = (await getCupRates())[targetCurrency];
+    return cupRate ? amountCUP / cupRate : 0;
+}
+
+// ========== MONTOS EN CÉNTIMOS ==========
+// Los saldos son numeric en Postgres (aritmética exacta); el error de coma
+// flotante aparece en JS al multiplicar/dividir por las tasas. Todo delta que
+// se envía a las funciones SQL se redondea antes a céntimos enteros.
+function roundMoney(amount) {
+    return Math.round(((Number(amount) || 0) + Number.EPSILON) * 100) / 100;
+}
+
+// ========== AJUSTE ATÓMICO DE SALDOS ==========
+// Suma deltas a los saldos con la función SQL adjust_user_balance (ver
+// supabase/functions.sql): una sola ida y vuelta y sin carrera entre leer y
+// escribir. Devuelve el usuario actualizado, o null si no existe o si algún
+// saldo quedaría negativo (en ese caso no se modifica nada).
+async function adjustBalance(telegramId, { cup = 0, usd = 0, bonus_cup = 0 }) {
+    const { data, error } = await supabase.rpc('adjust_user_balance', {
+        p_telegram_id: telegramId,
+        p_cup: roundMoney(cup),
+        p_usd: roundMoney(usd),
+        p_bonus_cup: roundMoney(bonus_cup)
+    });
+    if (error) throw error;
+    return data && data.length > 0 ? data[0] : null;
+}
+
+// Aprueba un depósito pendiente y acredita el saldo en una sola transacción
+// (función SQL approve_deposit). Devuelve el usuario actualizado, o null si la
+// solicitud ya estaba procesada.
+async function approveDeposit(requestId, { cup = 0, usd = 0 }, adminId) {
+    const { data, error } = await supabase.rpc('approve_deposit', {
+        p_request_id: requestId,
+        p_cup: roundMoney(cup),
+        p_usd: roundMoney(usd),
+        p_admin_id: adminId
+    });
+    if (error) throw error;
+    return data && data.length > 0 ? data[0] : null;
+}
+
+// Aprueba un retiro pendiente y descuenta el saldo en una sola transacción
+// (función SQL approve_withdraw). Los montos son positivos. Devuelve
+// { ok, reason } o { ok: true, user }.
+async function approveWithdraw(requestId, { cup = 0, usd = 0 }, adminId) {
+    const { data, error } = await supabase.rpc('approve_withdraw', {
+        p_request_id: requestId,
+        p_cup: roundMoney(cup),
+        p_usd: roundMoney(usd),
+        p_admin_id: adminId
+    });
+    if (error) throw error;
+    return data;
+}
+
+// ========== REGISTRO ATÓMICO DE APUESTAS ==========
+// Verifica sesión y saldo, descuenta (bono primero) e inserta la jugada con la
+// función SQL place_bet en una sola transacción. Devuelve { ok, reason } o
+// { ok: true, bet, user }.
+async function placeBet({ userId, lottery, sessionId, betType, rawText, items, costUSD, costCUP }) {
+    const rate = await getExchangeRateUSD();
+    const { data, error } = await supabase.rpc('place_bet', {
+        p_telegram_id: userId,
+        p_lottery: lottery,
+        p_session_id: sessionId || null,
+        p_bet_type: betType,
+        p_raw_text: rawText,
+        p_items: items,
+        p_cost_usd: roundMoney(costUSD),
+        p_cost_cup: roundMoney(costCUP),
+        p_rate: rate
+    });
+    if (error) throw error;
+    return data;
+}
+
+// ========== TRANSFERENCIAS ==========
+// Débito al remitente y crédito al destinatario con la función SQL
+// transfer_balance: una sola llamada que bloquea ambas filas en orden fijo.
+// Devuelve { ok, reason } o { ok: true, from, to } con los usuarios actualizados.
+async function transferBalance(fromId, toId, currency, amount) {
+    const { data, error } = await supabase.rpc('transfer_balance', {
+        p_from: fromId,
+        p_to: toId,
+        p_currency: currency,
+        p_amount: roundMoney(amount)
+    });
+    if (error) throw error;
+    return data;
 }
 
 // ========== FUNCIÓN GETUSER MODIFICADA (AHORA NO ENVÍA BONO DIRECTAMENTE) ==========
 async function getUser(telegramId, firstName = 'Jugador', username = null, ctx = null) {
     try {
-        const { data: user, error } = await supabase
-            .from('users')
-            .select('*')
-            .eq('telegram_id', telegramId)
-            .maybeSingle();
+        // Select + insert (o update de username) en una sola ida y vuelta
+        const { data, error } = await supabase.rpc('get_or_create_user', {
+            p_telegram_id: telegramId,
+            p_first_name: firstName,
+            p_username: username,
+            p_bonus_cup: BONUS_CUP_DEFAULT
+        });
 
-        if (error) {
-            console.error('Error al consultar usuario:', error);
+        if (error || !data || !data.user) {
+            console.error('Error al obtener/crear usuario:', error);
             return { cup: 0, usd: 0, bonus_cup: 0, first_name: firstName, username, telegram_id: telegramId };
         }
 
-        if (user) {
-            if (username && user.username !== username) {
-                await supabase.from('users').update({ username }).eq('telegram_id', telegramId);
-            }
-            return user;
-        }
-
-        const { data: newUser, error: insertError } = await supabase
-            .from('users')
-            .insert({
-                telegram_id: telegramId,
-                first_name: firstName,
-                username: username,
-                bonus_cup: BONUS_CUP_DEFAULT,
-                cup: 0,
-                usd: 0
-            })
-            .select()
-            .single();
-
-        if (insertError) {
-            console.error('Error al crear usuario:', insertError);
-            const { data: retryUser } = await supabase
-                .from('users')
-                .select('*')
-                .eq('telegram_id', telegramId)
-                .maybeSingle();
-            if (retryUser) return retryUser;
-            return { cup: 0, usd: 0, bonus_cup: BONUS_CUP_DEFAULT, first_name: firstName, username, telegram_id: telegramId };
-        }
-
         // Si hay contexto, marcamos que es nuevo para enviar el bono después de la bienvenida
-        if (ctx && ctx.session) {
+        if (data.is_new && ctx && ctx.session) {
             ctx.session.newUserBonus = true;
         }
 
-        return newUser;
+        return data.user;
     } catch (e) {
         console.error('Error inesperado en getUser:', e);
         return { cup: 0, usd: 0, bonus_cup: 0, first_name: firstName, username, telegram_id: telegramId };
     }
 }
 
+// app_config es una tabla clave/valor pequeña que solo cambia desde el panel de
+// admin: se lee completa en una consulta, se cachea como el resto de la
+// configuración y los setters de mínimos invalidan la entrada.
+async function getAppConfig() {
+    try {
+        return await cached('app_config', async () => {
+            const { data, error } = await supabase.from('app_config').select('key, value');
+            if (error) throw error;
+            return new Map((data || []).map(row => [row.key, row.value]));
+        });
+    } catch (e) {
+        console.error('Error leyendo app_config:', e.message);
+        return new Map();
+    }
+}
+
+async function getConfigNumber(key, fallback) {
+    const value = (await getAppConfig()).get(key);
+    return value != null ? parseFloat(value) : fallback;
+}
+
 async function getMinDepositUSD() {
-    const { data } = await supabase
-        .from('app_config')
-        .select('value')
-        .eq('key', 'min_deposit_usd')
-        .single();
-    return data ? parseFloat(data.value) : 1.0;
+    return getConfigNumber('min_deposit_usd', 1.0);
 }
 
 async function getMinWithdrawUSD() {
-    const { data } = await supabase
-        .from('app_config')
-        .select('value')
-        .eq('key', 'min_withdraw_usd')
-        .single();
-    return data ? parseFloat(data.value) : 1.0;
+    return getConfigNumber('min_withdraw_usd', 1.0);
 }
 
 async function setMinDepositUSD(value) {
-    await supabase
+    const { error } = await supabase
         .from('app_config')
         .upsert({ key: 'min_deposit_usd', value: value.toString() }, { onConflict: 'key' });
+    invalidateCache('app_config');
+    return error;
 }
 
 async function setMinWithdrawUSD(value) {
-    await supabase
+    const { error } = await supabase
         .from('app_config')
         .upsert({ key: 'min_withdraw_usd', value: value.toString() }, { onConflict: 'key' });
+    invalidateCache('app_config');
+    return error;
 }
 
+// backend.js usa estos mismos lectores/setters de configuración y wrappers de
+// RPC (como el cliente y la caché): un solo cargador por clave de la caché y
+// una sola definición de cada operación de saldo.
+Object.assign(bot.context, {
+    getExchangeRates,
+    getPlayPrices,
+    getPlayPrice,
+    getMethodsIndex,
+    getMethods,
+    getMethod,
+    setExchangeRateUSD,
+    setExchangeRateUSDT,
+    setExchangeRateTRX,
+    convertToCUP,
+    convertFromCUP,
+    roundMoney,
+    adjustBalance,
+    approveDeposit,
+    approveWithdraw,
+    placeBet,
+    transferBalance,
+    getAppConfig,
+    getMinDepositUSD,
+    getMinWithdrawUSD,
+    setMinDepositUSD,
+    setMinWithdrawUSD
+});
+
+// Datos del panel "Ver datos actuales" con la función SQL admin_dashboard:
+// una sola ida y vuelta y siempre desde la base (sin la caché de config).
+// Si la función aún no está desplegada (o falla), se cae a las lecturas
+// individuales lanzadas en paralelo: la latencia es la de la más lenta.
+async function getAdminDashboard() {
+    const { data, error } = await supabase.rpc('admin_dashboard');
+    if (error) {
+        console.warn('admin_dashboard no disponible, leyendo por separado:', error.message);
+        const [rates, minDeposit, minWithdraw, depositMethods, withdrawMethods, prices] = await Promise.all([
+            getExchangeRates(),
+            getMinDepositUSD(),
+            getMinWithdrawUSD(),
+            getMethods('deposit_methods'),
+            getMethods('withdraw_methods'),
+            getPlayPrices()
+        ]);
+        return { rates, minDeposit, minWithdraw, depositMethods, withdrawMethods, prices };
+    }
+    return {
+        rates: data.rates || { rate: 110, rate_usdt: 110, rate_trx: 1 },
+        minDeposit: data.min_deposit_usd != null ? parseFloat(data.min_deposit_usd) : 1.0,
+        minWithdraw: data.min_withdraw_usd != null ? parseFloat(data.min_withdraw_usd) : 1.0,
+        depositMethods: data.deposit_methods || [],
+        withdrawMethods: data.withdraw_methods || [],
+        prices: data.play_prices || []
+    };
+}
+
+// Número simple (entero o decimal con punto/coma). Se valida antes de convertir
+// para no aceptar entradas como "12abc" (parseFloat devolvería 12).
+const AMOUNT_RE = /^\d+(?:[.,]\d+)?$/;
+const NUMERIC_ID_RE = /^\d+$/;
+
+function parseAmount(text) {
+    if (!AMOUNT_RE.test(text)) return null;
+    return parseFloat(text.replace(',', '.'));
+}
+
+// Monto con moneda ("500 cup", "10,5 USDT"): una sola regex sin distinción de
+// mayúsculas, sin pasar antes por toLowerCase/replace sobre todo el texto.
+const AMOUNT_WITH_CURRENCY_RE = /^\s*(\d+)(?:[.,](\d+))?\s*(cup|usd|usdt|trx|mlc)\s*$/i;
+
 function parseAmountWithCurrency(text) {
-    const lower = text.toLowerCase().replace(',', '.').trim();
-    const match = lower.match(/^(\d+(?:\.\d+)?)\s*(cup|usd|usdt|trx|mlc)$/);
+    if (!text) return null;
+    const match = AMOUNT_WITH_CURRENCY_RE.exec(text);
     if (!match) return null;
     return {
-        amount: parseFloat(match[1]),
-        currency: match[2].toUpperCase()
+        amount: parseFloat(match[2] ? `${match[1]}.${match[2]}` : match[1]),
+        currency: match[3].toUpperCase()
     };
 }
 
+// Expresiones del parser de apuestas: se compilan una sola vez al cargar el módulo
+const BET_LINE_RE = /^([\d\s,]+)\s*(?:con|\*)\s*([0-9.]+)\s*(usd|cup)?$/i;
+const BET_NUMBERS_SPLIT_RE = /[\s,]+/;
+const BET_NUMBER_RE = {
+    fijo: /^\d{2}$/,
+    corridos: /^\d{2}$/,
+    centena: /^\d{3}$/,
+    parle: /^\d{2}x\d{2}$/
+};
+const FIJO_DECENA_TERMINAL_RE = /^[dt]\d$/i;
+
 function parseBetLine(line, betType) {
     line = line.trim().toLowerCase();
     if (!line) return [];
+    // Descarte rápido antes de la regex: toda jugada lleva "con" o "*"
+    if (!line.includes('con') && !line.includes('*')) return [];
+
+    const numberRe = BET_NUMBER_RE[betType];
+    if (!numberRe) return [];
 
-    const match = line.match(/^([\d\s,]+)\s*(?:con|\*)\s*([0-9.]+)\s*(usd|cup)?$/i);
+    const match = line.match(BET_LINE_RE);
     if (!match) return [];
 
     let numerosStr = match[1].trim();
     const montoStr = match[2];
     const moneda = (match[3] || 'usd').toLowerCase();
 
-    const numeros = numerosStr.split(/[\s,]+/).filter(n => n.length > 0);
+    const numeros = numerosStr.split(BET_NUMBERS_SPLIT_RE).filter(n => n.length > 0);
     const montoBase = parseFloat(montoStr);
     if (isNaN(montoBase) || montoBase <= 0) return [];
 
@@ -290,23 +659,12 @@ function parseBetLine(line, betType) {
         let montoReal = montoBase;
         let numeroGuardado = numero;
 
-        if (betType === 'fijo') {
-            if (/^\d{2}$/.test(numero)) {
-            } else if (/^[Dd](\d)$/.test(numero)) {
-                montoReal = montoBase * 10;
-                numeroGuardado = numero.toUpperCase();
-            } else if (/^[Tt](\d)$/.test(numero)) {
-                montoReal = montoBase * 10;
-                numeroGuardado = numero.toUpperCase();
-            } else {
-                continue;
-            }
-        } else if (betType === 'corridos') {
-            if (!/^\d{2}$/.test(numero)) continue;
-        } else if (betType === 'centena') {
-            if (!/^\d{3}$/.test(numero)) continue;
-        } else if (betType === 'parle') {
-            if (!/^\d{2}x\d{2}$/.test(numero)) continue;
+        if (numberRe.test(numero)) {
+            // normal
+        } else if (betType === 'fijo' && FIJO_DECENA_TERMINAL_RE.test(numero)) {
+            // D/T (decena o terminal): cubre 10 números
+            montoReal = montoBase * 10;
+            numeroGuardado = numero.toUpperCase();
         } else {
             continue;
         }
@@ -400,6 +758,12 @@ async function broadcastToAllUsers(message, parseMode = 'HTML') {
     }
 }
 
+async function downloadTelegramFile(telegram, fileId) {
+    const fileLink = await telegram.getFileLink(fileId);
+    const response = await axios({ url: fileLink.href, responseType: 'arraybuffer', httpsAgent: telegramAgent, timeout: 15000 });
+    return Buffer.from(response.data, 'binary');
+}
+
 async function createDepositRequest(userId, methodId, fileBuffer, amountText, currency) {
     const fileName = `deposit_${userId}_${Date.now()}.jpg`;
     const filePath = `deposits/${fileName}`;
@@ -424,7 +788,7 @@ async function createDepositRequest(userId, methodId, fileBuffer, amountText, cu
             currency: currency,
             status: 'pending'
         })
-        .select()
+        .select('id, screenshot_url')
         .single();
 
     if (insertError) throw insertError;
@@ -432,72 +796,210 @@ async function createDepositRequest(userId, methodId, fileBuffer, amountText, cu
     return request;
 }
 
-function getMainKeyboard(ctx) {
-    const buttons = [
-        ['🎲 Jugar', '💰 Mi dinero'],
-        ['📋 Mis jugadas', '👥 Referidos'],
-        ['❓ Cómo jugar', '🌐 Abrir WebApp']
-    ];
-    if (isAdmin(ctx.from.id)) {
-        buttons.push(['🔧 Admin']);
+// ========== REFERIDOS ==========
+// Solo el número: HEAD con count=exact, PostgREST no serializa ninguna fila.
+async function countReferrals(userId) {
+    const { count } = await supabase
+        .from('users')
+        .select('telegram_id', { count: 'exact', head: true })
+        .eq('ref_by', userId);
+    return count || 0;
+}
+
+// ========== HISTORIAL DE JUGADAS ==========
+// Solo las columnas que se muestran en "Mis jugadas"; items (el detalle de
+// cada número) es la columna más pesada de bets y aquí no se usa. La fecha ya
+// llega formateada en hora de Cuba (columna calculada placed_at_local); si la
+// función aún no existe en la base, se formatea placed_at aquí.
+async function getRecentBets(userId, limit = 5) {
+    const recentBets = columns => supabase
+        .from('bets')
+        .select(columns)
+        .eq('user_id', userId)
+        .order('placed_at', { ascending: false })
+        .limit(limit);
+
+    const { data, error } = await recentBets('lottery, bet_type, raw_text, cost_cup, cost_usd, placed_at_local');
+    if (!error) return data;
+
+    console.error('Error leyendo placed_at_local, se usa placed_at:', error.message);
+    const { data: fallback, error: fallbackError } = await recentBets('lottery, bet_type, raw_text, cost_cup, cost_usd, placed_at');
+    if (fallbackError) {
+        console.error('Error leyendo jugadas recientes:', fallbackError.message);
+        return null;
     }
-    return Markup.keyboard(buttons).resize();
+    return fallback.map(b => ({
+        ...b,
+        placed_at_local: moment(b.placed_at).tz(TIMEZONE).format('DD/MM/YYYY HH:mm')
+    }));
 }
 
-function playLotteryKbd() {
-    const buttons = [
-        [Markup.button.callback('🦩 Florida', 'lot_florida')],
-        [Markup.button.callback('🍑 Georgia', 'lot_georgia')],
-        [Markup.button.callback('🗽 Nueva York', 'lot_newyork')],
-        [Markup.button.callback('◀ Volver', 'main')]
-    ];
-    return Markup.inlineKeyboard(buttons);
+// Texto de "Mis jugadas" (comando, botón inline y botón del teclado): cada fila
+// se arma con map y el mensaje completo con un solo join.
+function formatBetsHistory(bets) {
+    const rows = bets.map((b, i) =>
+        `<b>${i + 1}.</b> 🎰 ${escapeHTML(b.lottery)} - ${escapeHTML(b.bet_type)}\n` +
+        `   📝 <code>${escapeHTML(b.raw_text)}</code>\n` +
+        `   💰 ${b.cost_cup} CUP / ${b.cost_usd} USD\n` +
+        `   🕒 ${b.placed_at_local}\n\n`
+    );
+    return '📋 <b>Tus últimas 5 jugadas:</b>\n\n' +
+        rows.join('') +
+        '¿Quieres ver más? Puedes consultar el historial completo en la WebApp.';
 }
 
-function playTypeKbd() {
-    const buttons = [
-        [Markup.button.callback('🎯 Fijo', 'type_fijo')],
-        [Markup.button.callback('🏃 Corridos', 'type_corridos')],
-        [Markup.button.callback('💯 Centena', 'type_centena')],
-        [Markup.button.callback('🔒 Parle', 'type_parle')],
-        [Markup.button.callback('◀ Volver', 'play')]
-    ];
-    return Markup.inlineKeyboard(buttons);
+// ========== TEXTOS FIJOS ==========
+// Mensajes sin interpolación que varios handlers (comando, botón inline y
+// botón del teclado) repiten tal cual.
+const HELP_TEXT =
+    '📩 <b>¿Necesitas ayuda?</b>\n\n' +
+    'Puedes escribirnos directamente en este chat. Tu mensaje será recibido por nuestro equipo de soporte y te responderemos a la mayor brevedad.\n\n' +
+    'También puedes consultar la sección de preguntas frecuentes en nuestra WebApp.';
+const WEBAPP_TEXT = 'Haz clic en el botón para acceder a nuestra plataforma web interactiva:';
+const ADMIN_PANEL_TEXT = '🔧 <b>Panel de administración</b>\nSelecciona una opción:';
+
+// ========== TECLADOS ==========
+// Los menús son estáticos: se construyen una sola vez al cargar el módulo y
+// cada handler reutiliza la misma referencia en lugar de rearmarlos por clic.
+const MAIN_MENU_ROWS = [
+    ['🎲 Jugar', '💰 Mi dinero'],
+    ['📋 Mis jugadas', '👥 Referidos'],
+    ['❓ Cómo jugar', '🌐 Abrir WebApp']
+];
+const MAIN_KBD = Markup.keyboard(MAIN_MENU_ROWS).resize();
+const MAIN_KBD_ADMIN = Markup.keyboard([...MAIN_MENU_ROWS, ['🔧 Admin']]).resize();
+// Textos de los botones del teclado principal, para reconocerlos en el
+// manejador de texto con una búsqueda en el Set.
+const MAIN_BUTTONS = new Set([...MAIN_MENU_ROWS.flat(), '🔧 Admin']);
+
+function getMainKeyboard(ctx) {
+    return isAdmin(ctx.from.id) ? MAIN_KBD_ADMIN : MAIN_KBD;
 }
 
-function myMoneyKbd() {
-    const buttons = [
-        [Markup.button.callback('📥 Recargar', 'recharge')],
-        [Markup.button.callback('📤 Retirar', 'withdraw')],
-        [Markup.button.callback('🔄 Transferir', 'transfer')],
-        [Markup.button.callback('◀ Volver', 'main')]
-    ];
+const PLAY_LOTTERY_KBD = Markup.inlineKeyboard([
+    [Markup.button.callback('🦩 Florida', 'lot_florida')],
+    [Markup.button.callback('🍑 Georgia', 'lot_georgia')],
+    [Markup.button.callback('🗽 Nueva York', 'lot_newyork')],
+    [Markup.button.callback('◀ Volver', 'main')]
+]);
+
+const PLAY_TYPE_KBD = Markup.inlineKeyboard([
+    [Markup.button.callback('🎯 Fijo', 'type_fijo')],
+    [Markup.button.callback('🏃 Corridos', 'type_corridos')],
+    [Markup.button.callback('💯 Centena', 'type_centena')],
+    [Markup.button.callback('🔒 Parle', 'type_parle')],
+    [Markup.button.callback('◀ Volver', 'play')]
+]);
+
+const MY_MONEY_KBD = Markup.inlineKeyboard([
+    [Markup.button.callback('📥 Recargar', 'recharge')],
+    [Markup.button.callback('📤 Retirar', 'withdraw')],
+    [Markup.button.callback('🔄 Transferir', 'transfer')],
+    [Markup.button.callback('◀ Volver', 'main')]
+]);
+
+const ADMIN_PANEL_KBD = Markup.inlineKeyboard([
+    [Markup.button.callback('🎰 Gestionar sesiones', 'admin_sessions')],
+    [Markup.button.callback('🔢 Publicar ganadores', 'admin_winning')],
+    [Markup.button.callback('➕ Añadir método DEPÓSITO', 'adm_add_dep')],
+    [Markup.button.callback('✏️ Editar método DEPÓSITO', 'adm_edit_dep')],
+    [Markup.button.callback('🗑 Eliminar método DEPÓSITO', 'adm_delete_dep')],
+    [Markup.button.callback('➕ Añadir método RETIRO', 'adm_add_wit')],
+    [Markup.button.callback('✏️ Editar método RETIRO', 'adm_edit_wit')],
+    [Markup.button.callback('🗑 Eliminar método RETIRO', 'adm_delete_wit')],
+    [Markup.button.callback('💰 Configurar tasa USD/CUP', 'adm_set_rate_usd')],
+    [Markup.button.callback('💰 Configurar tasa USDT/CUP', 'adm_set_rate_usdt')],
+    [Markup.button.callback('💰 Configurar tasa TRX/CUP', 'adm_set_rate_trx')],
+    [Markup.button.callback('🎲 Configurar precios y pagos', 'adm_set_prices')],
+    [Markup.button.callback('💰 Mínimos por jugada', 'adm_min_per_bet')],
+    [Markup.button.callback('💰 Mínimo depósito', 'adm_min_deposit')],
+    [Markup.button.callback('💰 Mínimo retiro', 'adm_min_withdraw')],
+    [Markup.button.callback('📋 Ver datos actuales', 'adm_view')],
+    [Markup.button.callback('◀ Menú principal', 'main')]
+]);
+
+// Los tipos de jugada son fijos (las filas de play_prices no cambian): los
+// menús de precios y de límites no necesitan consultar la base para armarse.
+const PLAY_TYPES = ['fijo', 'corridos', 'centena', 'parle'];
+
+function betTypeMenu(prefix) {
+    const buttons = PLAY_TYPES.map(t => [Markup.button.callback(t, `${prefix}${t}`)]);
+    buttons.push([Markup.button.callback('◀ Cancelar', 'admin_panel')]);
     return Markup.inlineKeyboard(buttons);
 }
 
-function adminPanelKbd() {
-    const buttons = [
-        [Markup.button.callback('🎰 Gestionar sesiones', 'admin_sessions')],
-        [Markup.button.callback('🔢 Publicar ganadores', 'admin_winning')],
-        [Markup.button.callback('➕ Añadir método DEPÓSITO', 'adm_add_dep')],
-        [Markup.button.callback('✏️ Editar método DEPÓSITO', 'adm_edit_dep')],
-        [Markup.button.callback('🗑 Eliminar método DEPÓSITO', 'adm_delete_dep')],
-        [Markup.button.callback('➕ Añadir método RETIRO', 'adm_add_wit')],
-        [Markup.button.callback('✏️ Editar método RETIRO', 'adm_edit_wit')],
-        [Markup.button.callback('🗑 Eliminar método RETIRO', 'adm_delete_wit')],
-        [Markup.button.callback('💰 Configurar tasa USD/CUP', 'adm_set_rate_usd')],
-        [Markup.button.callback('💰 Configurar tasa USDT/CUP', 'adm_set_rate_usdt')],
-        [Markup.button.callback('💰 Configurar tasa TRX/CUP', 'adm_set_rate_trx')],
-        [Markup.button.callback('🎲 Configurar precios y pagos', 'adm_set_prices')],
-        [Markup.button.callback('💰 Mínimos por jugada', 'adm_min_per_bet')],
-        [Markup.button.callback('💰 Mínimo depósito', 'adm_min_deposit')],
-        [Markup.button.callback('💰 Mínimo retiro', 'adm_min_withdraw')],
-        [Markup.button.callback('📋 Ver datos actuales', 'adm_view')],
-        [Markup.button.callback('◀ Menú principal', 'main')]
-    ];
-    return Markup.inlineKeyboard(buttons);
+const SET_PRICE_KBD = betTypeMenu('set_price_');
+const SET_MIN_KBD = betTypeMenu('set_min_');
+
+// WEBAPP_URL no cambia en tiempo de ejecución: el botón web_app es fijo
+const WEBAPP_KBD = Markup.inlineKeyboard([
+    Markup.button.webApp('🚀 Abrir WebApp', `${WEBAPP_URL}/app.html`)
+]);
+
+// Botones "Volver" de una sola fila, memoizados por texto y callback_data
+const backKbdCache = new Map();
+function backKbd(text, data) {
+    const key = `${text}|${data}`;
+    let kbd = backKbdCache.get(key);
+    if (!kbd) {
+        kbd = Markup.inlineKeyboard([[Markup.button.callback(text, data)]]);
+        backKbdCache.set(key, kbd);
+    }
+    return kbd;
+}
+
+const BACK_MAIN_KBD = backKbd('◀ Volver al inicio', 'main');
+const BACK_ADMIN_KBD = backKbd('◀ Volver a Admin', 'admin_panel');
+
+const REGIONS_KBD = Markup.inlineKeyboard([
+    [Markup.button.callback('🦩 Florida', 'sess_region_Florida')],
+    [Markup.button.callback('🍑 Georgia', 'sess_region_Georgia')],
+    [Markup.button.callback('🗽 Nueva York', 'sess_region_Nueva York')],
+    [Markup.button.callback('◀ Volver a Admin', 'admin_panel')]
+]);
+
+const EDIT_FIELD_KBD = Markup.inlineKeyboard([
+    [Markup.button.callback('✏️ Nombre', 'edit_field_name')],
+    [Markup.button.callback('✏️ Moneda', 'edit_field_currency')],
+    [Markup.button.callback('✏️ Datos (card)', 'edit_field_card')],
+    [Markup.button.callback('✏️ Confirmar / Red', 'edit_field_confirm')],
+    [Markup.button.callback('✏️ Límite mínimo', 'edit_field_min_amount')],
+    [Markup.button.callback('✏️ Límite máximo', 'edit_field_max_amount')],
+    [Markup.button.callback('◀ Cancelar', 'admin_panel')]
+]);
+
+// Listas de métodos (recarga, retiro, editar, eliminar). Se memoizan sobre la
+// lista cacheada por getMethods: mientras la caché no se invalide es el mismo
+// array y el teclado se reutiliza; al cambiar un método llega un array nuevo.
+const methodsKbdCache = new WeakMap();
+function methodsKbd(methods, prefix, backText, backData) {
+    let byPrefix = methodsKbdCache.get(methods);
+    if (!byPrefix) {
+        byPrefix = new Map();
+        methodsKbdCache.set(methods, byPrefix);
+    }
+    let kbd = byPrefix.get(prefix);
+    if (!kbd) {
+        const buttons = methods.map(m => [Markup.button.callback(`${m.name} (${m.currency})`, `${prefix}${m.id}`)]);
+        buttons.push([Markup.button.callback(backText, backData)]);
+        kbd = Markup.inlineKeyboard(buttons);
+        byPrefix.set(prefix, kbd);
+    }
+    return kbd;
+}
+
+// Teclado Aprobar/Rechazar que reciben los admins con cada solicitud. Solo cambia
+// el id, así que se arma directamente el objeto reply_markup sin pasar por Markup.
+function approveRejectMarkup(kind, id) {
+    return {
+        inline_keyboard: [[
+            { text: '✅ Aprobar', callback_data: `approve_${kind}_${id}` },
+            { text: '❌ Rechazar', callback_data: `reject_${kind}_${id}` }
+        ]]
+    };
 }
 
+// ========== HORARIOS DE JUEGO ==========
 function getAllowedHours(lotteryKey) {
     const schedules = {
         florida: {
@@ -574,11 +1076,10 @@ bot.command('start', async (ctx) => {
     // Si es un usuario nuevo, enviamos el bono después de la bienvenida
     if (ctx.session && ctx.session.newUserBonus) {
         try {
-            await ctx.reply(
+            await replyHtml(ctx,
                 `🎁 <b>¡Bono de bienvenida!</b>\n\n` +
                 `Has recibido <b>${BONUS_CUP_DEFAULT} CUP</b> como bono no retirable.\n` +
-                `Puedes usar este bono para jugar y ganar premios reales. ¡Buena suerte!`,
-                { parse_mode: 'HTML' }
+                `Puedes usar este bono para jugar y ganar premios reales. ¡Buena suerte!`
             );
         } catch (e) {
             console.error('Error enviando mensaje de bono:', e);
@@ -588,7 +1089,7 @@ bot.command('start', async (ctx) => {
 });
 
 bot.command('jugar', async (ctx) => {
-    await safeEdit(ctx, '🎲 Por favor, selecciona una lotería para comenzar a jugar:', playLotteryKbd());
+    await safeEdit(ctx, '🎲 Por favor, selecciona una lotería para comenzar a jugar:', PLAY_LOTTERY_KBD);
 });
 
 bot.command('mi_dinero', async (ctx) => {
@@ -605,17 +1106,12 @@ bot.command('mi_dinero', async (ctx) => {
         `💵 <b>USD:</b> ${usd.toFixed(2)} (aprox. ${usdToCup} CUP)\n` +
         `🎁 <b>Bono (no retirable):</b> ${bonusCup.toFixed(2)} CUP\n\n` +
         `¿Qué deseas hacer?`;
-    await safeEdit(ctx, text, myMoneyKbd());
+    await safeEdit(ctx, text, MY_MONEY_KBD);
 });
 
 bot.command('mis_jugadas', async (ctx) => {
     const uid = ctx.from.id;
-    const { data: bets } = await supabase
-        .from('bets')
-        .select('*')
-        .eq('user_id', uid)
-        .order('placed_at', { ascending: false })
-        .limit(5);
+    const bets = await getRecentBets(uid);
 
     if (!bets || bets.length === 0) {
         await safeEdit(ctx,
@@ -624,28 +1120,16 @@ bot.command('mis_jugadas', async (ctx) => {
             getMainKeyboard(ctx)
         );
     } else {
-        let text = '📋 <b>Tus últimas 5 jugadas:</b>\n\n';
-        bets.forEach((b, i) => {
-            const date = moment(b.placed_at).tz(TIMEZONE).format('DD/MM/YYYY HH:mm');
-            text += `<b>${i + 1}.</b> 🎰 ${escapeHTML(b.lottery)} - ${escapeHTML(b.bet_type)}\n` +
-                `   📝 <code>${escapeHTML(b.raw_text)}</code>\n` +
-                `   💰 ${b.cost_cup} CUP / ${b.cost_usd} USD\n` +
-                `   🕒 ${date}\n\n`;
-        });
-        text += '¿Quieres ver más? Puedes consultar el historial completo en la WebApp.';
-        await safeEdit(ctx, text, getMainKeyboard(ctx));
+        await safeEdit(ctx, formatBetsHistory(bets), getMainKeyboard(ctx));
     }
 });
 
 bot.command('referidos', async (ctx) => {
     const uid = ctx.from.id;
-    const { count } = await supabase
-        .from('users')
-        .select('*', { count: 'exact', head: true })
-        .eq('ref_by', uid);
+    const count = await countReferrals(uid);
 
-    const botInfo = await ctx.telegram.getMe();
-    const link = `https://t.me/${botInfo.username}?start=${uid}`;
+    // Telegraf obtiene getMe una sola vez al arrancar y lo expone en ctx.botInfo
+    const link = `https://t.me/${ctx.botInfo.username}?start=${uid}`;
 
     await safeEdit(ctx,
         `💸 <b>¡GANA DINERO EXTRA INVITANDO AMIGOS! 💰</b>\n\n` +
@@ -665,23 +1149,30 @@ bot.command('referidos', async (ctx) => {
 });
 
 bot.command('ayuda', async (ctx) => {
-    await safeEdit(ctx,
-        '📩 <b>¿Tienes dudas o necesitas ayuda?</b>\n\n' +
-        'Puedes escribir directamente en este chat. Tu mensaje será recibido por nuestro equipo de soporte y te responderemos a la mayor brevedad.\n\n' +
-        'También puedes consultar la sección de preguntas frecuentes en nuestra WebApp.',
-        Markup.inlineKeyboard([[Markup.button.callback('◀ Volver al inicio', 'main')]])
-    );
+    await safeEdit(ctx, HELP_TEXT, BACK_MAIN_KBD);
 });
 
 bot.command('webapp', async (ctx) => {
-    const webAppButton = Markup.inlineKeyboard([
-        Markup.button.webApp('🚀 Abrir WebApp', `${WEBAPP_URL}/app.html`)
-    ]);
-    await ctx.reply('Haz clic en el botón para acceder a nuestra plataforma web interactiva:', webAppButton);
+    await ctx.reply(WEBAPP_TEXT, WEBAPP_KBD);
 });
 
 // ========== ACCIONES ==========
-bot.action('main', async (ctx) => {
+// Los botones con callback_data fijo se resuelven con una sola búsqueda en el
+// Map en lugar de probar uno a uno todos los triggers registrados; solo si no
+// hay coincidencia exacta se pasa a los bot.action con regex (todas ancladas
+// con ^...$ para que 'dep_' no capture también 'edit_dep_' o 'delete_dep_').
+const CALLBACK_HANDLERS = new Map();
+
+function onCallback(data, handler) {
+    CALLBACK_HANDLERS.set(data, handler);
+}
+
+bot.on('callback_query', (ctx, next) => {
+    const handler = CALLBACK_HANDLERS.get(ctx.callbackQuery.data);
+    return handler ? handler(ctx) : next();
+});
+
+onCallback('main', async (ctx) => {
     const firstName = ctx.from.first_name || 'Jugador';
     await safeEdit(ctx,
         `👋 ¡Hola de nuevo, ${escapeHTML(firstName)}! ¿En qué podemos ayudarte hoy?\n\n` +
@@ -690,11 +1181,11 @@ bot.action('main', async (ctx) => {
     );
 });
 
-bot.action('play', async (ctx) => {
-    await safeEdit(ctx, '🎲 Elige una lotería para comenzar:', playLotteryKbd());
+onCallback('play', async (ctx) => {
+    await safeEdit(ctx, '🎲 Elige una lotería para comenzar:', PLAY_LOTTERY_KBD);
 });
 
-bot.action(/lot_(.+)/, async (ctx) => {
+bot.action(/^lot_(.+)$/, async (ctx) => {
     try {
         const lotteryKey = ctx.match[1];
         const lotteryName = lotteryKey === 'florida' ? 'Florida' : lotteryKey === 'georgia' ? 'Georgia' : 'Nueva York';
@@ -722,14 +1213,14 @@ bot.action(/lot_(.+)/, async (ctx) => {
                 `📅 Los horarios permitidos (hora de Cuba) son:\n${hoursText}\n` +
                 `🔄 Por favor, intenta dentro del horario o elige otra lotería. ¡Te esperamos!`;
 
-            await safeEdit(ctx, errorMsg, playLotteryKbd());
+            await safeEdit(ctx, errorMsg, PLAY_LOTTERY_KBD);
             return;
         }
 
         const today = moment.tz(TIMEZONE).format('YYYY-MM-DD');
         const { data: activeSession, error } = await supabase
             .from('lottery_sessions')
-            .select('*')
+            .select('id, time_slot')
             .eq('lottery', lotteryName)
             .eq('date', today)
             .eq('status', 'open')
@@ -752,7 +1243,7 @@ bot.action(/lot_(.+)/, async (ctx) => {
                 `❌ <b>No hay una sesión abierta en este momento para ${schedule.emoji} ${schedule.name}</b>\n\n` +
                 `📅 Horarios de juego (hora de Cuba):\n${hoursText}\n` +
                 `🔄 Por favor, espera a que se abra una sesión o elige otra lotería. ¡Estamos contigo!`;
-            await safeEdit(ctx, errorMsg, playLotteryKbd());
+            await safeEdit(ctx, errorMsg, PLAY_LOTTERY_KBD);
             return;
         }
 
@@ -761,7 +1252,7 @@ bot.action(/lot_(.+)/, async (ctx) => {
         await safeEdit(ctx,
             `✅ Has seleccionado <b>${escapeHTML(lotteryName)}</b> - Turno <b>${escapeHTML(activeSession.time_slot)}</b>.\n` +
             `Ahora elige el tipo de jugada que deseas realizar:`,
-            playTypeKbd()
+            PLAY_TYPE_KBD
         );
     } catch (e) {
         console.error('Error en lot_ handler:', e);
@@ -769,17 +1260,13 @@ bot.action(/lot_(.+)/, async (ctx) => {
     }
 });
 
-bot.action(/type_(.+)/, async (ctx) => {
+bot.action(/^type_(.+)$/, async (ctx) => {
     const betType = ctx.match[1];
     ctx.session.betType = betType;
     ctx.session.awaitingBet = true;
     const lottery = ctx.session.lottery || 'Florida';
 
-    const { data: price } = await supabase
-        .from('play_prices')
-        .select('payout_multiplier, min_cup, min_usd, max_cup, max_usd')
-        .eq('bet_type', betType)
-        .single();
+    const price = await getPlayPrice(betType);
 
     let priceInfo = '';
     if (price) {
@@ -829,7 +1316,7 @@ bot.action(/type_(.+)/, async (ctx) => {
     await safeEdit(ctx, instructions, null);
 });
 
-bot.action('my_money', async (ctx) => {
+onCallback('my_money', async (ctx) => {
     const user = ctx.dbUser;
     const rate = await getExchangeRateUSD();
     const cup = parseFloat(user.cup) || 0;
@@ -843,23 +1330,19 @@ bot.action('my_money', async (ctx) => {
         `💵 <b>USD:</b> ${usd.toFixed(2)} (aprox. ${usdToCup} CUP)\n` +
         `🎁 <b>Bono (no retirable):</b> ${bonusCup.toFixed(2)} CUP\n\n` +
         `¿Qué deseas hacer?`;
-    await safeEdit(ctx, text, myMoneyKbd());
+    await safeEdit(ctx, text, MY_MONEY_KBD);
 });
 
-bot.action('recharge', async (ctx) => {
+onCallback('recharge', async (ctx) => {
     const minDeposit = await getMinDepositUSD();
-    const { data: methods } = await supabase
-        .from('deposit_methods')
-        .select('*')
-        .order('id', { ascending: true });
+    const methods = await getMethods('deposit_methods');
 
     if (!methods || methods.length === 0) {
         await ctx.answerCbQuery('❌ Por el momento no hay métodos de depósito disponibles. Intenta más tarde.', { show_alert: true });
         return;
     }
 
-    const buttons = methods.map(m => [Markup.button.callback(`${m.name} (${m.currency})`, `dep_${m.id}`)]);
-    buttons.push([Markup.button.callback('◀ Volver', 'my_money')]);
+    const kbd = methodsKbd(methods, 'dep_', '◀ Volver', 'my_money');
 
     const rate = await getExchangeRateUSD();
     await safeEdit(ctx,
@@ -867,17 +1350,13 @@ bot.action('recharge', async (ctx) => {
         `Elige un método de pago. Luego deberás enviar una captura de pantalla de la transferencia realizada.\n\n` +
         `<b>Mínimo de depósito:</b> ${minDeposit} USD (equivalente a ${(minDeposit * rate).toFixed(2)} CUP)\n\n` +
         `Selecciona el método:`,
-        Markup.inlineKeyboard(buttons)
+        kbd
     );
 });
 
-bot.action(/dep_(\d+)/, async (ctx) => {
+bot.action(/^dep_(\d+)$/, async (ctx) => {
     const methodId = parseInt(ctx.match[1]);
-    const { data: method } = await supabase
-        .from('deposit_methods')
-        .select('*')
-        .eq('id', methodId)
-        .single();
+    const method = await getMethod('deposit_methods', methodId);
 
     if (!method) {
         await ctx.answerCbQuery('Método no encontrado. Por favor, selecciona otro.', { show_alert: true });
@@ -889,7 +1368,7 @@ bot.action(/dep_(\d+)/, async (ctx) => {
 
     let extraInstructions = '';
     if (method.currency === 'USDT' || method.currency === 'TRX') {
-        extraInstructions = `\n\n🔐 <b>Importante:</b>\n- Envía el monto exacto en ${method.currency} a la dirección indicada.\n- Asegúrate de usar la red correcta: ${method.confirm.includes('TRC20') ? 'TRC-20' : method.confirm.includes('BEP20') ? 'BEP-20' : method.confirm || 'la red especificada'}.\n- La captura debe mostrar claramente el hash de la transacción (TXID) y el monto.`;
+        extraInstructions = `\n\n🔐 <b>Importante:</b>\n- Envía el monto exacto en ${method.currency} a la dirección indicada.\n- Asegúrate de usar la red correcta: ${method.confirm.includes('TRC20') ? 'TRC-20' : method.confirm.includes('BEP20') ? 'BEP-20' : escapeHTML(method.confirm) || 'la red especificada'}.\n- La captura debe mostrar claramente el hash de la transacción (TXID) y el monto.`;
     }
 
     await safeEdit(ctx,
@@ -903,7 +1382,7 @@ bot.action(/dep_(\d+)/, async (ctx) => {
     );
 });
 
-bot.action('withdraw', async (ctx) => {
+onCallback('withdraw', async (ctx) => {
     if (!isWithdrawTime()) {
         const startStr = moment.tz(TIMEZONE).hours(22).minutes(0).format('h:mm A');
         const endStr = moment.tz(TIMEZONE).hours(23).minutes(30).format('h:mm A');
@@ -925,29 +1404,21 @@ bot.action('withdraw', async (ctx) => {
         return;
     }
 
-    const { data: methods } = await supabase
-        .from('withdraw_methods')
-        .select('*')
-        .order('id', { ascending: true });
+    const methods = await getMethods('withdraw_methods');
 
     if (!methods || methods.length === 0) {
         await ctx.answerCbQuery('❌ Por el momento no hay métodos de retiro disponibles. Intenta más tarde.', { show_alert: true });
         return;
     }
 
-    const buttons = methods.map(m => [Markup.button.callback(`${m.name} (${m.currency})`, `wit_${m.id}`)]);
-    buttons.push([Markup.button.callback('◀ Volver', 'my_money')]);
+    const kbd = methodsKbd(methods, 'wit_', '◀ Volver', 'my_money');
 
-    await safeEdit(ctx, '📤 <b>Selecciona un método de retiro:</b>', Markup.inlineKeyboard(buttons));
+    await safeEdit(ctx, '📤 <b>Selecciona un método de retiro:</b>', kbd);
 });
 
-bot.action(/wit_(\d+)/, async (ctx) => {
+bot.action(/^wit_(\d+)$/, async (ctx) => {
     const methodId = parseInt(ctx.match[1]);
-    const { data: method } = await supabase
-        .from('withdraw_methods')
-        .select('*')
-        .eq('id', methodId)
-        .single();
+    const method = await getMethod('withdraw_methods', methodId);
 
     if (!method) {
         await ctx.answerCbQuery('Método no encontrado. Por favor, selecciona otro.', { show_alert: true });
@@ -981,13 +1452,13 @@ bot.action(/wit_(\d+)/, async (ctx) => {
         instruccionesAdicionales = `\n\n🔐 <b>Para retiros en ${method.currency}:</b>\n` +
             `- Después de confirmar el monto, te pediré por separado:\n` +
             `   • Dirección de wallet\n` +
-            `   • Red (ej: TRC-20 para USDT, sugerida: ${method.confirm !== 'ninguno' ? method.confirm : 'la que corresponda'})\n` +
+            `   • Red (ej: TRC-20 para USDT, sugerida: ${method.confirm !== 'ninguno' ? escapeHTML(method.confirm) : 'la que corresponda'})\n` +
             `- Asegúrate de usar la red correcta para evitar pérdidas.`;
     }
 
     await safeEdit(ctx,
         `Has elegido <b>${escapeHTML(method.name)}</b> (moneda: ${method.currency}).\n\n` +
-        `💳 <b>Instrucciones:</b> ${method.confirm}\n\n` +
+        `💳 <b>Instrucciones:</b> ${escapeHTML(method.confirm)}\n\n` +
         `${mensajeSaldo}\n\n` +
         `⏳ <b>Mínimo de retiro:</b> ${minWithdrawCUP} CUP (equivalente a ${minWithdrawUSD} USD).\n` +
         (method.min_amount ? `📉 Límite mínimo: ${method.min_amount} ${method.currency}\n` : '') +
@@ -998,7 +1469,7 @@ bot.action(/wit_(\d+)/, async (ctx) => {
     );
 });
 
-bot.action('transfer', async (ctx) => {
+onCallback('transfer', async (ctx) => {
     ctx.session.awaitingTransferTarget = true;
     await safeEdit(ctx,
         '🔄 <b>Transferir saldo a otro usuario</b>\n\n' +
@@ -1010,14 +1481,9 @@ bot.action('transfer', async (ctx) => {
     );
 });
 
-bot.action('my_bets', async (ctx) => {
+onCallback('my_bets', async (ctx) => {
     const uid = ctx.from.id;
-    const { data: bets } = await supabase
-        .from('bets')
-        .select('*')
-        .eq('user_id', uid)
-        .order('placed_at', { ascending: false })
-        .limit(5);
+    const bets = await getRecentBets(uid);
 
     if (!bets || bets.length === 0) {
         await safeEdit(ctx,
@@ -1026,28 +1492,15 @@ bot.action('my_bets', async (ctx) => {
             getMainKeyboard(ctx)
         );
     } else {
-        let text = '📋 <b>Tus últimas 5 jugadas:</b>\n\n';
-        bets.forEach((b, i) => {
-            const date = moment(b.placed_at).tz(TIMEZONE).format('DD/MM/YYYY HH:mm');
-            text += `<b>${i + 1}.</b> 🎰 ${escapeHTML(b.lottery)} - ${escapeHTML(b.bet_type)}\n` +
-                `   📝 <code>${escapeHTML(b.raw_text)}</code>\n` +
-                `   💰 ${b.cost_cup} CUP / ${b.cost_usd} USD\n` +
-                `   🕒 ${date}\n\n`;
-        });
-        text += '¿Quieres ver más? Puedes consultar el historial completo en la WebApp.';
-        await safeEdit(ctx, text, getMainKeyboard(ctx));
+        await safeEdit(ctx, formatBetsHistory(bets), getMainKeyboard(ctx));
     }
 });
 
-bot.action('referrals', async (ctx) => {
+onCallback('referrals', async (ctx) => {
     const uid = ctx.from.id;
-    const { count } = await supabase
-        .from('users')
-        .select('*', { count: 'exact', head: true })
-        .eq('ref_by', uid);
+    const count = await countReferrals(uid);
 
-    const botInfo = await ctx.telegram.getMe();
-    const link = `https://t.me/${botInfo.username}?start=${uid}`;
+    const link = `https://t.me/${ctx.botInfo.username}?start=${uid}`;
 
     await safeEdit(ctx,
         `💸 <b>¡GANA DINERO EXTRA INVITANDO AMIGOS! 💰</b>\n\n` +
@@ -1066,50 +1519,33 @@ bot.action('referrals', async (ctx) => {
     );
 });
 
-bot.action('how_to_play', async (ctx) => {
-    await safeEdit(ctx,
-        '📩 <b>¿Necesitas ayuda?</b>\n\n' +
-        'Puedes escribirnos directamente en este chat. Nuestro equipo de soporte te responderá a la mayor brevedad.\n\n' +
-        'También puedes consultar la sección de preguntas frecuentes en nuestra WebApp.',
-        Markup.inlineKeyboard([[Markup.button.callback('◀ Volver al inicio', 'main')]])
-    );
+onCallback('how_to_play', async (ctx) => {
+    await safeEdit(ctx, HELP_TEXT, BACK_MAIN_KBD);
 });
 
-bot.action('admin_panel', async (ctx) => {
-    if (!isAdmin(ctx.from.id)) {
-        await ctx.answerCbQuery('⛔ No autorizado. Solo administradores.', { show_alert: true });
-        return;
-    }
-    await safeEdit(ctx, '🔧 <b>Panel de administración</b>\nSelecciona una opción:', adminPanelKbd());
-});
+onCallback('admin_panel', adminOnly(async (ctx) => {
+    await safeEdit(ctx, ADMIN_PANEL_TEXT, ADMIN_PANEL_KBD);
+}));
 
-bot.action('admin_sessions', async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+onCallback('admin_sessions', adminOnly(async (ctx) => {
     await showRegionsMenu(ctx);
-});
+}));
 
 async function showRegionsMenu(ctx) {
-    const buttons = [
-        [Markup.button.callback('🦩 Florida', 'sess_region_Florida')],
-        [Markup.button.callback('🍑 Georgia', 'sess_region_Georgia')],
-        [Markup.button.callback('🗽 Nueva York', 'sess_region_Nueva York')],
-        [Markup.button.callback('◀ Volver a Admin', 'admin_panel')]
-    ];
-    await safeEdit(ctx, '🎰 <b>Gestionar sesiones de juego</b>\n\nSelecciona una región:', Markup.inlineKeyboard(buttons));
+    await safeEdit(ctx, '🎰 <b>Gestionar sesiones de juego</b>\n\nSelecciona una región:', REGIONS_KBD);
 }
 
-bot.action(/sess_region_(.+)/, async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+bot.action(/^sess_region_(.+)$/, adminOnly(async (ctx) => {
     const lottery = ctx.match[1];
     await showRegionSessions(ctx, lottery);
-});
+}));
 
 async function showRegionSessions(ctx, lottery) {
     try {
         const today = moment.tz(TIMEZONE).format('YYYY-MM-DD');
         const { data: sessions } = await supabase
             .from('lottery_sessions')
-            .select('*')
+            .select('id, time_slot, status')
             .eq('lottery', lottery)
             .eq('date', today);
 
@@ -1150,8 +1586,7 @@ async function showRegionSessions(ctx, lottery) {
     }
 }
 
-bot.action(/create_session_(.+)_(.+)/, async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+bot.action(/^create_session_(.+)_(.+)$/, adminOnly(async (ctx) => {
     try {
         const lottery = ctx.match[1];
         const timeSlot = ctx.match[2];
@@ -1203,10 +1638,9 @@ bot.action(/create_session_(.+)_(.+)/, async (ctx) => {
         console.error(e);
         await ctx.answerCbQuery('❌ Error al abrir sesión. Revisa los logs.', { show_alert: true });
     }
-});
+}));
 
-bot.action(/toggle_session_(\d+)_(.+)/, async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+bot.action(/^toggle_session_(\d+)_(.+)$/, adminOnly(async (ctx) => {
     try {
         const sessionId = parseInt(ctx.match[1]);
         const currentStatus = ctx.match[2];
@@ -1221,7 +1655,7 @@ bot.action(/toggle_session_(\d+)_(.+)/, async (ctx) => {
 
         const { data: session } = await supabase
             .from('lottery_sessions')
-            .select('*')
+            .select('lottery, date, time_slot')
             .eq('id', sessionId)
             .single();
 
@@ -1242,81 +1676,64 @@ bot.action(/toggle_session_(\d+)_(.+)/, async (ctx) => {
         console.error(e);
         await ctx.answerCbQuery('❌ Error al cambiar estado. Intenta más tarde.', { show_alert: true });
     }
-});
+}));
 
 // ========== ADMIN: AÑADIR MÉTODOS ==========
-bot.action('adm_add_dep', async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+onCallback('adm_add_dep', adminOnly(async (ctx) => {
     ctx.session.adminAction = 'add_dep';
     ctx.session.adminStep = 1;
-    await ctx.reply('➕ <b>Añadir nuevo método de DEPÓSITO</b>\n\nPaso 1/4: Escribe el <b>nombre</b> del método (ej: "USDT-TRC20", "Transfermovil CUP"):', { parse_mode: 'HTML' });
-    await ctx.answerCbQuery();
-});
+    await replyAndAnswer(ctx, '➕ <b>Añadir nuevo método de DEPÓSITO</b>\n\nPaso 1/4: Escribe el <b>nombre</b> del método (ej: "USDT-TRC20", "Transfermovil CUP"):');
+}));
 
-bot.action('adm_add_wit', async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+onCallback('adm_add_wit', adminOnly(async (ctx) => {
     ctx.session.adminAction = 'add_wit';
     ctx.session.adminStep = 1;
-    await ctx.reply('➕ <b>Añadir nuevo método de RETIRO</b>\n\nPaso 1/4: Escribe el <b>nombre</b> del método (ej: "Efectivo USD", "USDT-BEP20"):', { parse_mode: 'HTML' });
-    await ctx.answerCbQuery();
-});
+    await replyAndAnswer(ctx, '➕ <b>Añadir nuevo método de RETIRO</b>\n\nPaso 1/4: Escribe el <b>nombre</b> del método (ej: "Efectivo USD", "USDT-BEP20"):');
+}));
 
-bot.action('adm_edit_dep', async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
-    const { data: methods } = await supabase.from('deposit_methods').select('*').order('id');
+onCallback('adm_edit_dep', adminOnly(async (ctx) => {
+    const methods = await getMethods('deposit_methods');
     if (!methods || methods.length === 0) {
         await ctx.answerCbQuery('No hay métodos de depósito para editar.', { show_alert: true });
         return;
     }
-    const buttons = methods.map(m => [Markup.button.callback(`${m.name} (${m.currency})`, `edit_dep_${m.id}`)]);
-    buttons.push([Markup.button.callback('◀ Cancelar', 'admin_panel')]);
-    await ctx.reply('✏️ <b>Editar método de DEPÓSITO</b>\nSelecciona el método que deseas modificar:', Markup.inlineKeyboard(buttons));
-    await ctx.answerCbQuery();
-});
+    const kbd = methodsKbd(methods, 'edit_dep_', '◀ Cancelar', 'admin_panel');
+    await replyAndAnswer(ctx, '✏️ <b>Editar método de DEPÓSITO</b>\nSelecciona el método que deseas modificar:', kbd);
+}));
 
-bot.action('adm_edit_wit', async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
-    const { data: methods } = await supabase.from('withdraw_methods').select('*').order('id');
+onCallback('adm_edit_wit', adminOnly(async (ctx) => {
+    const methods = await getMethods('withdraw_methods');
     if (!methods || methods.length === 0) {
         await ctx.answerCbQuery('No hay métodos de retiro para editar.', { show_alert: true });
         return;
     }
-    const buttons = methods.map(m => [Markup.button.callback(`${m.name} (${m.currency})`, `edit_wit_${m.id}`)]);
-    buttons.push([Markup.button.callback('◀ Cancelar', 'admin_panel')]);
-    await ctx.reply('✏️ <b>Editar método de RETIRO</b>\nSelecciona el método que deseas modificar:', Markup.inlineKeyboard(buttons));
-    await ctx.answerCbQuery();
-});
+    const kbd = methodsKbd(methods, 'edit_wit_', '◀ Cancelar', 'admin_panel');
+    await replyAndAnswer(ctx, '✏️ <b>Editar método de RETIRO</b>\nSelecciona el método que deseas modificar:', kbd);
+}));
 
-bot.action('adm_delete_dep', async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
-    const { data: methods } = await supabase.from('deposit_methods').select('*').order('id');
+onCallback('adm_delete_dep', adminOnly(async (ctx) => {
+    const methods = await getMethods('deposit_methods');
     if (!methods || methods.length === 0) {
         await ctx.answerCbQuery('No hay métodos de depósito para eliminar.', { show_alert: true });
         return;
     }
-    const buttons = methods.map(m => [Markup.button.callback(`${m.name} (${m.currency})`, `delete_dep_${m.id}`)]);
-    buttons.push([Markup.button.callback('◀ Cancelar', 'admin_panel')]);
-    await ctx.reply('🗑 <b>Eliminar método de DEPÓSITO</b>\nSelecciona el método que deseas eliminar:', Markup.inlineKeyboard(buttons));
-    await ctx.answerCbQuery();
-});
+    const kbd = methodsKbd(methods, 'delete_dep_', '◀ Cancelar', 'admin_panel');
+    await replyAndAnswer(ctx, '🗑 <b>Eliminar método de DEPÓSITO</b>\nSelecciona el método que deseas eliminar:', kbd);
+}));
 
-bot.action('adm_delete_wit', async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
-    const { data: methods } = await supabase.from('withdraw_methods').select('*').order('id');
+onCallback('adm_delete_wit', adminOnly(async (ctx) => {
+    const methods = await getMethods('withdraw_methods');
     if (!methods || methods.length === 0) {
         await ctx.answerCbQuery('No hay métodos de retiro para eliminar.', { show_alert: true });
         return;
     }
-    const buttons = methods.map(m => [Markup.button.callback(`${m.name} (${m.currency})`, `delete_wit_${m.id}`)]);
-    buttons.push([Markup.button.callback('◀ Cancelar', 'admin_panel')]);
-    await ctx.reply('🗑 <b>Eliminar método de RETIRO</b>\nSelecciona el método que deseas eliminar:', Markup.inlineKeyboard(buttons));
-    await ctx.answerCbQuery();
-});
+    const kbd = methodsKbd(methods, 'delete_wit_', '◀ Cancelar', 'admin_panel');
+    await replyAndAnswer(ctx, '🗑 <b>Eliminar método de RETIRO</b>\nSelecciona el método que deseas eliminar:', kbd);
+}));
 
-bot.action(/edit_dep_(\d+)/, async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+bot.action(/^edit_dep_(\d+)$/, adminOnly(async (ctx) => {
     const methodId = parseInt(ctx.match[1]);
-    const { data: method } = await supabase.from('deposit_methods').select('*').eq('id', methodId).single();
+    const method = await getMethod('deposit_methods', methodId);
     if (!method) {
         await ctx.answerCbQuery('Método no encontrado.', { show_alert: true });
         return;
@@ -1326,16 +1743,7 @@ bot.action(/edit_dep_(\d+)/, async (ctx) => {
     ctx.session.adminAction = 'edit_method';
     ctx.session.editStep = 'choose_field';
 
-    const buttons = [
-        [Markup.button.callback('✏️ Nombre', 'edit_field_name')],
-        [Markup.button.callback('✏️ Moneda', 'edit_field_currency')],
-        [Markup.button.callback('✏️ Datos (card)', 'edit_field_card')],
-        [Markup.button.callback('✏️ Confirmar / Red', 'edit_field_confirm')],
-        [Markup.button.callback('✏️ Límite mínimo', 'edit_field_min_amount')],
-        [Markup.button.callback('✏️ Límite máximo', 'edit_field_max_amount')],
-        [Markup.button.callback('◀ Cancelar', 'admin_panel')]
-    ];
-    await ctx.reply(
+    await replyAndAnswer(ctx, 
         `✏️ Editando método <b>${escapeHTML(method.name)}</b> (ID: ${methodId})\n\n` +
         `Valores actuales:\n` +
         `📛 Nombre: ${escapeHTML(method.name)}\n` +
@@ -1345,15 +1753,13 @@ bot.action(/edit_dep_(\d+)/, async (ctx) => {
         `📉 Mín: ${method.min_amount !== null ? method.min_amount : '-'}\n` +
         `📈 Máx: ${method.max_amount !== null ? method.max_amount : '-'}\n\n` +
         `¿Qué campo deseas modificar?`,
-        Markup.inlineKeyboard(buttons)
+        EDIT_FIELD_KBD
     );
-    await ctx.answerCbQuery();
-});
+}));
 
-bot.action(/edit_wit_(\d+)/, async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+bot.action(/^edit_wit_(\d+)$/, adminOnly(async (ctx) => {
     const methodId = parseInt(ctx.match[1]);
-    const { data: method } = await supabase.from('withdraw_methods').select('*').eq('id', methodId).single();
+    const method = await getMethod('withdraw_methods', methodId);
     if (!method) {
         await ctx.answerCbQuery('Método no encontrado.', { show_alert: true });
         return;
@@ -1363,16 +1769,7 @@ bot.action(/edit_wit_(\d+)/, async (ctx) => {
     ctx.session.adminAction = 'edit_method';
     ctx.session.editStep = 'choose_field';
 
-    const buttons = [
-        [Markup.button.callback('✏️ Nombre', 'edit_field_name')],
-        [Markup.button.callback('✏️ Moneda', 'edit_field_currency')],
-        [Markup.button.callback('✏️ Datos (card)', 'edit_field_card')],
-        [Markup.button.callback('✏️ Confirmar / Red', 'edit_field_confirm')],
-        [Markup.button.callback('✏️ Límite mínimo', 'edit_field_min_amount')],
-        [Markup.button.callback('✏️ Límite máximo', 'edit_field_max_amount')],
-        [Markup.button.callback('◀ Cancelar', 'admin_panel')]
-    ];
-    await ctx.reply(
+    await replyAndAnswer(ctx, 
         `✏️ Editando método <b>${escapeHTML(method.name)}</b> (ID: ${methodId})\n\n` +
         `Valores actuales:\n` +
         `📛 Nombre: ${escapeHTML(method.name)}\n` +
@@ -1382,180 +1779,170 @@ bot.action(/edit_wit_(\d+)/, async (ctx) => {
         `📉 Mín: ${method.min_amount !== null ? method.min_amount : '-'}\n` +
         `📈 Máx: ${method.max_amount !== null ? method.max_amount : '-'}\n\n` +
         `¿Qué campo deseas modificar?`,
-        Markup.inlineKeyboard(buttons)
+        EDIT_FIELD_KBD
     );
-    await ctx.answerCbQuery();
-});
+}));
 
-bot.action('edit_field_name', async (ctx) => {
+onCallback('edit_field_name', adminOnly(async (ctx) => {
     ctx.session.editField = 'name';
     ctx.session.adminAction = 'edit_method';
     ctx.session.editStep = 'awaiting_value';
-    await ctx.reply('✏️ Envía el <b>nuevo nombre</b> del método:');
-    await ctx.answerCbQuery();
-});
+    await replyAndAnswer(ctx, '✏️ Envía el <b>nuevo nombre</b> del método:');
+}));
 
-bot.action('edit_field_currency', async (ctx) => {
+onCallback('edit_field_currency', adminOnly(async (ctx) => {
     ctx.session.editField = 'currency';
     ctx.session.adminAction = 'edit_method';
     ctx.session.editStep = 'awaiting_value';
-    await ctx.reply('✏️ Envía la <b>nueva moneda</b> (CUP, USD, USDT, TRX, MLC):');
-    await ctx.answerCbQuery();
-});
+    await replyAndAnswer(ctx, '✏️ Envía la <b>nueva moneda</b> (CUP, USD, USDT, TRX, MLC):');
+}));
 
-bot.action('edit_field_card', async (ctx) => {
+onCallback('edit_field_card', adminOnly(async (ctx) => {
     ctx.session.editField = 'card';
     ctx.session.adminAction = 'edit_method';
     ctx.session.editStep = 'awaiting_value';
-    await ctx.reply('✏️ Envía el <b>nuevo dato</b> (número de cuenta, dirección wallet, etc.):');
-    await ctx.answerCbQuery();
-});
+    await replyAndAnswer(ctx, '✏️ Envía el <b>nuevo dato</b> (número de cuenta, dirección wallet, etc.):');
+}));
 
-bot.action('edit_field_confirm', async (ctx) => {
+onCallback('edit_field_confirm', adminOnly(async (ctx) => {
     ctx.session.editField = 'confirm';
     ctx.session.adminAction = 'edit_method';
     ctx.session.editStep = 'awaiting_value';
-    await ctx.reply('✏️ Envía el <b>nuevo dato de confirmación / red sugerida</b> (para cripto, la red; para otros, número a confirmar):');
-    await ctx.answerCbQuery();
-});
+    await replyAndAnswer(ctx, '✏️ Envía el <b>nuevo dato de confirmación / red sugerida</b> (para cripto, la red; para otros, número a confirmar):');
+}));
 
-bot.action('edit_field_min_amount', async (ctx) => {
+onCallback('edit_field_min_amount', adminOnly(async (ctx) => {
     ctx.session.editField = 'min_amount';
     ctx.session.adminAction = 'edit_method';
     ctx.session.editStep = 'awaiting_value';
-    await ctx.reply('✏️ Envía el <b>nuevo límite mínimo</b> (0 = sin límite):');
-    await ctx.answerCbQuery();
-});
+    await replyAndAnswer(ctx, '✏️ Envía el <b>nuevo límite mínimo</b> (0 = sin límite):');
+}));
 
-bot.action('edit_field_max_amount', async (ctx) => {
+onCallback('edit_field_max_amount', adminOnly(async (ctx) => {
     ctx.session.editField = 'max_amount';
     ctx.session.adminAction = 'edit_method';
     ctx.session.editStep = 'awaiting_value';
-    await ctx.reply('✏️ Envía el <b>nuevo límite máximo</b> (0 = sin límite):');
-    await ctx.answerCbQuery();
-});
+    await replyAndAnswer(ctx, '✏️ Envía el <b>nuevo límite máximo</b> (0 = sin límite):');
+}));
+
+// Elegir un método en la lista de eliminar solo pide confirmación; el borrado
+// lo hace confirm_delete_*_N, que únicamente envía este mensaje.
+function confirmDeleteMethod(table, prefix, label) {
+    return adminOnly(async (ctx) => {
+        const method = await getMethod(table, ctx.match[1]);
+        if (!method) {
+            await ctx.answerCbQuery('Método no encontrado', { show_alert: true });
+            return;
+        }
+        await replyAndAnswer(ctx,
+            `🗑 ¿Seguro que quieres eliminar el método de ${label} <b>${escapeHTML(method.name)}</b>?`,
+            Markup.inlineKeyboard([
+                [Markup.button.callback('✅ Sí, eliminar', `${prefix}${method.id}`)],
+                [Markup.button.callback('◀ Cancelar', 'admin_panel')]
+            ])
+        );
+    });
+}
+
+bot.action(/^delete_dep_(\d+)$/, confirmDeleteMethod('deposit_methods', 'confirm_delete_dep_', 'DEPÓSITO'));
+bot.action(/^delete_wit_(\d+)$/, confirmDeleteMethod('withdraw_methods', 'confirm_delete_wit_', 'RETIRO'));
 
-bot.action(/confirm_delete_dep_(\d+)/, async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+bot.action(/^confirm_delete_dep_(\d+)$/, adminOnly(async (ctx) => {
     const methodId = parseInt(ctx.match[1]);
     const { error } = await supabase.from('deposit_methods').delete().eq('id', methodId);
+    invalidateCache('deposit_methods');
     if (error) {
-        await ctx.reply(`❌ Error al eliminar: ${error.message}`);
+        await replyHtml(ctx, `❌ Error al eliminar: ${escapeHTML(error.message)}`);
     } else {
         await ctx.reply('✅ Método de DEPÓSITO eliminado correctamente.');
     }
     await ctx.answerCbQuery();
-    await safeEdit(ctx, '🔧 <b>Panel de administración</b>', adminPanelKbd());
-});
+    await safeEdit(ctx, '🔧 <b>Panel de administración</b>', ADMIN_PANEL_KBD);
+}));
 
-bot.action(/confirm_delete_wit_(\d+)/, async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+bot.action(/^confirm_delete_wit_(\d+)$/, adminOnly(async (ctx) => {
     const methodId = parseInt(ctx.match[1]);
     const { error } = await supabase.from('withdraw_methods').delete().eq('id', methodId);
+    invalidateCache('withdraw_methods');
     if (error) {
-        await ctx.reply(`❌ Error al eliminar: ${error.message}`);
+        await replyHtml(ctx, `❌ Error al eliminar: ${escapeHTML(error.message)}`);
     } else {
         await ctx.reply('✅ Método de RETIRO eliminado correctamente.');
     }
     await ctx.answerCbQuery();
-    await safeEdit(ctx, '🔧 <b>Panel de administración</b>', adminPanelKbd());
-});
+    await safeEdit(ctx, '🔧 <b>Panel de administración</b>', ADMIN_PANEL_KBD);
+}));
 
-bot.action('adm_set_rate_usd', async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+onCallback('adm_set_rate_usd', adminOnly(async (ctx) => {
     const rate = await getExchangeRateUSD();
     ctx.session.adminAction = 'set_rate_usd';
-    await ctx.reply(`💰 <b>Tasa USD/CUP actual:</b> 1 USD = ${rate} CUP\n\nEnvía la nueva tasa (solo número, ej: 120):`, { parse_mode: 'HTML' });
-    await ctx.answerCbQuery();
-});
+    await replyAndAnswer(ctx, `💰 <b>Tasa USD/CUP actual:</b> 1 USD = ${rate} CUP\n\nEnvía la nueva tasa (solo número, ej: 120):`);
+}));
 
-bot.action('adm_set_rate_usdt', async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+onCallback('adm_set_rate_usdt', adminOnly(async (ctx) => {
     const rate = await getExchangeRateUSDT();
     ctx.session.adminAction = 'set_rate_usdt';
-    await ctx.reply(`💰 <b>Tasa USDT/CUP actual:</b> 1 USDT = ${rate} CUP\n\nEnvía la nueva tasa (solo número, ej: 110):`, { parse_mode: 'HTML' });
-    await ctx.answerCbQuery();
-});
+    await replyAndAnswer(ctx, `💰 <b>Tasa USDT/CUP actual:</b> 1 USDT = ${rate} CUP\n\nEnvía la nueva tasa (solo número, ej: 110):`);
+}));
 
-bot.action('adm_set_rate_trx', async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+onCallback('adm_set_rate_trx', adminOnly(async (ctx) => {
     const rate = await getExchangeRateTRX();
     ctx.session.adminAction = 'set_rate_trx';
-    await ctx.reply(`💰 <b>Tasa TRX/CUP actual:</b> 1 TRX = ${rate} CUP\n\nEnvía la nueva tasa (solo número, ej: 1.5):`, { parse_mode: 'HTML' });
-    await ctx.answerCbQuery();
-});
+    await replyAndAnswer(ctx, `💰 <b>Tasa TRX/CUP actual:</b> 1 TRX = ${rate} CUP\n\nEnvía la nueva tasa (solo número, ej: 1.5):`);
+}));
 
-bot.action('adm_min_deposit', async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+onCallback('adm_min_deposit', adminOnly(async (ctx) => {
     const current = await getMinDepositUSD();
     ctx.session.adminAction = 'set_min_deposit';
-    await ctx.reply(`💰 <b>Mínimo de depósito actual:</b> ${current} USD (equivale a ${(current * await getExchangeRateUSD()).toFixed(2)} CUP)\n\nEnvía el nuevo mínimo en USD (solo número, ej: 5):`, { parse_mode: 'HTML' });
-    await ctx.answerCbQuery();
-});
+    await replyAndAnswer(ctx, `💰 <b>Mínimo de depósito actual:</b> ${current} USD (equivale a ${(current * await getExchangeRateUSD()).toFixed(2)} CUP)\n\nEnvía el nuevo mínimo en USD (solo número, ej: 5):`);
+}));
 
-bot.action('adm_min_withdraw', async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+onCallback('adm_min_withdraw', adminOnly(async (ctx) => {
     const current = await getMinWithdrawUSD();
     const rate = await getExchangeRateUSD();
     ctx.session.adminAction = 'set_min_withdraw';
-    await ctx.reply(`💰 <b>Mínimo de retiro actual:</b> ${current} USD (equivale a ${(current * rate).toFixed(2)} CUP)\n\nEnvía el nuevo mínimo en USD (solo número, ej: 2):`, { parse_mode: 'HTML' });
-    await ctx.answerCbQuery();
-});
+    await replyAndAnswer(ctx, `💰 <b>Mínimo de retiro actual:</b> ${current} USD (equivale a ${(current * rate).toFixed(2)} CUP)\n\nEnvía el nuevo mínimo en USD (solo número, ej: 2):`);
+}));
 
-bot.action('adm_set_prices', async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
-    const { data: prices } = await supabase.from('play_prices').select('*');
-    const buttons = prices.map(p => [Markup.button.callback(p.bet_type, `set_price_${p.bet_type}`)]);
-    buttons.push([Markup.button.callback('◀ Cancelar', 'admin_panel')]);
-    await ctx.reply('🎲 <b>Configurar precios y pagos</b>\nElige el tipo de jugada que deseas modificar:', Markup.inlineKeyboard(buttons));
-    await ctx.answerCbQuery();
-});
+onCallback('adm_set_prices', adminOnly(async (ctx) => {
+    await replyAndAnswer(ctx, '🎲 <b>Configurar precios y pagos</b>\nElige el tipo de jugada que deseas modificar:', SET_PRICE_KBD);
+}));
 
-bot.action(/set_price_(.+)/, async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+bot.action(/^set_price_(.+)$/, adminOnly(async (ctx) => {
     const betType = ctx.match[1];
     ctx.session.adminAction = 'set_price';
     ctx.session.betType = betType;
     ctx.session.priceStep = 1;
-    await ctx.reply(
+    await replyAndAnswer(ctx, 
         `⚙️ Configurando precios para <b>${betType}</b>\n\n` +
-        `Paso 1/3: Ingresa el multiplicador de premio (ej: 500):`,
-        { parse_mode: 'HTML' }
+        `Paso 1/3: Ingresa el multiplicador de premio (ej: 500):`
     );
-    await ctx.answerCbQuery();
-});
+}));
 
-bot.action('adm_min_per_bet', async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
-    const { data: prices } = await supabase.from('play_prices').select('*');
-    const buttons = prices.map(p => [Markup.button.callback(p.bet_type, `set_min_${p.bet_type}`)]);
-    buttons.push([Markup.button.callback('◀ Cancelar', 'admin_panel')]);
-    await ctx.reply('💰 <b>Configurar montos mínimos y máximos por jugada</b>\nElige el tipo de jugada:', Markup.inlineKeyboard(buttons));
-    await ctx.answerCbQuery();
-});
+onCallback('adm_min_per_bet', adminOnly(async (ctx) => {
+    await replyAndAnswer(ctx, '💰 <b>Configurar montos mínimos y máximos por jugada</b>\nElige el tipo de jugada:', SET_MIN_KBD);
+}));
 
-bot.action(/set_min_(.+)/, async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+bot.action(/^set_min_(.+)$/, adminOnly(async (ctx) => {
     const betType = ctx.match[1];
     ctx.session.adminAction = 'set_min';
     ctx.session.betType = betType;
     ctx.session.minStep = 1;
-    await ctx.reply(
+    await replyAndAnswer(ctx, 
         `⚙️ Configurando límites para <b>${betType}</b>\n\n` +
-        `Paso 1/4: Ingresa el <b>monto mínimo en CUP</b> (0 = sin mínimo):`,
-        { parse_mode: 'HTML' }
+        `Paso 1/4: Ingresa el <b>monto mínimo en CUP</b> (0 = sin mínimo):`
     );
-    await ctx.answerCbQuery();
-});
-
-bot.action('adm_view', async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
-    const rates = await getExchangeRates();
-    const minDep = await getMinDepositUSD();
-    const minWit = await getMinWithdrawUSD();
-    const { data: depMethods } = await supabase.from('deposit_methods').select('*');
-    const { data: witMethods } = await supabase.from('withdraw_methods').select('*');
-    const { data: prices } = await supabase.from('play_prices').select('*');
+}));
+
+onCallback('adm_view', adminOnly(async (ctx) => {
+    const {
+        rates,
+        minDeposit: minDep,
+        minWithdraw: minWit,
+        depositMethods: depMethods,
+        withdrawMethods: witMethods,
+        prices
+    } = await getAdminDashboard();
 
     let text = `💰 <b>Tasas de cambio:</b>\n`;
     text += `USD/CUP: 1 USD = ${rates.rate} CUP\n`;
@@ -1572,15 +1959,13 @@ bot.action('adm_view', async (ctx) => {
         `  ${p.bet_type}: Pago x${p.payout_multiplier || 0}  |  Mín: ${p.min_cup||0} CUP / ${p.min_usd||0} USD  |  Máx: ${p.max_cup||'∞'} CUP / ${p.max_usd||'∞'} USD\n`
     );
 
-    await safeEdit(ctx, text, Markup.inlineKeyboard([[Markup.button.callback('◀ Volver a Admin', 'admin_panel')]]));
-});
-
-bot.action('admin_winning', async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+    await safeEdit(ctx, text, BACK_ADMIN_KBD);
+}));
 
+onCallback('admin_winning', adminOnly(async (ctx) => {
     const { data: closedSessions } = await supabase
         .from('lottery_sessions')
-        .select('*')
+        .select('id, lottery, date, time_slot')
         .eq('status', 'closed')
         .order('date', { ascending: false });
 
@@ -1608,27 +1993,23 @@ bot.action('admin_winning', async (ctx) => {
     });
     buttons.push([Markup.button.callback('◀ Cancelar', 'admin_panel')]);
 
-    await ctx.reply('🔢 <b>Publicar números ganadores</b>\nSelecciona la sesión para la cual deseas ingresar el número ganador:', Markup.inlineKeyboard(buttons));
-    await ctx.answerCbQuery();
-});
+    await replyAndAnswer(ctx, '🔢 <b>Publicar números ganadores</b>\nSelecciona la sesión para la cual deseas ingresar el número ganador:', Markup.inlineKeyboard(buttons));
+}));
 
-bot.action(/publish_win_(\d+)/, async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
+bot.action(/^publish_win_(\d+)$/, adminOnly(async (ctx) => {
     const sessionId = parseInt(ctx.match[1]);
     ctx.session.winningSessionId = sessionId;
     ctx.session.adminAction = 'winning_numbers';
-    await ctx.reply(
+    await replyAndAnswer(ctx, 
         '✍️ <b>Ingresa el número ganador de 7 DÍGITOS</b>\n' +
         'Formato: centena (3) + cuarteta (4). Ejemplo: <code>5173262</code> o <code>517 3262</code>\n\n' +
         'Se desglosará automáticamente en:\n' +
         '• Centena: primeros 3 dígitos\n' +
         '• Fijo: últimos 2 de la centena\n' +
         '• Corridos: fijo, primeros 2 de cuarteta, últimos 2 de cuarteta\n' +
-        '• Parles: combinaciones de los corridos',
-        { parse_mode: 'HTML' }
+        '• Parles: combinaciones de los corridos'
     );
-    await ctx.answerCbQuery();
-});
+}));
 
 function formatWinningNumber(num) {
     if (!num || num.length !== 7) return num;
@@ -1644,7 +2025,7 @@ async function processWinningNumber(sessionId, winningStr, ctx) {
 
     const { data: session } = await supabase
         .from('lottery_sessions')
-        .select('*')
+        .select('lottery, date, time_slot')
         .eq('id', sessionId)
         .single();
 
@@ -1691,31 +2072,27 @@ async function processWinningNumber(sessionId, winningStr, ctx) {
         });
 
     if (insertError) {
-        await ctx.reply(`❌ Error al guardar: ${insertError.message}`);
+        await replyHtml(ctx, `❌ Error al guardar: ${escapeHTML(insertError.message)}`);
         return false;
     }
 
-    const { data: multipliers } = await supabase
-        .from('play_prices')
-        .select('bet_type, payout_multiplier');
+    const multipliers = await getPlayPrices();
 
     const multiplierMap = {};
     multipliers.forEach(m => { multiplierMap[m.bet_type] = parseFloat(m.payout_multiplier) || 0; });
 
     const { data: bets } = await supabase
         .from('bets')
-        .select('*')
+        .select('id, user_id, bet_type, items')
         .eq('session_id', sessionId);
 
     const rates = await getExchangeRates();
     const formattedWinning = formatWinningNumber(winningStr);
+    // Jugadas ganadoras cuyo premio no se pudo acreditar: el bucle sigue con el
+    // resto y al final se avisa al admin para que las revise a mano.
+    const unpaidBets = [];
 
     for (const bet of bets || []) {
-        const { data: userBefore } = await supabase
-            .from('users')
-            .select('usd, cup, bonus_cup')
-            .eq('telegram_id', bet.user_id)
-            .single();
 
         let premioTotalUSD = 0;
         let premioTotalCUP = 0;
@@ -1756,36 +2133,40 @@ async function processWinningNumber(sessionId, winningStr, ctx) {
         }
 
         if (premioTotalUSD > 0 || premioTotalCUP > 0) {
-            let newUsd = parseFloat(userBefore.usd) + premioTotalUSD;
-            let newCup = parseFloat(userBefore.cup) + premioTotalCUP;
-
-            await supabase
-                .from('users')
-                .update({ usd: newUsd, cup: newCup, updated_at: new Date() })
-                .eq('telegram_id', bet.user_id);
+            let userAfter = null;
+            try {
+                userAfter = await adjustBalance(bet.user_id, { usd: premioTotalUSD, cup: premioTotalCUP });
+            } catch (e) {
+                console.error(`Error acreditando el premio de la jugada ${bet.id}:`, e.message);
+            }
+            if (!userAfter) {
+                console.error(`No se pudo acreditar el premio de la jugada ${bet.id} al usuario ${bet.user_id}`);
+                unpaidBets.push(bet.id);
+                continue;
+            }
+            const newUsd = parseFloat(userAfter.usd) || 0;
+            const newCup = parseFloat(userAfter.cup) || 0;
 
             const usdEquivalentCup = (premioTotalUSD * rates.rate).toFixed(2);
             const cupEquivalentUsd = (premioTotalCUP / rates.rate).toFixed(2);
-            await bot.telegram.sendMessage(bet.user_id,
+            await sendHtml(bot.telegram, bet.user_id,
                 `🎉 <b>¡FELICIDADES! Has ganado</b>\n\n` +
                 `🔢 Número ganador: <code>${formattedWinning}</code>\n` +
                 `🎰 ${regionMap[session.lottery]?.emoji || '🎰'} ${escapeHTML(session.lottery)} - ${escapeHTML(session.time_slot)}\n` +
                 `💰 Premio: ${premioTotalCUP.toFixed(2)} CUP / ${premioTotalUSD.toFixed(2)} USD\n` +
                 (premioTotalCUP > 0 ? `   (equivale a ${cupEquivalentUsd} USD aprox.)\n` : '') +
                 (premioTotalUSD > 0 ? `   (equivale a ${usdEquivalentCup} CUP aprox.)\n` : '') +
-                `\n📊 <b>Saldo anterior:</b> ${parseFloat(userBefore.cup).toFixed(2)} CUP / ${parseFloat(userBefore.usd).toFixed(2)} USD\n` +
+                `\n📊 <b>Saldo anterior:</b> ${(newCup - premioTotalCUP).toFixed(2)} CUP / ${(newUsd - premioTotalUSD).toFixed(2)} USD\n` +
                 `📊 <b>Saldo actual:</b> ${newCup.toFixed(2)} CUP / ${newUsd.toFixed(2)} USD\n\n` +
-                `✅ El premio ya fue acreditado a tu saldo. ¡Sigue disfrutando!`,
-                { parse_mode: 'HTML' }
-            );
+                `✅ El premio ya fue acreditado a tu saldo. ¡Sigue disfrutando!`
+            ).catch(e => logNotifyError('premio a usuario', e));
         } else {
-            await bot.telegram.sendMessage(bet.user_id,
+            await sendHtml(bot.telegram, bet.user_id,
                 `🔢 <b>Números ganadores de ${regionMap[session.lottery]?.emoji || '🎰'} ${escapeHTML(session.lottery)} (${session.date} - ${escapeHTML(session.time_slot)})</b>\n\n` +
                 `Número: <code>${formattedWinning}</code>\n\n` +
                 `😔 Esta vez no has ganado, pero no te desanimes. ¡Sigue intentando y la suerte llegará!\n\n` +
-                `🍀 ¡Mucha suerte en la próxima!`,
-                { parse_mode: 'HTML' }
-            );
+                `🍀 ¡Mucha suerte en la próxima!`
+            ).catch(e => logNotifyError('resultado a usuario', e));
         }
     }
 
@@ -1797,22 +2178,26 @@ async function processWinningNumber(sessionId, winningStr, ctx) {
         `💬 Revisa tu historial para ver si has ganado. ¡Mucha suerte en las próximas jugadas!`
     );
 
+    if (unpaidBets.length > 0) {
+        await replyHtml(ctx,
+            `⚠️ Números publicados, pero <b>${unpaidBets.length}</b> premio(s) no se pudieron acreditar.\n` +
+            `Jugadas sin pagar (id): <code>${unpaidBets.join(', ')}</code>\n` +
+            `Revisa los logs y acredítalas manualmente.`
+        );
+        return true;
+    }
+
     await ctx.reply(`✅ Números ganadores publicados y premios calculados correctamente.`);
     return true;
 }
 
 // ========== SISTEMA DE SOPORTE ==========
 // Acción para que un admin responda a un usuario
-bot.action(/support_reply_(\d+)/, async (ctx) => {
-    if (!isAdmin(ctx.from.id)) {
-        await ctx.answerCbQuery('⛔ No autorizado', { show_alert: true });
-        return;
-    }
+bot.action(/^support_reply_(\d+)$/, adminOnly(async (ctx) => {
     const userId = parseInt(ctx.match[1]);
     ctx.session.supportReplyTo = userId;
-    await ctx.reply(`✏️ Escribe ahora tu respuesta para el usuario. Se enviará cuando termines.`);
-    await ctx.answerCbQuery();
-});
+    await replyAndAnswer(ctx, `✏️ Escribe ahora tu respuesta para el usuario. Se enviará cuando termines.`);
+}));
 
 // ========== MANEJADOR DE TEXTO PRINCIPAL ==========
 bot.on(message('text'), async (ctx) => {
@@ -1820,14 +2205,17 @@ bot.on(message('text'), async (ctx) => {
     const text = ctx.message.text.trim();
     const session = ctx.session;
     const user = ctx.dbUser;
+    // Para un usuario normal queda undefined: los flujos de admin de abajo se
+    // descartan con una sola comparación, sin volver a consultar isAdmin.
+    const isAdminUser = isAdmin(uid);
+    const adminAction = isAdminUser ? session.adminAction : undefined;
 
     // 1. Verificar si es un admin respondiendo a un usuario
-    if (isAdmin(uid) && session.supportReplyTo) {
+    if (isAdminUser && session.supportReplyTo) {
         const targetUserId = session.supportReplyTo;
         try {
-            await bot.telegram.sendMessage(targetUserId,
-                `📨 <b>Respuesta de soporte:</b>\n\n${escapeHTML(text)}`,
-                { parse_mode: 'HTML' }
+            await sendHtml(bot.telegram, targetUserId,
+                `📨 <b>Respuesta de soporte:</b>\n\n${escapeHTML(text)}`
             );
             await ctx.reply('✅ Respuesta enviada al usuario.');
         } catch (e) {
@@ -1838,10 +2226,9 @@ bot.on(message('text'), async (ctx) => {
     }
 
     // 2. Verificar si es un botón del menú principal
-    const mainButtons = ['🎲 Jugar', '💰 Mi dinero', '📋 Mis jugadas', '👥 Referidos', '❓ Cómo jugar', '🌐 Abrir WebApp', '🔧 Admin'];
-    if (mainButtons.includes(text)) {
+    if (MAIN_BUTTONS.has(text)) {
         if (text === '🎲 Jugar') {
-            await safeEdit(ctx, '🎲 Por favor, selecciona una lotería para comenzar a jugar:', playLotteryKbd());
+            await safeEdit(ctx, '🎲 Por favor, selecciona una lotería para comenzar a jugar:', PLAY_LOTTERY_KBD);
             return;
         } else if (text === '💰 Mi dinero') {
             const user = ctx.dbUser;
@@ -1857,16 +2244,11 @@ bot.on(message('text'), async (ctx) => {
                 `💵 <b>USD:</b> ${usd.toFixed(2)} (aprox. ${usdToCup} CUP)\n` +
                 `🎁 <b>Bono (no retirable):</b> ${bonusCup.toFixed(2)} CUP\n\n` +
                 `¿Qué deseas hacer?`;
-            await safeEdit(ctx, text, myMoneyKbd());
+            await safeEdit(ctx, text, MY_MONEY_KBD);
             return;
         } else if (text === '📋 Mis jugadas') {
             const uid = ctx.from.id;
-            const { data: bets } = await supabase
-                .from('bets')
-                .select('*')
-                .eq('user_id', uid)
-                .order('placed_at', { ascending: false })
-                .limit(5);
+            const bets = await getRecentBets(uid);
 
             if (!bets || bets.length === 0) {
                 await safeEdit(ctx,
@@ -1875,27 +2257,14 @@ bot.on(message('text'), async (ctx) => {
                     getMainKeyboard(ctx)
                 );
             } else {
-                let text = '📋 <b>Tus últimas 5 jugadas:</b>\n\n';
-                bets.forEach((b, i) => {
-                    const date = moment(b.placed_at).tz(TIMEZONE).format('DD/MM/YYYY HH:mm');
-                    text += `<b>${i + 1}.</b> 🎰 ${escapeHTML(b.lottery)} - ${escapeHTML(b.bet_type)}\n` +
-                        `   📝 <code>${escapeHTML(b.raw_text)}</code>\n` +
-                        `   💰 ${b.cost_cup} CUP / ${b.cost_usd} USD\n` +
-                        `   🕒 ${date}\n\n`;
-                });
-                text += '¿Quieres ver más? Puedes consultar el historial completo en la WebApp.';
-                await safeEdit(ctx, text, getMainKeyboard(ctx));
+                await safeEdit(ctx, formatBetsHistory(bets), getMainKeyboard(ctx));
             }
             return;
         } else if (text === '👥 Referidos') {
             const uid = ctx.from.id;
-            const { count } = await supabase
-                .from('users')
-                .select('*', { count: 'exact', head: true })
-                .eq('ref_by', uid);
+            const count = await countReferrals(uid);
 
-            const botInfo = await ctx.telegram.getMe();
-            const link = `https://t.me/${botInfo.username}?start=${uid}`;
+            const link = `https://t.me/${ctx.botInfo.username}?start=${uid}`;
 
             await safeEdit(ctx,
                 `💸 <b>¡GANA DINERO EXTRA INVITANDO AMIGOS! 💰</b>\n\n` +
@@ -1914,32 +2283,24 @@ bot.on(message('text'), async (ctx) => {
             );
             return;
         } else if (text === '❓ Cómo jugar') {
-            await safeEdit(ctx,
-                '📩 <b>¿Necesitas ayuda?</b>\n\n' +
-                'Puedes escribirnos directamente en este chat. Tu mensaje será recibido por nuestro equipo de soporte y te responderemos a la mayor brevedad.\n\n' +
-                'También puedes consultar la sección de preguntas frecuentes en nuestra WebApp.',
-                Markup.inlineKeyboard([[Markup.button.callback('◀ Volver al inicio', 'main')]])
-            );
+            await safeEdit(ctx, HELP_TEXT, BACK_MAIN_KBD);
             return;
         } else if (text === '🌐 Abrir WebApp') {
-            const webAppButton = Markup.inlineKeyboard([
-                Markup.button.webApp('🚀 Abrir WebApp', `${WEBAPP_URL}/app.html`)
-            ]);
-            await ctx.reply('Haz clic en el botón para acceder a nuestra plataforma web interactiva:', webAppButton);
+            await ctx.reply(WEBAPP_TEXT, WEBAPP_KBD);
             return;
-        } else if (text === '🔧 Admin' && isAdmin(uid)) {
-            await safeEdit(ctx, '🔧 <b>Panel de administración</b>\nSelecciona una opción:', adminPanelKbd());
+        } else if (text === '🔧 Admin' && isAdminUser) {
+            await safeEdit(ctx, ADMIN_PANEL_TEXT, ADMIN_PANEL_KBD);
             return;
         }
     }
 
     // 3. Manejo de flujos existentes (apuestas, depósitos, etc.)
     // --- Admin: añadir método depósito ---
-    if (isAdmin(uid) && session.adminAction === 'add_dep') {
+    if (adminAction === 'add_dep') {
         if (session.adminStep === 1) {
             session.adminTempName = text;
             session.adminStep = 2;
-            await ctx.reply('Paso 2/4: Ahora envía la <b>moneda</b> del método (CUP, USD, USDT, TRX, MLC):', { parse_mode: 'HTML' });
+            await replyHtml(ctx, 'Paso 2/4: Ahora envía la <b>moneda</b> del método (CUP, USD, USDT, TRX, MLC):');
             return;
         } else if (session.adminStep === 2) {
             const currency = text.toUpperCase();
@@ -1949,12 +2310,12 @@ bot.on(message('text'), async (ctx) => {
             }
             session.adminTempCurrency = currency;
             session.adminStep = 3;
-            await ctx.reply('Paso 3/4: Ahora envía el <b>dato principal</b> (número de cuenta, dirección wallet, etc.):', { parse_mode: 'HTML' });
+            await replyHtml(ctx, 'Paso 3/4: Ahora envía el <b>dato principal</b> (número de cuenta, dirección wallet, etc.):');
             return;
         } else if (session.adminStep === 3) {
             session.adminTempCard = text;
             session.adminStep = 4;
-            await ctx.reply('Paso 4/4: Finalmente, envía el <b>dato de confirmación / red sugerida</b> (para cripto, la red; para otros, número a confirmar):', { parse_mode: 'HTML' });
+            await replyHtml(ctx, 'Paso 4/4: Finalmente, envía el <b>dato de confirmación / red sugerida</b> (para cripto, la red; para otros, número a confirmar):');
             return;
         } else if (session.adminStep === 4) {
             const { data, error } = await supabase
@@ -1965,22 +2326,23 @@ bot.on(message('text'), async (ctx) => {
                     card: session.adminTempCard,
                     confirm: text
                 })
-                .select()
+                .select('id')
                 .single();
-            if (error) await ctx.reply(`❌ Error al añadir: ${error.message}`);
-            else await ctx.reply(`✅ Método de depósito <b>${escapeHTML(session.adminTempName)}</b> (${session.adminTempCurrency}) añadido correctamente con ID ${data.id}.`, { parse_mode: 'HTML' });
+            invalidateCache('deposit_methods');
+            if (error) await replyHtml(ctx, `❌ Error al añadir: ${escapeHTML(error.message)}`);
+            else await replyHtml(ctx, `✅ Método de depósito <b>${escapeHTML(session.adminTempName)}</b> (${session.adminTempCurrency}) añadido correctamente con ID ${data.id}.`);
             delete session.adminAction;
-            await safeEdit(ctx, '🔧 <b>Panel de administración</b>', adminPanelKbd());
+            await safeEdit(ctx, '🔧 <b>Panel de administración</b>', ADMIN_PANEL_KBD);
             return;
         }
     }
 
     // --- Admin: añadir método retiro ---
-    if (isAdmin(uid) && session.adminAction === 'add_wit') {
+    if (adminAction === 'add_wit') {
         if (session.adminStep === 1) {
             session.adminTempName = text;
             session.adminStep = 2;
-            await ctx.reply('Paso 2/4: Ahora envía la <b>moneda</b> del método (CUP, USD, USDT, TRX, MLC):', { parse_mode: 'HTML' });
+            await replyHtml(ctx, 'Paso 2/4: Ahora envía la <b>moneda</b> del método (CUP, USD, USDT, TRX, MLC):');
             return;
         } else if (session.adminStep === 2) {
             const currency = text.toUpperCase();
@@ -1990,12 +2352,12 @@ bot.on(message('text'), async (ctx) => {
             }
             session.adminTempCurrency = currency;
             session.adminStep = 3;
-            await ctx.reply('Paso 3/4: Ahora envía el <b>dato principal</b> (instrucciones, número de cuenta, etc.):', { parse_mode: 'HTML' });
+            await replyHtml(ctx, 'Paso 3/4: Ahora envía el <b>dato principal</b> (instrucciones, número de cuenta, etc.):');
             return;
         } else if (session.adminStep === 3) {
             session.adminTempCard = text;
             session.adminStep = 4;
-            await ctx.reply('Paso 4/4: Finalmente, envía el <b>dato de confirmación / red sugerida</b> (para cripto, la red; para otros, número a confirmar):', { parse_mode: 'HTML' });
+            await replyHtml(ctx, 'Paso 4/4: Finalmente, envía el <b>dato de confirmación / red sugerida</b> (para cripto, la red; para otros, número a confirmar):');
             return;
         } else if (session.adminStep === 4) {
             const { data, error } = await supabase
@@ -2006,18 +2368,19 @@ bot.on(message('text'), async (ctx) => {
                     card: session.adminTempCard,
                     confirm: text
                 })
-                .select()
+                .select('id')
                 .single();
-            if (error) await ctx.reply(`❌ Error al añadir: ${error.message}`);
-            else await ctx.reply(`✅ Método de retiro <b>${escapeHTML(session.adminTempName)}</b> (${session.adminTempCurrency}) añadido correctamente con ID ${data.id}.`, { parse_mode: 'HTML' });
+            invalidateCache('withdraw_methods');
+            if (error) await replyHtml(ctx, `❌ Error al añadir: ${escapeHTML(error.message)}`);
+            else await replyHtml(ctx, `✅ Método de retiro <b>${escapeHTML(session.adminTempName)}</b> (${session.adminTempCurrency}) añadido correctamente con ID ${data.id}.`);
             delete session.adminAction;
-            await safeEdit(ctx, '🔧 <b>Panel de administración</b>', adminPanelKbd());
+            await safeEdit(ctx, '🔧 <b>Panel de administración</b>', ADMIN_PANEL_KBD);
             return;
         }
     }
 
     // --- Admin: editar método (awaiting_value) ---
-    if (isAdmin(uid) && session.adminAction === 'edit_method' && session.editStep === 'awaiting_value') {
+    if (adminAction === 'edit_method' && session.editStep === 'awaiting_value') {
         const newValue = text;
         const methodId = session.editMethodId;
         const field = session.editField;
@@ -2026,8 +2389,8 @@ bot.on(message('text'), async (ctx) => {
 
         let updateValue;
         if (field === 'min_amount' || field === 'max_amount') {
-            const num = parseFloat(newValue);
-            if (isNaN(num) || num < 0) {
+            const num = parseAmount(newValue);
+            if (num === null || num < 0) {
                 await ctx.reply('❌ Valor inválido. Debe ser un número positivo o 0.');
                 return;
             }
@@ -2040,152 +2403,169 @@ bot.on(message('text'), async (ctx) => {
         updateData[field] = updateValue;
 
         const { error } = await supabase.from(table).update(updateData).eq('id', methodId);
+        invalidateCache(table);
         if (error) {
-            await ctx.reply(`❌ Error al actualizar: ${error.message}`);
+            await replyHtml(ctx, `❌ Error al actualizar: ${escapeHTML(error.message)}`);
         } else {
-            await ctx.reply(`✅ Campo <b>${field}</b> actualizado correctamente.`, { parse_mode: 'HTML' });
+            await replyHtml(ctx, `✅ Campo <b>${field}</b> actualizado correctamente.`);
         }
         delete session.adminAction;
         delete session.editMethodId;
         delete session.editMethodType;
         delete session.editStep;
         delete session.editField;
-        await safeEdit(ctx, '🔧 <b>Panel de administración</b>', adminPanelKbd());
+        await safeEdit(ctx, '🔧 <b>Panel de administración</b>', ADMIN_PANEL_KBD);
         return;
     }
 
     // --- Admin: configurar tasa USD ---
-    if (isAdmin(uid) && session.adminAction === 'set_rate_usd') {
-        const rate = parseFloat(text.replace(',', '.'));
-        if (isNaN(rate) || rate <= 0) {
+    if (adminAction === 'set_rate_usd') {
+        const rate = parseAmount(text);
+        if (rate === null || rate <= 0) {
             await ctx.reply('❌ Número inválido. Por favor, envía un número positivo (ej: 120).');
             return;
         }
-        await setExchangeRateUSD(rate);
-        await ctx.reply(`✅ Tasa USD/CUP actualizada: 1 USD = ${rate} CUP`, { parse_mode: 'HTML' });
+        const error = await setExchangeRateUSD(rate);
+        if (error) {
+            await replyHtml(ctx, `❌ Error al guardar: ${escapeHTML(error.message)}`);
+            return;
+        }
+        await ctx.reply(`✅ Tasa USD/CUP actualizada: 1 USD = ${rate} CUP`);
         delete session.adminAction;
-        await safeEdit(ctx, '🔧 <b>Panel de administración</b>', adminPanelKbd());
+        await safeEdit(ctx, '🔧 <b>Panel de administración</b>', ADMIN_PANEL_KBD);
         return;
     }
 
     // --- Admin: configurar tasa USDT ---
-    if (isAdmin(uid) && session.adminAction === 'set_rate_usdt') {
-        const rate = parseFloat(text.replace(',', '.'));
-        if (isNaN(rate) || rate <= 0) {
+    if (adminAction === 'set_rate_usdt') {
+        const rate = parseAmount(text);
+        if (rate === null || rate <= 0) {
             await ctx.reply('❌ Número inválido. Por favor, envía un número positivo (ej: 110).');
             return;
         }
-        await setExchangeRateUSDT(rate);
-        await ctx.reply(`✅ Tasa USDT/CUP actualizada: 1 USDT = ${rate} CUP`, { parse_mode: 'HTML' });
+        const error = await setExchangeRateUSDT(rate);
+        if (error) {
+            await replyHtml(ctx, `❌ Error al guardar: ${escapeHTML(error.message)}`);
+            return;
+        }
+        await ctx.reply(`✅ Tasa USDT/CUP actualizada: 1 USDT = ${rate} CUP`);
         delete session.adminAction;
-        await safeEdit(ctx, '🔧 <b>Panel de administración</b>', adminPanelKbd());
+        await safeEdit(ctx, '🔧 <b>Panel de administración</b>', ADMIN_PANEL_KBD);
         return;
     }
 
     // --- Admin: configurar tasa TRX ---
-    if (isAdmin(uid) && session.adminAction === 'set_rate_trx') {
-        const rate = parseFloat(text.replace(',', '.'));
-        if (isNaN(rate) || rate <= 0) {
+    if (adminAction === 'set_rate_trx') {
+        const rate = parseAmount(text);
+        if (rate === null || rate <= 0) {
             await ctx.reply('❌ Número inválido. Por favor, envía un número positivo (ej: 1.5).');
             return;
         }
-        await setExchangeRateTRX(rate);
-        await ctx.reply(`✅ Tasa TRX/CUP actualizada: 1 TRX = ${rate} CUP`, { parse_mode: 'HTML' });
+        const error = await setExchangeRateTRX(rate);
+        if (error) {
+            await replyHtml(ctx, `❌ Error al guardar: ${escapeHTML(error.message)}`);
+            return;
+        }
+        await ctx.reply(`✅ Tasa TRX/CUP actualizada: 1 TRX = ${rate} CUP`);
         delete session.adminAction;
-        await safeEdit(ctx, '🔧 <b>Panel de administración</b>', adminPanelKbd());
+        await safeEdit(ctx, '🔧 <b>Panel de administración</b>', ADMIN_PANEL_KBD);
         return;
     }
 
     // --- Admin: configurar mínimo depósito ---
-    if (isAdmin(uid) && session.adminAction === 'set_min_deposit') {
-        const value = parseFloat(text.replace(',', '.'));
-        if (isNaN(value) || value <= 0) {
+    if (adminAction === 'set_min_deposit') {
+        const value = parseAmount(text);
+        if (value === null || value <= 0) {
             await ctx.reply('❌ Número inválido. Envía un número positivo (ej: 5).');
             return;
         }
-        await setMinDepositUSD(value);
-        await ctx.reply(`✅ Mínimo de depósito actualizado a: ${value} USD (equivale a ${(value * await getExchangeRateUSD()).toFixed(2)} CUP)`, { parse_mode: 'HTML' });
+        const error = await setMinDepositUSD(value);
+        if (error) {
+            await replyHtml(ctx, `❌ Error al guardar: ${escapeHTML(error.message)}`);
+            return;
+        }
+        await ctx.reply(`✅ Mínimo de depósito actualizado a: ${value} USD (equivale a ${(value * await getExchangeRateUSD()).toFixed(2)} CUP)`);
         delete session.adminAction;
-        await safeEdit(ctx, '🔧 <b>Panel de administración</b>', adminPanelKbd());
+        await safeEdit(ctx, '🔧 <b>Panel de administración</b>', ADMIN_PANEL_KBD);
         return;
     }
 
     // --- Admin: configurar mínimo retiro ---
-    if (isAdmin(uid) && session.adminAction === 'set_min_withdraw') {
-        const value = parseFloat(text.replace(',', '.'));
-        if (isNaN(value) || value <= 0) {
+    if (adminAction === 'set_min_withdraw') {
+        const value = parseAmount(text);
+        if (value === null || value <= 0) {
             await ctx.reply('❌ Número inválido. Envía un número positivo (ej: 2).');
             return;
         }
-        await setMinWithdrawUSD(value);
-        await ctx.reply(`✅ Mínimo de retiro actualizado a: ${value} USD (equivale a ${(value * await getExchangeRateUSD()).toFixed(2)} CUP)`, { parse_mode: 'HTML' });
+        const error = await setMinWithdrawUSD(value);
+        if (error) {
+            await replyHtml(ctx, `❌ Error al guardar: ${escapeHTML(error.message)}`);
+            return;
+        }
+        await ctx.reply(`✅ Mínimo de retiro actualizado a: ${value} USD (equivale a ${(value * await getExchangeRateUSD()).toFixed(2)} CUP)`);
         delete session.adminAction;
-        await safeEdit(ctx, '🔧 <b>Panel de administración</b>', adminPanelKbd());
+        await safeEdit(ctx, '🔧 <b>Panel de administración</b>', ADMIN_PANEL_KBD);
         return;
     }
 
     // --- Admin: configurar precios (set_price) ---
-    if (isAdmin(uid) && session.adminAction === 'set_price') {
+    if (adminAction === 'set_price') {
         if (session.priceStep === 1) {
-            const multiplier = parseFloat(text.replace(',', '.'));
-            if (isNaN(multiplier) || multiplier < 0) {
+            const multiplier = parseAmount(text);
+            if (multiplier === null || multiplier < 0) {
                 await ctx.reply('❌ Multiplicador inválido. Debe ser un número positivo.');
                 return;
             }
             session.priceTempMultiplier = multiplier;
             session.priceStep = 2;
-            await ctx.reply(
-                `Paso 2/3: Ingresa el <b>monto mínimo en CUP</b> (0 = sin mínimo):`,
-                { parse_mode: 'HTML' }
+            await replyHtml(ctx,
+                `Paso 2/3: Ingresa el <b>monto mínimo en CUP</b> (0 = sin mínimo):`
             );
             return;
         } else if (session.priceStep === 2) {
-            const minCup = parseFloat(text.replace(',', '.'));
-            if (isNaN(minCup) || minCup < 0) {
+            const minCup = parseAmount(text);
+            if (minCup === null || minCup < 0) {
                 await ctx.reply('❌ Monto inválido. Debe ser un número positivo o 0.');
                 return;
             }
             session.priceTempMinCup = minCup;
             session.priceStep = 3;
-            await ctx.reply(
-                `Paso 3/3: Ingresa el <b>monto mínimo en USD</b> (0 = sin mínimo):`,
-                { parse_mode: 'HTML' }
+            await replyHtml(ctx,
+                `Paso 3/3: Ingresa el <b>monto mínimo en USD</b> (0 = sin mínimo):`
             );
             return;
         } else if (session.priceStep === 3) {
-            const minUsd = parseFloat(text.replace(',', '.'));
-            if (isNaN(minUsd) || minUsd < 0) {
+            const minUsd = parseAmount(text);
+            if (minUsd === null || minUsd < 0) {
                 await ctx.reply('❌ Monto inválido. Debe ser un número positivo o 0.');
                 return;
             }
             session.priceTempMinUsd = minUsd;
             session.priceStep = 4;
-            await ctx.reply(
-                `Paso 4/4: Ingresa el <b>monto máximo en CUP</b> (0 = sin límite):`,
-                { parse_mode: 'HTML' }
+            await replyHtml(ctx,
+                `Paso 4/4: Ingresa el <b>monto máximo en CUP</b> (0 = sin límite):`
             );
             return;
         } else if (session.priceStep === 4) {
-            const maxCup = parseFloat(text.replace(',', '.'));
-            if (isNaN(maxCup) || maxCup < 0) {
+            const maxCup = parseAmount(text);
+            if (maxCup === null || maxCup < 0) {
                 await ctx.reply('❌ Monto inválido. Debe ser un número positivo o 0.');
                 return;
             }
             session.priceTempMaxCup = maxCup;
             session.priceStep = 5;
-            await ctx.reply(
-                `Paso 5/5: Ingresa el <b>monto máximo en USD</b> (0 = sin límite):`,
-                { parse_mode: 'HTML' }
+            await replyHtml(ctx,
+                `Paso 5/5: Ingresa el <b>monto máximo en USD</b> (0 = sin límite):`
             );
             return;
         } else if (session.priceStep === 5) {
-            const maxUsd = parseFloat(text.replace(',', '.'));
-            if (isNaN(maxUsd) || maxUsd < 0) {
+            const maxUsd = parseAmount(text);
+            if (maxUsd === null || maxUsd < 0) {
                 await ctx.reply('❌ Monto inválido. Debe ser un número positivo o 0.');
                 return;
             }
             const betType = session.betType;
-            await supabase
+            const { error } = await supabase
                 .from('play_prices')
                 .update({
                     payout_multiplier: session.priceTempMultiplier,
@@ -2196,12 +2576,16 @@ bot.on(message('text'), async (ctx) => {
                     updated_at: new Date()
                 })
                 .eq('bet_type', betType);
-            await ctx.reply(
+            invalidateCache('play_prices');
+            if (error) {
+                await replyHtml(ctx, `❌ Error al guardar: ${escapeHTML(error.message)}`);
+                return;
+            }
+            await replyHtml(ctx,
                 `✅ Precios para <b>${betType}</b> actualizados:\n` +
                 `🎁 Multiplicador: x${session.priceTempMultiplier}\n` +
                 `📉 Mín: ${session.priceTempMinCup} CUP / ${session.priceTempMinUsd} USD\n` +
-                `📈 Máx: ${session.priceTempMaxCup || '∞'} CUP / ${maxUsd || '∞'} USD`,
-                { parse_mode: 'HTML' }
+                `📈 Máx: ${session.priceTempMaxCup || '∞'} CUP / ${maxUsd || '∞'} USD`
             );
             delete session.adminAction;
             delete session.priceStep;
@@ -2210,60 +2594,57 @@ bot.on(message('text'), async (ctx) => {
             delete session.priceTempMinUsd;
             delete session.priceTempMaxCup;
             delete session.betType;
-            await safeEdit(ctx, '🔧 <b>Panel de administración</b>', adminPanelKbd());
+            await safeEdit(ctx, '🔧 <b>Panel de administración</b>', ADMIN_PANEL_KBD);
             return;
         }
     }
 
     // --- Admin: configurar mínimos por jugada (set_min) ---
-    if (isAdmin(uid) && session.adminAction === 'set_min') {
+    if (adminAction === 'set_min') {
         if (session.minStep === 1) {
-            const minCup = parseFloat(text.replace(',', '.'));
-            if (isNaN(minCup) || minCup < 0) {
+            const minCup = parseAmount(text);
+            if (minCup === null || minCup < 0) {
                 await ctx.reply('❌ Monto inválido. Debe ser un número positivo o 0.');
                 return;
             }
             session.minTempCup = minCup;
             session.minStep = 2;
-            await ctx.reply(
-                `Paso 2/4: Ingresa el <b>monto mínimo en USD</b> (0 = sin mínimo):`,
-                { parse_mode: 'HTML' }
+            await replyHtml(ctx,
+                `Paso 2/4: Ingresa el <b>monto mínimo en USD</b> (0 = sin mínimo):`
             );
             return;
         } else if (session.minStep === 2) {
-            const minUsd = parseFloat(text.replace(',', '.'));
-            if (isNaN(minUsd) || minUsd < 0) {
+            const minUsd = parseAmount(text);
+            if (minUsd === null || minUsd < 0) {
                 await ctx.reply('❌ Monto inválido. Debe ser un número positivo o 0.');
                 return;
             }
             session.minTempUsd = minUsd;
             session.minStep = 3;
-            await ctx.reply(
-                `Paso 3/4: Ingresa el <b>monto máximo en CUP</b> (0 = sin límite):`,
-                { parse_mode: 'HTML' }
+            await replyHtml(ctx,
+                `Paso 3/4: Ingresa el <b>monto máximo en CUP</b> (0 = sin límite):`
             );
             return;
         } else if (session.minStep === 3) {
-            const maxCup = parseFloat(text.replace(',', '.'));
-            if (isNaN(maxCup) || maxCup < 0) {
+            const maxCup = parseAmount(text);
+            if (maxCup === null || maxCup < 0) {
                 await ctx.reply('❌ Monto inválido. Debe ser un número positivo o 0.');
                 return;
             }
             session.maxTempCup = maxCup;
             session.minStep = 4;
-            await ctx.reply(
-                `Paso 4/4: Ingresa el <b>monto máximo en USD</b> (0 = sin límite):`,
-                { parse_mode: 'HTML' }
+            await replyHtml(ctx,
+                `Paso 4/4: Ingresa el <b>monto máximo en USD</b> (0 = sin límite):`
             );
             return;
         } else if (session.minStep === 4) {
-            const maxUsd = parseFloat(text.replace(',', '.'));
-            if (isNaN(maxUsd) || maxUsd < 0) {
+            const maxUsd = parseAmount(text);
+            if (maxUsd === null || maxUsd < 0) {
                 await ctx.reply('❌ Monto inválido. Debe ser un número positivo o 0.');
                 return;
             }
             const betType = session.betType;
-            await supabase
+            const { error } = await supabase
                 .from('play_prices')
                 .update({
                     min_cup: session.minTempCup,
@@ -2273,11 +2654,15 @@ bot.on(message('text'), async (ctx) => {
                     updated_at: new Date()
                 })
                 .eq('bet_type', betType);
-            await ctx.reply(
+            invalidateCache('play_prices');
+            if (error) {
+                await replyHtml(ctx, `❌ Error al guardar: ${escapeHTML(error.message)}`);
+                return;
+            }
+            await replyHtml(ctx,
                 `✅ Límites para <b>${betType}</b> actualizados:\n` +
                 `📉 Mín: ${session.minTempCup} CUP / ${session.minTempUsd} USD\n` +
-                `📈 Máx: ${session.maxTempCup || '∞'} CUP / ${maxUsd || '∞'} USD`,
-                { parse_mode: 'HTML' }
+                `📈 Máx: ${session.maxTempCup || '∞'} CUP / ${maxUsd || '∞'} USD`
             );
             delete session.adminAction;
             delete session.minStep;
@@ -2285,19 +2670,19 @@ bot.on(message('text'), async (ctx) => {
             delete session.minTempUsd;
             delete session.maxTempCup;
             delete session.betType;
-            await safeEdit(ctx, '🔧 <b>Panel de administración</b>', adminPanelKbd());
+            await safeEdit(ctx, '🔧 <b>Panel de administración</b>', ADMIN_PANEL_KBD);
             return;
         }
     }
 
     // --- Admin: publicar número ganador ---
-    if (isAdmin(uid) && session.adminAction === 'winning_numbers') {
+    if (adminAction === 'winning_numbers') {
         const sessionId = session.winningSessionId;
         const success = await processWinningNumber(sessionId, text, ctx);
         if (success) {
             delete session.adminAction;
             delete session.winningSessionId;
-            await safeEdit(ctx, '🔧 <b>Panel de administración</b>', adminPanelKbd());
+            await safeEdit(ctx, '🔧 <b>Panel de administración</b>', ADMIN_PANEL_KBD);
         }
         return;
     }
@@ -2306,8 +2691,8 @@ bot.on(message('text'), async (ctx) => {
     if (session.awaitingDepositAmount) {
         const amountText = text;
         const method = session.depositMethod;
-        const buffer = session.depositPhotoBuffer;
-        if (!buffer) {
+        const photoFileId = session.depositPhotoFileId;
+        if (!photoFileId) {
             await ctx.reply('❌ Error: no se encontró la captura. Por favor, comienza el proceso de recarga de nuevo.', getMainKeyboard(ctx));
             delete session.awaitingDepositAmount;
             return;
@@ -2315,7 +2700,7 @@ bot.on(message('text'), async (ctx) => {
 
         const parsed = parseAmountWithCurrency(amountText);
         if (!parsed) {
-            await ctx.reply('❌ Formato inválido. Debes escribir el monto seguido de la moneda (ej: <code>500 cup</code> o <code>10 usdt</code>).', getMainKeyboard(ctx));
+            await replyHtml(ctx, '❌ Formato inválido. Debes escribir el monto seguido de la moneda (ej: <code>500 cup</code> o <code>10 usdt</code>).', getMainKeyboard(ctx));
             return;
         }
 
@@ -2340,27 +2725,19 @@ bot.on(message('text'), async (ctx) => {
         }
 
         try {
+            const buffer = await downloadTelegramFile(ctx.telegram, photoFileId);
             const request = await createDepositRequest(uid, method.id, buffer, amountText, parsed.currency);
-            for (const adminId of ADMIN_IDS) {
-                try {
-                    await bot.telegram.sendMessage(adminId,
-                        `📥 <b>Nueva solicitud de DEPÓSITO</b>\n` +
-                        `👤 Usuario: ${ctx.from.first_name} (${uid})\n` +
-                        `🏦 Método: ${escapeHTML(method.name)} (${method.currency})\n` +
-                        `💰 Monto: ${amountText}\n` +
-                        `📎 <a href="${request.screenshot_url}">Ver captura</a>\n` +
-                        `🆔 Solicitud: ${request.id}`,
-                        {
-                            parse_mode: 'HTML',
-                            reply_markup: Markup.inlineKeyboard([
-                                [Markup.button.callback('✅ Aprobar', `approve_deposit_${request.id}`),
-                                 Markup.button.callback('❌ Rechazar', `reject_deposit_${request.id}`)]
-                            ]).reply_markup
-                        }
-                    );
-                } catch (e) {}
-            }
-            await ctx.reply(`✅ <b>Solicitud de depósito enviada</b>\nMonto: ${amountText}\n⏳ Tu solicitud está siendo procesada. Te notificaremos cuando se acredite. ¡Gracias por confiar en nosotros!`, { parse_mode: 'HTML' });
+            await notifyAdmins(
+                `📥 <b>Nueva solicitud de DEPÓSITO</b>\n` +
+                `👤 Usuario: ${escapeHTML(ctx.from.first_name)} (${uid})\n` +
+                `🏦 Método: ${escapeHTML(method.name)} (${method.currency})\n` +
+                `💰 Monto: ${amountText}\n` +
+                `📎 <a href="${request.screenshot_url}">Ver captura</a>\n` +
+                `🆔 Solicitud: ${request.id}`,
+                { reply_markup: approveRejectMarkup('deposit', request.id) },
+                'depósito a admin'
+            );
+            await replyHtml(ctx, `✅ <b>Solicitud de depósito enviada</b>\nMonto: ${amountText}\n⏳ Tu solicitud está siendo procesada. Te notificaremos cuando se acredite. ¡Gracias por confiar en nosotros!`);
         } catch (e) {
             console.error(e);
             await ctx.reply('❌ Error al procesar la solicitud. Por favor, intenta más tarde o contacta a soporte.', getMainKeyboard(ctx));
@@ -2368,7 +2745,7 @@ bot.on(message('text'), async (ctx) => {
 
         delete session.awaitingDepositAmount;
         delete session.depositMethod;
-        delete session.depositPhotoBuffer;
+        delete session.depositPhotoFileId;
         return;
     }
 
@@ -2378,8 +2755,8 @@ bot.on(message('text'), async (ctx) => {
         const method = session.withdrawMethod;
         const currency = method.currency;
 
-        const amount = parseFloat(amountText.replace(',', '.'));
-        if (isNaN(amount) || amount <= 0) {
+        const amount = parseAmount(amountText);
+        if (amount === null || amount <= 0) {
             await ctx.reply('❌ Monto inválido. Por favor, envía un número positivo.', getMainKeyboard(ctx));
             return;
         }
@@ -2430,19 +2807,17 @@ bot.on(message('text'), async (ctx) => {
         if (currency === 'USDT' || currency === 'TRX') {
             session.awaitingWithdrawWallet = true; // Nuevo estado para pedir wallet
             delete session.awaitingWithdrawAmount;
-            await ctx.reply(
+            await replyHtml(ctx,
                 `✅ Monto aceptado: ${amount} ${currency} (equivale a ${amountUSD.toFixed(2)} USD)\n\n` +
                 `Por favor, escribe tu <b>dirección de wallet</b> para recibir el retiro.\n` +
-                `(Ejemplo: TXYZ... o 0x... según la red)`,
-                { parse_mode: 'HTML' }
+                `(Ejemplo: TXYZ... o 0x... según la red)`
             );
         } else {
             session.awaitingWithdrawAccount = true;
             delete session.awaitingWithdrawAmount;
-            await ctx.reply(
+            await replyHtml(ctx,
                 `✅ Monto aceptado: ${amount} ${currency} (equivale a ${amountUSD.toFixed(2)} USD)\n\n` +
-                `Por favor, escribe los <b>datos de tu cuenta</b> (número de teléfono, tarjeta, etc.) para recibir el retiro.`,
-                { parse_mode: 'HTML' }
+                `Por favor, escribe los <b>datos de tu cuenta</b> (número de teléfono, tarjeta, etc.) para recibir el retiro.`
             );
         }
         return;
@@ -2458,11 +2833,10 @@ bot.on(message('text'), async (ctx) => {
         session.withdrawWallet = wallet;
         delete session.awaitingWithdrawWallet;
         session.awaitingWithdrawNetwork = true;
-        await ctx.reply(
+        await replyHtml(ctx,
             `✅ Dirección guardada: ${escapeHTML(wallet)}\n\n` +
             `Ahora, por favor, escribe la <b>red</b> que usarás (ej: TRC-20, BEP-20, etc.).\n` +
-            `Si el método sugiere una red (${escapeHTML(session.withdrawMethod.confirm)}), asegúrate de coincidir.`,
-            { parse_mode: 'HTML' }
+            `Si el método sugiere una red (${escapeHTML(session.withdrawMethod.confirm)}), asegúrate de coincidir.`
         );
         return;
     }
@@ -2492,41 +2866,31 @@ bot.on(message('text'), async (ctx) => {
                     account_info: accountInfo,
                     status: 'pending'
                 })
-                .select()
+                .select('id')
                 .single();
 
             if (error) throw error;
 
-            for (const adminId of ADMIN_IDS) {
-                try {
-                    await bot.telegram.sendMessage(adminId,
-                        `📤 <b>Nueva solicitud de RETIRO (cripto)</b>\n` +
-                        `👤 Usuario: ${ctx.from.first_name} (${uid})\n` +
-                        `💰 Monto: ${amount} ${currency}\n` +
-                        `🏦 Método: ${escapeHTML(method.name)}\n` +
-                        `📞 Datos: ${escapeHTML(accountInfo)}\n` +
-                        `🆔 Solicitud: ${request.id}`,
-                        {
-                            parse_mode: 'HTML',
-                            reply_markup: Markup.inlineKeyboard([
-                                [Markup.button.callback('✅ Aprobar', `approve_withdraw_${request.id}`),
-                                 Markup.button.callback('❌ Rechazar', `reject_withdraw_${request.id}`)]
-                            ]).reply_markup
-                        }
-                    );
-                } catch (e) {}
-            }
-            await ctx.reply(
+            await notifyAdmins(
+                `📤 <b>Nueva solicitud de RETIRO (cripto)</b>\n` +
+                `👤 Usuario: ${escapeHTML(ctx.from.first_name)} (${uid})\n` +
+                `💰 Monto: ${amount} ${currency}\n` +
+                `🏦 Método: ${escapeHTML(method.name)}\n` +
+                `📞 Datos: ${escapeHTML(accountInfo)}\n` +
+                `🆔 Solicitud: ${request.id}`,
+                { reply_markup: approveRejectMarkup('withdraw', request.id) },
+                'retiro a admin'
+            );
+            await replyHtml(ctx,
                 `✅ <b>Solicitud de retiro enviada</b>\n` +
                 `💰 Monto: ${amount} ${currency}\n` +
                 `📞 Wallet: ${escapeHTML(wallet)}\n` +
                 `🔗 Red: ${escapeHTML(network)}\n` +
-                `⏳ Procesaremos tu solicitud a la mayor brevedad.`,
-                { parse_mode: 'HTML' }
+                `⏳ Procesaremos tu solicitud a la mayor brevedad.`
             );
         } catch (e) {
             console.error(e);
-            await ctx.reply(`❌ Error al crear la solicitud: ${e.message}`, getMainKeyboard(ctx));
+            await replyHtml(ctx, `❌ Error al crear la solicitud: ${escapeHTML(e.message)}`, getMainKeyboard(ctx));
         }
 
         delete session.withdrawWallet;
@@ -2573,36 +2937,26 @@ bot.on(message('text'), async (ctx) => {
                 account_info: accountInfo,
                 status: 'pending'
             })
-            .select()
+            .select('id')
             .single();
 
         if (error) {
-            await ctx.reply(`❌ Error al crear la solicitud: ${error.message}`, getMainKeyboard(ctx));
+            await replyHtml(ctx, `❌ Error al crear la solicitud: ${escapeHTML(error.message)}`, getMainKeyboard(ctx));
         } else {
-            for (const adminId of ADMIN_IDS) {
-                try {
-                    await bot.telegram.sendMessage(adminId,
-                        `📤 <b>Nueva solicitud de RETIRO</b>\n` +
-                        `👤 Usuario: ${ctx.from.first_name} (${uid})\n` +
-                        `💰 Monto: ${amount} ${currency}\n` +
-                        `🏦 Método: ${escapeHTML(method.name)}\n` +
-                        `📞 Cuenta: ${escapeHTML(accountInfo)}\n` +
-                        `🆔 Solicitud: ${request.id}`,
-                        {
-                            parse_mode: 'HTML',
-                            reply_markup: Markup.inlineKeyboard([
-                                [Markup.button.callback('✅ Aprobar', `approve_withdraw_${request.id}`),
-                                 Markup.button.callback('❌ Rechazar', `reject_withdraw_${request.id}`)]
-                            ]).reply_markup
-                        }
-                    );
-                } catch (e) {}
-            }
-            await ctx.reply(
+            await notifyAdmins(
+                `📤 <b>Nueva solicitud de RETIRO</b>\n` +
+                `👤 Usuario: ${escapeHTML(ctx.from.first_name)} (${uid})\n` +
+                `💰 Monto: ${amount} ${currency}\n` +
+                `🏦 Método: ${escapeHTML(method.name)}\n` +
+                `📞 Cuenta: ${escapeHTML(accountInfo)}\n` +
+                `🆔 Solicitud: ${request.id}`,
+                { reply_markup: approveRejectMarkup('withdraw', request.id) },
+                'retiro a admin'
+            );
+            await replyHtml(ctx,
                 `✅ <b>Solicitud de retiro enviada</b>\n` +
                 `💰 Monto: ${amount} ${currency}\n` +
-                `⏳ Procesaremos tu solicitud a la mayor brevedad. Te avisaremos cuando esté lista.`,
-                { parse_mode: 'HTML' }
+                `⏳ Procesaremos tu solicitud a la mayor brevedad. Te avisaremos cuando esté lista.`
             );
         }
 
@@ -2628,17 +2982,14 @@ bot.on(message('text'), async (ctx) => {
                 .maybeSingle();
             if (userByUsername) {
                 targetUser = userByUsername;
-            } else {
-                const targetId = parseInt(targetIdentifier);
-                if (!isNaN(targetId)) {
-                    const { data: userById } = await supabase
-                        .from('users')
-                        .select('telegram_id, username, first_name')
-                        .eq('telegram_id', targetId)
-                        .maybeSingle();
-                    if (userById) {
-                        targetUser = userById;
-                    }
+            } else if (NUMERIC_ID_RE.test(targetIdentifier)) {
+                const { data: userById } = await supabase
+                    .from('users')
+                    .select('telegram_id, username, first_name')
+                    .eq('telegram_id', parseInt(targetIdentifier))
+                    .maybeSingle();
+                if (userById) {
+                    targetUser = userById;
                 }
             }
         }
@@ -2658,11 +3009,10 @@ bot.on(message('text'), async (ctx) => {
         session.awaitingTransferAmount = true;
         delete session.awaitingTransferTarget;
         const displayName = targetUser.first_name || targetUser.username || targetUser.telegram_id;
-        await ctx.reply(
+        await replyHtml(ctx,
             `✅ Usuario encontrado: ${escapeHTML(displayName)}\n\n` +
             `Ahora envía el <b>monto y la moneda</b> que deseas transferir (ej: <code>500 cup</code>, <code>10 usd</code>).\n` +
-            `💰 Tus saldos: CUP: ${(parseFloat(user.cup) || 0).toFixed(2)}, USD: ${(parseFloat(user.usd) || 0).toFixed(2)}`,
-            { parse_mode: 'HTML' }
+            `💰 Tus saldos: CUP: ${(parseFloat(user.cup) || 0).toFixed(2)}, USD: ${(parseFloat(user.usd) || 0).toFixed(2)}`
         );
         return;
     }
@@ -2671,7 +3021,7 @@ bot.on(message('text'), async (ctx) => {
     if (session.awaitingTransferAmount) {
         const parsed = parseAmountWithCurrency(text);
         if (!parsed) {
-            await ctx.reply('❌ Formato inválido. Debe ser <code>monto moneda</code> (ej: 500 cup).', getMainKeyboard(ctx));
+            await replyHtml(ctx, '❌ Formato inválido. Debe ser <code>monto moneda</code> (ej: 500 cup).', getMainKeyboard(ctx));
             return;
         }
 
@@ -2695,56 +3045,42 @@ bot.on(message('text'), async (ctx) => {
             return;
         }
 
-        if (currency === 'CUP') {
-            await supabase
-                .from('users')
-                .update({ cup: (parseFloat(user.cup) || 0) - amount, updated_at: new Date() })
-                .eq('telegram_id', uid);
-        } else {
-            await supabase
-                .from('users')
-                .update({ usd: (parseFloat(user.usd) || 0) - amount, updated_at: new Date() })
-                .eq('telegram_id', uid);
+        let result;
+        try {
+            result = await transferBalance(uid, targetId, currency, amount);
+        } catch (e) {
+            console.error('Error en transferencia:', e);
+            result = { ok: false, reason: 'error' };
         }
-
-        const { data: targetUser } = await supabase
-            .from('users')
-            .select('cup, usd')
-            .eq('telegram_id', targetId)
-            .single();
-
-        if (currency === 'CUP') {
-            await supabase
-                .from('users')
-                .update({ cup: (parseFloat(targetUser.cup) || 0) + amount, updated_at: new Date() })
-                .eq('telegram_id', targetId);
-        } else {
-            await supabase
-                .from('users')
-                .update({ usd: (parseFloat(targetUser.usd) || 0) + amount, updated_at: new Date() })
-                .eq('telegram_id', targetId);
+        if (!result.ok) {
+            if (result.reason === 'insufficient_funds') {
+                await ctx.reply(`❌ No tienes suficiente saldo en ${currency}.`, getMainKeyboard(ctx));
+            } else {
+                await ctx.reply('❌ No se pudo completar la transferencia. El saldo no fue modificado.', getMainKeyboard(ctx));
+            }
+            return;
         }
 
+        const targetUser = result.to;
+
         const fromName = user.first_name || user.username || uid;
         const toName = targetUser.first_name || targetUser.username || targetId;
 
-        await ctx.reply(
-            `✅ Transferencia realizada con éxito:\n` +
-            `💰 Monto: ${amount} ${currency}\n` +
-            `👤 De: ${escapeHTML(fromName)}\n` +
-            `👤 A: ${escapeHTML(toName)}`,
-            { parse_mode: 'HTML' }
-        );
-
-        try {
-            await bot.telegram.sendMessage(targetId,
+        // Confirmación al remitente y aviso al destinatario en paralelo
+        await Promise.all([
+            replyHtml(ctx,
+                `✅ Transferencia realizada con éxito:\n` +
+                `💰 Monto: ${amount} ${currency}\n` +
+                `👤 De: ${escapeHTML(fromName)}\n` +
+                `👤 A: ${escapeHTML(toName)}`
+            ),
+            sendHtml(bot.telegram, targetId,
                 `🔄 <b>Has recibido una transferencia</b>\n\n` +
                 `👤 De: ${escapeHTML(fromName)}\n` +
                 `💰 Monto: ${amount} ${currency}\n` +
-                `📊 Saldo actualizado.`,
-                { parse_mode: 'HTML' }
-            );
-        } catch (e) {}
+                `📊 Saldo actualizado.`
+            ).catch(e => logNotifyError('transferencia a destinatario', e))
+        ]);
 
         delete session.transferTarget;
         delete session.awaitingTransferAmount;
@@ -2763,19 +3099,6 @@ bot.on(message('text'), async (ctx) => {
             return;
         }
 
-        const { data: activeSession } = await supabase
-            .from('lottery_sessions')
-            .select('*')
-            .eq('id', sessionId)
-            .eq('status', 'open')
-            .maybeSingle();
-
-        if (!activeSession) {
-            await ctx.reply('❌ La sesión de juego ha sido cerrada. No se pueden registrar más apuestas para esta sesión.', getMainKeyboard(ctx));
-            delete session.awaitingBet;
-            return;
-        }
-
         const parsed = parseBetMessage(text, betType);
         if (!parsed.ok) {
             await ctx.reply('❌ No se pudo interpretar tu apuesta. Verifica el formato y vuelve a intentarlo.\n\nSi necesitas ayuda, escribe "❓ Cómo jugar".', getMainKeyboard(ctx));
@@ -2790,11 +3113,7 @@ bot.on(message('text'), async (ctx) => {
             return;
         }
 
-        const { data: priceData } = await supabase
-            .from('play_prices')
-            .select('min_cup, min_usd, max_cup, max_usd')
-            .eq('bet_type', betType)
-            .single();
+        const priceData = await getPlayPrice(betType);
 
         const minCup = priceData?.min_cup || 0;
         const minUsd = priceData?.min_usd || 0;
@@ -2820,67 +3139,44 @@ bot.on(message('text'), async (ctx) => {
             }
         }
 
-        let newUsd = parseFloat(user.usd) || 0;
-        let newBonus = parseFloat(user.bonus_cup) || 0;
-        let newCup = parseFloat(user.cup) || 0;
-
-        if (totalUSD > 0) {
-            const rate = await getExchangeRateUSD();
-            const totalDisponible = newUsd + newBonus / rate;
-            if (totalDisponible < totalUSD) {
-                await ctx.reply('❌ Saldo USD (incluyendo bono convertido) insuficiente para realizar esta jugada. Recarga o reduce el monto.', getMainKeyboard(ctx));
-                return;
-            }
-            const usarBonoUSD = Math.min(newBonus / rate, totalUSD);
-            newBonus -= usarBonoUSD * rate;
-            newUsd -= (totalUSD - usarBonoUSD);
-        }
-
-        if (totalCUP > 0) {
-            if (newCup < totalCUP) {
-                await ctx.reply('❌ Saldo CUP insuficiente. Recarga o reduce el monto.', getMainKeyboard(ctx));
-                return;
-            }
-            newCup -= totalCUP;
-        }
-
-        await supabase
-            .from('users')
-            .update({
-                usd: newUsd,
-                bonus_cup: newBonus,
-                cup: newCup,
-                updated_at: new Date()
-            })
-            .eq('telegram_id', uid);
-
-        const { data: bet, error } = await supabase
-            .from('bets')
-            .insert({
-                user_id: uid,
+        // Sesión abierta, saldo, descuento e inserción en una sola transacción
+        let result;
+        try {
+            result = await placeBet({
+                userId: uid,
                 lottery,
-                session_id: sessionId,
-                bet_type: betType,
-                raw_text: text,
+                sessionId,
+                betType,
+                rawText: text,
                 items: parsed.items,
-                cost_usd: totalUSD,
-                cost_cup: totalCUP,
-                placed_at: new Date()
-            })
-            .select()
-            .single();
-
-        if (error) {
+                costUSD: totalUSD,
+                costCUP: totalCUP
+            });
+        } catch (error) {
             console.error('Error insertando apuesta:', error);
             await ctx.reply('❌ Error al registrar la apuesta. Por favor, intenta más tarde.', getMainKeyboard(ctx));
             return;
         }
 
+        if (!result.ok) {
+            if (result.reason === 'session_closed') {
+                await ctx.reply('❌ La sesión de juego ha sido cerrada. No se pueden registrar más apuestas para esta sesión.', getMainKeyboard(ctx));
+                delete session.awaitingBet;
+            } else if (result.reason === 'insufficient_usd') {
+                await ctx.reply('❌ Saldo USD (incluyendo bono convertido) insuficiente para realizar esta jugada. Recarga o reduce el monto.', getMainKeyboard(ctx));
+            } else if (result.reason === 'insufficient_cup') {
+                await ctx.reply('❌ Saldo CUP insuficiente. Recarga o reduce el monto.', getMainKeyboard(ctx));
+            } else {
+                await ctx.reply('❌ Error al registrar la apuesta. Por favor, intenta más tarde.', getMainKeyboard(ctx));
+            }
+            return;
+        }
+
         const rate = await getExchangeRateUSD();
         const usdEquivalentCup = (totalUSD * rate).toFixed(2);
         const cupEquivalentUsd = (totalCUP / rate).toFixed(2);
 
-        await ctx.replyWithHTML(
+        await replyHtml(ctx,
             `✅ <b>Jugada registrada exitosamente</b>\n` +
             `🎰 ${escapeHTML(lottery)} - ${escapeHTML(betType)}\n` +
             `📝 <code>${escapeHTML(text)}</code>\n` +
@@ -2901,24 +3197,20 @@ bot.on(message('text'), async (ctx) => {
 
     // 4. Si no hay ningún flujo activo, se trata como mensaje de soporte
     // Solo si el usuario no es admin (para evitar que los admins se envíen soporte a sí mismos)
-    if (!isAdmin(uid)) {
-        // Reenviar a todos los admins
-        for (const adminId of ADMIN_IDS) {
-            try {
-                await bot.telegram.sendMessage(adminId,
-                    `📩 <b>Mensaje de soporte de</b> ${escapeHTML(ctx.from.first_name)} (${uid}):\n\n${escapeHTML(text)}`,
-                    {
-                        parse_mode: 'HTML',
-                        reply_markup: Markup.inlineKeyboard([
-                            [Markup.button.callback('📩 Responder', `support_reply_${uid}`)]
-                        ]).reply_markup
-                    }
-                );
-            } catch (e) {
-                console.warn(`Error enviando soporte a admin ${adminId}:`, e.message);
-            }
-        }
-        await ctx.reply('✅ Tu mensaje ha sido enviado al equipo de soporte. Te responderemos a la brevedad.');
+    if (!isAdminUser) {
+        // Reenviar a todos los admins y confirmar al usuario a la vez
+        await Promise.all([
+            notifyAdmins(
+                `📩 <b>Mensaje de soporte de</b> ${escapeHTML(ctx.from.first_name)} (${uid}):\n\n${escapeHTML(text)}`,
+                {
+                    reply_markup: Markup.inlineKeyboard([
+                        [Markup.button.callback('📩 Responder', `support_reply_${uid}`)]
+                    ]).reply_markup
+                },
+                'soporte a admin'
+            ),
+            ctx.reply('✅ Tu mensaje ha sido enviado al equipo de soporte. Te responderemos a la brevedad.')
+        ]);
     } else {
         // Si es admin y no está en modo respuesta, ignoramos (o podríamos dar un mensaje)
         await ctx.reply('Usa los botones del menú para navegar.', getMainKeyboard(ctx));
@@ -2931,17 +3223,14 @@ bot.on(message('photo'), async (ctx) => {
     const session = ctx.session;
 
     if (session.awaitingDepositPhoto) {
+        // Solo el file_id: la sesión se serializa a JSON (archivo o Redis) y la
+        // imagen se descarga al enviar la solicitud.
         const photo = ctx.message.photo.pop();
-        const fileId = photo.file_id;
-        const fileLink = await ctx.telegram.getFileLink(fileId);
-        const response = await axios({ url: fileLink.href, responseType: 'arraybuffer' });
-        const buffer = Buffer.from(response.data, 'binary');
-
-        session.depositPhotoBuffer = buffer;
+        session.depositPhotoFileId = photo.file_id;
         delete session.awaitingDepositPhoto;
         session.awaitingDepositAmount = true;
 
-        await ctx.reply('✅ Captura recibida correctamente. Ahora, por favor, envía el <b>monto transferido</b> con la moneda (ej: <code>500 cup</code> o <code>10 usdt</code>).', { parse_mode: 'HTML' });
+        await replyHtml(ctx, '✅ Captura recibida correctamente. Ahora, por favor, envía el <b>monto transferido</b> con la moneda (ej: <code>500 cup</code> o <code>10 usdt</code>).');
         return;
     }
 
@@ -2949,176 +3238,134 @@ bot.on(message('photo'), async (ctx) => {
 });
 
 // ========== APROBAR/RECHAZAR DEPÓSITOS Y RETIROS ==========
-bot.action(/approve_deposit_(\d+)/, async (ctx) => {
-    if (!isAdmin(ctx.from.id)) {
-        await ctx.answerCbQuery('⛔ No autorizado', { show_alert: true });
-        return;
-    }
-    try {
-        const requestId = parseInt(ctx.match[1]);
-        const { data: request } = await supabase
-            .from('deposit_requests')
-            .select('*')
-            .eq('id', requestId)
-            .single();
-
-        if (!request) {
-            await ctx.answerCbQuery('Solicitud no encontrada', { show_alert: true });
-            return;
-        }
-
-        const parsed = parseAmountWithCurrency(request.amount);
-        if (!parsed) {
-            await ctx.answerCbQuery('Monto no válido en la solicitud', { show_alert: true });
-            return;
+// Envoltorio común de aprobar/rechazar solicitudes: comprueba el admin antes
+// de cualquier consulta, parsea el id una sola vez y centraliza los errores.
+// Los update de estado sin .select() ya viajan con return=minimal.
+function reviewAction(errorText, handler) {
+    return adminOnly(async (ctx) => {
+        const requestId = Number(ctx.match[1]);
+        try {
+            await handler(ctx, requestId);
+        } catch (e) {
+            console.error(e);
+            await ctx.answerCbQuery(errorText, { show_alert: true });
         }
+    });
+}
 
-        const rates = await getExchangeRates();
-        const amountCUP = await convertToCUP(parsed.amount, parsed.currency);
+bot.action(/^approve_deposit_(\d+)$/, reviewAction('❌ Error al aprobar. Revisa los logs.', async (ctx, requestId) => {
+    const { data: request } = await supabase
+        .from('deposit_requests')
+        .select('user_id, amount')
+        .eq('id', requestId)
+        .single();
 
-        const { data: user } = await supabase
-            .from('users')
-            .select('cup')
-            .eq('telegram_id', request.user_id)
-            .single();
+    if (!request) {
+        await ctx.answerCbQuery('Solicitud no encontrada', { show_alert: true });
+        return;
+    }
 
-        const newCup = (parseFloat(user.cup) || 0) + amountCUP;
+    const parsed = parseAmountWithCurrency(request.amount);
+    if (!parsed) {
+        await ctx.answerCbQuery('Monto no válido en la solicitud', { show_alert: true });
+        return;
+    }
 
-        await supabase
-            .from('users')
-            .update({ cup: newCup, updated_at: new Date() })
-            .eq('telegram_id', request.user_id);
+    const amountCUP = await convertToCUP(parsed.amount, parsed.currency);
 
-        await supabase
-            .from('deposit_requests')
-            .update({ status: 'approved', updated_at: new Date() })
-            .eq('id', requestId);
+    const credited = await approveDeposit(requestId, { cup: amountCUP }, ctx.from.id);
+    if (!credited) {
+        await ctx.answerCbQuery('Esta solicitud ya fue procesada', { show_alert: true });
+        return;
+    }
 
-        await ctx.telegram.sendMessage(request.user_id,
+    // Las llamadas a Telegram son independientes entre sí: se envían en paralelo.
+    // El saldo ya está acreditado, así que un fallo de la interfaz solo se
+    // registra y no cae en el mensaje de "Error al aprobar".
+    await Promise.all([
+        sendHtml(ctx.telegram, request.user_id,
             `✅ <b>Depósito aprobado</b>\n\n` +
             `💰 Monto depositado: ${request.amount}\n` +
             `💵 Se acreditaron <b>${amountCUP.toFixed(2)} CUP</b> a tu saldo.\n\n` +
-            `¡Gracias por confiar en nosotros!`,
-            { parse_mode: 'HTML' }
-        );
+            `¡Gracias por confiar en nosotros!`
+        ).catch(e => logNotifyError('depósito aprobado', e)),
+        ctx.editMessageReplyMarkup({ inline_keyboard: [] }).catch(e => logNotifyError('depósito aprobado (botones)', e)),
+        ctx.reply('✅ Depósito aprobado y saldo actualizado correctamente.').catch(e => logNotifyError('depósito aprobado (admin)', e)),
+        ctx.answerCbQuery().catch(e => logNotifyError('depósito aprobado (callback)', e))
+    ]);
+}));
 
-        await ctx.editMessageReplyMarkup({ inline_keyboard: [] });
-        await ctx.reply('✅ Depósito aprobado y saldo actualizado correctamente.');
-        await ctx.answerCbQuery();
-    } catch (e) {
-        console.error(e);
-        await ctx.answerCbQuery('❌ Error al aprobar. Revisa los logs.', { show_alert: true });
-    }
-});
+bot.action(/^reject_deposit_(\d+)$/, reviewAction('❌ Error al rechazar', async (ctx, requestId) => {
+    const { data: request } = await supabase
+        .from('deposit_requests')
+        .update({ status: 'rejected', updated_at: new Date() })
+        .eq('id', requestId)
+        .select('user_id')
+        .maybeSingle();
 
-bot.action(/reject_deposit_(\d+)/, async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
-    try {
-        const requestId = parseInt(ctx.match[1]);
-        await supabase
-            .from('deposit_requests')
-            .update({ status: 'rejected', updated_at: new Date() })
-            .eq('id', requestId);
-
-        const { data: request } = await supabase
-            .from('deposit_requests')
-            .select('user_id')
-            .eq('id', requestId)
-            .single();
+    await Promise.all([
+        request && sendHtml(ctx.telegram, request.user_id,
+            '❌ <b>Depósito rechazado</b>\nLa solicitud no pudo ser procesada. Por favor, contacta al administrador para más información.'
+        ).catch(e => logNotifyError('depósito rechazado', e)),
+        ctx.editMessageReplyMarkup({ inline_keyboard: [] }).catch(e => logNotifyError('depósito rechazado (botones)', e)),
+        ctx.reply('❌ Depósito rechazado.').catch(e => logNotifyError('depósito rechazado (admin)', e)),
+        ctx.answerCbQuery().catch(e => logNotifyError('depósito rechazado (callback)', e))
+    ]);
+}));
 
-        if (request) {
-            await ctx.telegram.sendMessage(request.user_id,
-                '❌ <b>Depósito rechazado</b>\nLa solicitud no pudo ser procesada. Por favor, contacta al administrador para más información.',
-                { parse_mode: 'HTML' }
-            );
-        }
-        await ctx.editMessageReplyMarkup({ inline_keyboard: [] });
-        await ctx.reply('❌ Depósito rechazado.');
-        await ctx.answerCbQuery();
-    } catch (e) {
-        console.error(e);
-        await ctx.answerCbQuery('❌ Error al rechazar', { show_alert: true });
-    }
-});
+bot.action(/^approve_withdraw_(\d+)$/, reviewAction('❌ Error al aprobar', async (ctx, requestId) => {
+    const { data: request } = await supabase
+        .from('withdraw_requests')
+        .select('user_id, amount, currency')
+        .eq('id', requestId)
+        .single();
 
-bot.action(/approve_withdraw_(\d+)/, async (ctx) => {
-    if (!isAdmin(ctx.from.id)) {
-        await ctx.answerCbQuery('⛔ No autorizado', { show_alert: true });
+    if (!request) {
+        await ctx.answerCbQuery('Solicitud no encontrada', { show_alert: true });
         return;
     }
-    try {
-        const requestId = parseInt(ctx.match[1]);
-        const { data: request } = await supabase
-            .from('withdraw_requests')
-            .select('*')
-            .eq('id', requestId)
-            .single();
-
-        if (!request) {
-            await ctx.answerCbQuery('Solicitud no encontrada', { show_alert: true });
-            return;
-        }
 
-        const { data: user } = await supabase
-            .from('users')
-            .select('cup')
-            .eq('telegram_id', request.user_id)
-            .single();
-
-        const amountCUP = await convertToCUP(request.amount, request.currency);
+    const amountCUP = await convertToCUP(request.amount, request.currency);
 
-        if ((parseFloat(user.cup) || 0) < amountCUP) {
+    const result = await approveWithdraw(requestId, { cup: amountCUP }, ctx.from.id);
+    if (!result.ok) {
+        if (result.reason === 'not_pending') {
+            await ctx.answerCbQuery('Esta solicitud ya fue procesada', { show_alert: true });
+        } else {
             await ctx.reply('❌ El usuario ya no tiene saldo suficiente para este retiro.');
-            return;
         }
+        return;
+    }
 
-        await supabase
-            .from('users')
-            .update({ cup: (parseFloat(user.cup) || 0) - amountCUP, updated_at: new Date() })
-            .eq('telegram_id', request.user_id);
-
-        await supabase
-            .from('withdraw_requests')
-            .update({ status: 'approved', updated_at: new Date() })
-            .eq('id', requestId);
-
-        await ctx.telegram.sendMessage(request.user_id,
+    await Promise.all([
+        sendHtml(ctx.telegram, request.user_id,
             `✅ <b>Retiro aprobado</b>\n\n` +
             `💰 Monto retirado: ${request.amount} ${request.currency}\n` +
             `💵 Se debitaron ${amountCUP.toFixed(2)} CUP de tu saldo.\n\n` +
-            `Los fondos serán enviados a la cuenta proporcionada en breve.`,
-            { parse_mode: 'HTML' }
-        );
-
-        await ctx.editMessageReplyMarkup({ inline_keyboard: [] });
-        await ctx.reply('✅ Retiro aprobado y saldo debitado correctamente.');
-        await ctx.answerCbQuery();
-    } catch (e) {
-        console.error(e);
-        await ctx.answerCbQuery('❌ Error al aprobar', { show_alert: true });
-    }
-});
-
-bot.action(/reject_withdraw_(\d+)/, async (ctx) => {
-    if (!isAdmin(ctx.from.id)) return;
-    try {
-        const requestId = parseInt(ctx.match[1]);
-        await supabase.from('withdraw_requests').update({ status: 'rejected', updated_at: new Date() }).eq('id', requestId);
-        const { data: request } = await supabase.from('withdraw_requests').select('user_id').eq('id', requestId).single();
-        if (request) {
-            await ctx.telegram.sendMessage(request.user_id,
-                '❌ <b>Retiro rechazado</b>\nTu solicitud no pudo ser procesada. Por favor, contacta al administrador para más detalles.',
-                { parse_mode: 'HTML' }
-            );
-        }
-        await ctx.editMessageReplyMarkup({ inline_keyboard: [] });
-        await ctx.reply('❌ Retiro rechazado.');
-        await ctx.answerCbQuery();
-    } catch (e) {
-        console.error(e);
-        await ctx.answerCbQuery('❌ Error al rechazar', { show_alert: true });
-    }
-});
+            `Los fondos serán enviados a la cuenta proporcionada en breve.`
+        ).catch(e => logNotifyError('retiro aprobado', e)),
+        ctx.editMessageReplyMarkup({ inline_keyboard: [] }).catch(e => logNotifyError('retiro aprobado (botones)', e)),
+        ctx.reply('✅ Retiro aprobado y saldo debitado correctamente.').catch(e => logNotifyError('retiro aprobado (admin)', e)),
+        ctx.answerCbQuery().catch(e => logNotifyError('retiro aprobado (callback)', e))
+    ]);
+}));
+
+bot.action(/^reject_withdraw_(\d+)$/, reviewAction('❌ Error al rechazar', async (ctx, requestId) => {
+    const { data: request } = await supabase
+        .from('withdraw_requests')
+        .update({ status: 'rejected', updated_at: new Date() })
+        .eq('id', requestId)
+        .select('user_id')
+        .maybeSingle();
+    await Promise.all([
+        request && sendHtml(ctx.telegram, request.user_id,
+            '❌ <b>Retiro rechazado</b>\nTu solicitud no pudo ser procesada. Por favor, contacta al administrador para más detalles.'
+        ).catch(e => logNotifyError('retiro rechazado', e)),
+        ctx.editMessageReplyMarkup({ inline_keyboard: [] }).catch(e => logNotifyError('retiro rechazado (botones)', e)),
+        ctx.reply('❌ Retiro rechazado.').catch(e => logNotifyError('retiro rechazado (admin)', e)),
+        ctx.answerCbQuery().catch(e => logNotifyError('retiro rechazado (callback)', e))
+    ]);
+}));
 
 // ========== CRON JOBS ==========
 async function closeExpiredSessions() {
@@ -3126,7 +3373,7 @@ async function closeExpiredSessions() {
         const now = new Date().toISOString();
         const { data: expiredSessions } = await supabase
             .from('lottery_sessions')
-            .select('*')
+            .select('id, lottery, date, time_slot')
             .eq('status', 'open')
             .lt('end_time', now);
 
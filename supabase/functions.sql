@@ -0,0 +1,366 @@
+-- ==============================
+-- supabase/functions.sql - Funciones SQL (RPC) usadas por bot.js y backend.js
+-- Ejecutar en el editor SQL de Supabase. Son idempotentes (create or replace /
+-- if not exists).
+-- ==============================
+
+-- ========== ÍNDICES ==========
+-- Conteo de referidos (count exact + head sobre users.ref_by): sin índice,
+-- cada pulsación de "Referidos" recorre la tabla completa de usuarios.
+create index if not exists users_ref_by_idx on users (ref_by);
+
+-- ========== COLUMNAS CALCULADAS ==========
+-- Fecha de la jugada ya formateada en hora de Cuba para "Mis jugadas".
+-- PostgREST la expone como columna: select('..., placed_at_local').
+create or replace function placed_at_local(b bets)
+returns text
+language sql
+stable
+as $$
+    select to_char(b.placed_at at time zone 'America/Havana', 'DD/MM/YYYY HH24:MI');
+$$;
+
+-- ========== AJUSTE ATÓMICO DE SALDO ==========
+-- Suma los deltas (positivos o negativos) a los saldos del usuario en una sola
+-- sentencia: no hay carrera entre leer y escribir. Si algún saldo quedaría
+-- negativo o el usuario no existe, no actualiza nada y devuelve 0 filas.
+create or replace function adjust_user_balance(
+    p_telegram_id bigint,
+    p_cup numeric default 0,
+    p_usd numeric default 0,
+    p_bonus_cup numeric default 0
+) returns setof users
+language sql
+as $$
+    update users
+       set cup = coalesce(cup, 0) + p_cup,
+           usd = coalesce(usd, 0) + p_usd,
+           bonus_cup = coalesce(bonus_cup, 0) + p_bonus_cup,
+           updated_at = now()
+     where telegram_id = p_telegram_id
+       and coalesce(cup, 0) + p_cup >= 0
+       and coalesce(usd, 0) + p_usd >= 0
+       and coalesce(bonus_cup, 0) + p_bonus_cup >= 0
+    returning *;
+$$;
+
+-- ========== REGISTRO DE APUESTA EN UNA TRANSACCIÓN ==========
+-- Bloquea la fila del usuario (FOR UPDATE), comprueba que la sesión siga
+-- abierta y que haya saldo, descuenta primero el bono (convertido a USD con
+-- p_rate) y luego el USD, descuenta el CUP e inserta la jugada. Todo en una
+-- sola llamada: dos apuestas simultáneas del mismo usuario no pueden pasar
+-- ambas la verificación de saldo.
+-- Devuelve {ok, reason} o {ok: true, bet, user}.
+create or replace function place_bet(
+    p_telegram_id bigint,
+    p_lottery text,
+    p_session_id bigint,
+    p_bet_type text,
+    p_raw_text text,
+    p_items jsonb,
+    p_cost_usd numeric,
+    p_cost_cup numeric,
+    p_rate numeric
+) returns jsonb
+language plpgsql
+as $$
+declare
+    u users%rowtype;
+    b bets%rowtype;
+    bonus_usd numeric;
+    use_bonus_usd numeric := 0;
+begin
+    select * into u from users where telegram_id = p_telegram_id for update;
+    if not found then
+        return jsonb_build_object('ok', false, 'reason', 'user_not_found');
+    end if;
+
+    if p_session_id is not null and not exists (
+        select 1 from lottery_sessions where id = p_session_id and status = 'open'
+    ) then
+        return jsonb_build_object('ok', false, 'reason', 'session_closed');
+    end if;
+
+    if p_cost_usd > 0 then
+        bonus_usd := coalesce(u.bonus_cup, 0) / p_rate;
+        if coalesce(u.usd, 0) + bonus_usd < p_cost_usd then
+            return jsonb_build_object('ok', false, 'reason', 'insufficient_usd');
+        end if;
+        -- En céntimos enteros, truncando para no descontar más bono del que hay
+        use_bonus_usd := floor(least(bonus_usd, p_cost_usd) * 100) / 100;
+    end if;
+
+    if p_cost_cup > 0 and coalesce(u.cup, 0) < p_cost_cup then
+        return jsonb_build_object('ok', false, 'reason', 'insufficient_cup');
+    end if;
+
+    update users
+       set usd = coalesce(usd, 0) - (p_cost_usd - use_bonus_usd),
+           bonus_cup = greatest(coalesce(bonus_cup, 0) - round(use_bonus_usd * p_rate, 2), 0),
+           cup = coalesce(cup, 0) - p_cost_cup,
+           updated_at = now()
+     where telegram_id = p_telegram_id
+    returning * into u;
+
+    insert into bets (user_id, lottery, session_id, bet_type, raw_text, items, cost_usd, cost_cup, placed_at)
+    values (p_telegram_id, p_lottery, p_session_id, p_bet_type, p_raw_text, p_items, p_cost_usd, p_cost_cup, now())
+    returning * into b;
+
+    return jsonb_build_object('ok', true, 'bet', to_jsonb(b), 'user', to_jsonb(u));
+end;
+$$;
+
+-- ========== CANCELACIÓN DE APUESTA EN UNA TRANSACCIÓN ==========
+-- Bloquea la jugada (FOR UPDATE), comprueba que su sesión siga abierta, la
+-- borra y devuelve al usuario lo apostado según sus items. Dos cancelaciones
+-- simultáneas (doble toque, reintento de red) se serializan en el bloqueo: la
+-- segunda ya no encuentra la jugada y no reembolsa otra vez.
+-- Devuelve {ok, reason} o {ok: true, user}.
+create or replace function cancel_bet(
+    p_bet_id bigint,
+    p_telegram_id bigint
+) returns jsonb
+language plpgsql
+as $$
+declare
+    b bets%rowtype;
+    u users%rowtype;
+    refund_cup numeric;
+    refund_usd numeric;
+begin
+    select * into b from bets
+     where id = p_bet_id and user_id = p_telegram_id
+       for update;
+    if not found then
+        return jsonb_build_object('ok', false, 'reason', 'not_found');
+    end if;
+
+    if b.session_id is not null and not exists (
+        select 1 from lottery_sessions where id = b.session_id and status = 'open'
+    ) then
+        return jsonb_build_object('ok', false, 'reason', 'session_closed');
+    end if;
+
+    select coalesce(sum((i->>'amount')::numeric) filter (where i->>'currency' = 'CUP'), 0),
+           coalesce(sum((i->>'amount')::numeric) filter (where i->>'currency' = 'USD'), 0)
+      into refund_cup, refund_usd
+      from jsonb_array_elements(coalesce(b.items, '[]'::jsonb)) as i;
+
+    delete from bets where id = b.id;
+
+    update users
+       set cup = coalesce(cup, 0) + refund_cup,
+           usd = coalesce(usd, 0) + refund_usd,
+           updated_at = now()
+     where telegram_id = p_telegram_id
+    returning * into u;
+
+    return jsonb_build_object('ok', true, 'user', to_jsonb(u));
+end;
+$$;
+
+-- ========== APROBACIÓN DE DEPÓSITO ==========
+-- Marca la solicitud como aprobada y acredita el saldo en la misma transacción.
+-- Solo actúa si la solicitud sigue 'pending', así que aprobar dos veces (doble
+-- toque del admin, bot + WebApp) no acredita dos veces. Devuelve el usuario
+-- actualizado, o 0 filas si la solicitud ya estaba procesada.
+create or replace function approve_deposit(
+    p_request_id bigint,
+    p_cup numeric default 0,
+    p_usd numeric default 0,
+    p_admin_id bigint default null
+) returns setof users
+language plpgsql
+as $$
+declare
+    r deposit_requests%rowtype;
+begin
+    update deposit_requests
+       set status = 'approved',
+           updated_at = now(),
+           processed_at = now(),
+           processed_by = p_admin_id
+     where id = p_request_id
+       and status = 'pending'
+    returning * into r;
+
+    if not found then
+        return;
+    end if;
+
+    return query
+        update users
+           set cup = coalesce(cup, 0) + p_cup,
+               usd = coalesce(usd, 0) + p_usd,
+               updated_at = now()
+         where telegram_id = r.user_id
+        returning *;
+end;
+$$;
+
+-- ========== APROBACIÓN DE RETIRO ==========
+-- Pasa la solicitud de 'pending' a 'approved' y descuenta el saldo en la misma
+-- transacción. La fila de la solicitud se bloquea (FOR UPDATE), así un doble
+-- toque o aprobar desde el bot y la WebApp a la vez descuenta una sola vez.
+-- p_cup / p_usd son los montos a descontar (positivos). Si el saldo no alcanza
+-- no cambia nada. Devuelve {ok, reason} o {ok: true, user}.
+create or replace function approve_withdraw(
+    p_request_id bigint,
+    p_cup numeric default 0,
+    p_usd numeric default 0,
+    p_admin_id bigint default null
+) returns jsonb
+language plpgsql
+as $$
+declare
+    r withdraw_requests%rowtype;
+    u users%rowtype;
+begin
+    select * into r from withdraw_requests
+     where id = p_request_id and status = 'pending'
+       for update;
+    if not found then
+        return jsonb_build_object('ok', false, 'reason', 'not_pending');
+    end if;
+
+    update users
+       set cup = coalesce(cup, 0) - p_cup,
+           usd = coalesce(usd, 0) - p_usd,
+           updated_at = now()
+     where telegram_id = r.user_id
+       and coalesce(cup, 0) - p_cup >= 0
+       and coalesce(usd, 0) - p_usd >= 0
+    returning * into u;
+    if not found then
+        return jsonb_build_object('ok', false, 'reason', 'insufficient_funds');
+    end if;
+
+    update withdraw_requests
+       set status = 'approved',
+           updated_at = now(),
+           processed_at = now(),
+           processed_by = p_admin_id
+     where id = p_request_id;
+
+    return jsonb_build_object('ok', true, 'user', to_jsonb(u));
+end;
+$$;
+
+-- ========== OBTENER O CREAR USUARIO ==========
+-- Una sola llamada por actualización: devuelve el usuario existente (y
+-- actualiza su username solo si cambió) o lo crea con el bono inicial.
+-- is_new indica si se acaba de crear, para enviar el bono de bienvenida.
+-- Devuelve {user, is_new}.
+create or replace function get_or_create_user(
+    p_telegram_id bigint,
+    p_first_name text,
+    p_username text,
+    p_bonus_cup numeric
+) returns jsonb
+language plpgsql
+as $$
+declare
+    u users%rowtype;
+begin
+    select * into u from users where telegram_id = p_telegram_id;
+    if found then
+        if p_username is not null and u.username is distinct from p_username then
+            update users set username = p_username
+             where telegram_id = p_telegram_id
+            returning * into u;
+        end if;
+        return jsonb_build_object('user', to_jsonb(u), 'is_new', false);
+    end if;
+
+    insert into users (telegram_id, first_name, username, bonus_cup, cup, usd)
+    values (p_telegram_id, p_first_name, p_username, p_bonus_cup, 0, 0)
+    on conflict (telegram_id) do nothing
+    returning * into u;
+
+    if not found then
+        -- Otro proceso lo creó entre el select y el insert
+        select * into u from users where telegram_id = p_telegram_id;
+        return jsonb_build_object('user', to_jsonb(u), 'is_new', false);
+    end if;
+
+    return jsonb_build_object('user', to_jsonb(u), 'is_new', true);
+end;
+$$;
+
+-- ========== TRANSFERENCIA ENTRE USUARIOS ==========
+-- Débito y crédito en la misma transacción. Las dos filas se bloquean siempre
+-- en el mismo orden (menor telegram_id primero), así dos transferencias
+-- cruzadas A→B y B→A no pueden quedar en deadlock.
+-- p_currency es 'CUP' o 'USD'. Devuelve {ok, reason} o {ok: true, from, to}.
+create or replace function transfer_balance(
+    p_from bigint,
+    p_to bigint,
+    p_currency text,
+    p_amount numeric
+) returns jsonb
+language plpgsql
+as $$
+declare
+    src users%rowtype;
+    dst users%rowtype;
+begin
+    if p_amount <= 0 or p_from = p_to or p_currency not in ('CUP', 'USD') then
+        return jsonb_build_object('ok', false, 'reason', 'invalid');
+    end if;
+
+    perform 1 from users
+      where telegram_id in (least(p_from, p_to), greatest(p_from, p_to))
+      order by telegram_id
+      for update;
+
+    select * into src from users where telegram_id = p_from;
+    if not found then
+        return jsonb_build_object('ok', false, 'reason', 'source_not_found');
+    end if;
+    select * into dst from users where telegram_id = p_to;
+    if not found then
+        return jsonb_build_object('ok', false, 'reason', 'target_not_found');
+    end if;
+
+    if (p_currency = 'CUP' and coalesce(src.cup, 0) < p_amount)
+       or (p_currency = 'USD' and coalesce(src.usd, 0) < p_amount) then
+        return jsonb_build_object('ok', false, 'reason', 'insufficient_funds');
+    end if;
+
+    update users
+       set cup = coalesce(cup, 0) - case when p_currency = 'CUP' then p_amount else 0 end,
+           usd = coalesce(usd, 0) - case when p_currency = 'USD' then p_amount else 0 end,
+           updated_at = now()
+     where telegram_id = p_from
+    returning * into src;
+
+    update users
+       set cup = coalesce(cup, 0) + case when p_currency = 'CUP' then p_amount else 0 end,
+           usd = coalesce(usd, 0) + case when p_currency = 'USD' then p_amount else 0 end,
+           updated_at = now()
+     where telegram_id = p_to
+    returning * into dst;
+
+    return jsonb_build_object('ok', true, 'from', to_jsonb(src), 'to', to_jsonb(dst));
+end;
+$$;
+
+-- ========== RESUMEN DEL PANEL DE ADMIN ==========
+-- Todo lo que muestra "Ver datos actuales" en una sola llamada: tasas, mínimos
+-- de depósito/retiro, métodos y precios por jugada. Las claves ausentes
+-- vuelven como null y los listados vacíos como [].
+create or replace function admin_dashboard()
+returns jsonb
+language sql
+stable
+as $$
+    select jsonb_build_object(
+        'rates', (select jsonb_build_object('rate', rate, 'rate_usdt', rate_usdt, 'rate_trx', rate_trx)
+                    from exchange_rate where id = 1),
+        'min_deposit_usd', (select value from app_config where key = 'min_deposit_usd'),
+        'min_withdraw_usd', (select value from app_config where key = 'min_withdraw_usd'),
+        'deposit_methods', coalesce((select jsonb_agg(to_jsonb(m) order by m.id) from deposit_methods m), '[]'::jsonb),
+        'withdraw_methods', coalesce((select jsonb_agg(to_jsonb(m) order by m.id) from withdraw_methods m), '[]'::jsonb),
+        'play_prices', coalesce((select jsonb_agg(to_jsonb(p)) from play_prices p), '[]'::jsonb)
+    );
+$$;